@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from sm.engine.annotation.fdr import FDR
+
+
+class PerSampleMergeFDR(FDR):
+    """FDR estimation as it was before it was vectorized: one merge per decoy sample"""
+
+    @staticmethod
+    def _msm_fdr_map(target_msm, decoy_msm):
+        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
+        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
+        msm_df = (
+            pd.concat([target_msm_hits, decoy_msm_hits], axis=1)
+            .fillna(0)
+            .sort_index(ascending=False)
+        )
+        msm_df['target_cum'] = msm_df.target.cumsum()
+        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
+        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
+        return msm_df.fdr
+
+    def estimate_fdr(self, formula_msm):
+        td_df = self.td_df.set_index('tm')
+
+        target_fdr_df_list = []
+        for tm in self.target_modifiers_df.index.drop_duplicates():  # pylint: disable=invalid-name
+            target_msm = formula_msm[formula_msm.modifier == tm]
+            full_decoy_df = td_df.loc[tm, ['formula', 'dm']]
+
+            msm_fdr_list = []
+            for i in range(self.decoy_sample_size):
+                decoy_subset_df = full_decoy_df[i :: self.decoy_sample_size]
+                decoy_msm = pd.merge(
+                    formula_msm,
+                    decoy_subset_df,
+                    left_on=['formula', 'modifier'],
+                    right_on=['formula', 'dm'],
+                )
+                msm_fdr = self._msm_fdr_map(target_msm, decoy_msm)
+                msm_fdr_list.append(msm_fdr)
+
+            msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
+            target_fdr = self._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
+            target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
+
+        return pd.concat(target_fdr_df_list, axis=0)
+
+
+def make_formula_msm(fdr, rng, fraction_with_msm):
+    """Random MSMs for a fraction of the ions. MSMs are rounded so that many ions share an MSM,
+    as happens with real results"""
+    ions_df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    ions_df = ions_df[rng.random(len(ions_df)) < fraction_with_msm]
+    return ions_df.assign(msm=(rng.random(len(ions_df)) ** 4).round(3)).reset_index(drop=True)
+
+
+def run_benchmark(n_formulas, target_adducts, neutral_losses, decoy_sample_size, fraction_with_msm):
+    rng = np.random.default_rng(42)
+    formulas = [f'C{i}H{i % 50}O{i % 7}' for i in range(n_formulas)]
+
+    print(
+        f'{"analysis_version":>16} {"per-sample merge, s":>20} {"vectorized, s":>14} {"speedup":>8}'
+    )
+    for analysis_version in [1, 2]:
+        args = (
+            {'decoy_sample_size': decoy_sample_size},
+            [],
+            neutral_losses,
+            target_adducts,
+            analysis_version,
+        )
+        fdr, old_fdr = FDR(*args), PerSampleMergeFDR(*args)
+        fdr.decoy_adducts_selection(formulas)
+        old_fdr.td_df = fdr.td_table.to_df()
+        formula_msm = make_formula_msm(fdr, rng, fraction_with_msm)
+
+        start = time.perf_counter()
+        old_fdr_df = old_fdr.estimate_fdr(formula_msm)
+        old_t = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fdr_df = fdr.estimate_fdr(formula_msm)
+        new_t = time.perf_counter() - start
+
+        assert_frame_equal(fdr_df, old_fdr_df)
+        print(f'{analysis_version:>16} {old_t:>20.2f} {new_t:>14.2f} {old_t / new_t:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark vectorized vs per-decoy-sample FDR estimation on random MSMs'
+    )
+    parser.add_argument('--n-formulas', type=int, default=100000, help='Target DB size')
+    parser.add_argument(
+        '--target-adducts', nargs='+', default=['+H', '+Na', '+K'], help='Target adducts'
+    )
+    parser.add_argument('--neutral-losses', nargs='*', default=[], help='Neutral losses')
+    parser.add_argument('--decoy-sample-size', type=int, default=20, help='Decoy sample size')
+    parser.add_argument(
+        '--fraction-with-msm',
+        type=float,
+        default=0.5,
+        help='Fraction of ions that get an MSM, the rest are treated as not found',
+    )
+    args = parser.parse_args()
+
+    run_benchmark(
+        args.n_formulas,
+        args.target_adducts,
+        args.neutral_losses,
+        args.decoy_sample_size,
+        args.fraction_with_msm,
+    )
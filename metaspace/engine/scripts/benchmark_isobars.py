@@ -0,0 +1,142 @@
+import argparse
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from sm.engine.es_export import ESExporterIsobars
+
+
+class GroupbyESExporterIsobars(ESExporterIsobars):
+    """Isobar detection as it was before it was vectorized: a Python loop over the peaks of each
+    annotation"""
+
+    @classmethod
+    def get_isobars(cls, ann_ids, ions, ion_formulas, msms, peaks, isocalc):
+        ann_infos = {
+            ann_id: {'ion_formula': ion_formula, 'ion': ion, 'msm': msm}
+            for ann_id, ion, ion_formula, msm in zip(ann_ids, ions, ion_formulas, msms)
+        }
+        mzs_df = cls._build_mzs_df(ann_infos, peaks, isocalc)
+
+        isobars = {ann_id: [] for ann_id in ann_ids}
+        for ann_id, peak_rows in mzs_df.groupby('id'):
+            overlaps = cls._find_peak_overlaps(mzs_df, peak_rows)
+            cls._apply_overlap_group(ann_infos, isobars, ann_id, overlaps)
+        return isobars
+
+    @staticmethod
+    def _build_mzs_df(ann_infos, peaks, isocalc):
+        peak_ann_ids, peak_ns, peak_mzs = peaks
+        peaks_df = pd.DataFrame(
+            {
+                'id': peak_ann_ids,
+                'peak_n': peak_ns,
+                'mz': np.asarray(peak_mzs, dtype=np.float64),
+                'ion_formula': [ann_infos[ann_id]['ion_formula'] or '' for ann_id in peak_ann_ids],
+            }
+        )
+        mzs_df = peaks_df.sort_values('mz')
+
+        mzs_df['lower_mz'], mzs_df['upper_mz'] = isocalc.mass_accuracy_bounds(mzs_df['mz'])
+        mzs_df['lower_idx'] = np.searchsorted(mzs_df.upper_mz.values, mzs_df.lower_mz.values, 'l')
+        mzs_df['upper_idx'] = np.searchsorted(mzs_df.lower_mz.values, mzs_df.upper_mz.values, 'r')
+        return mzs_df
+
+    @staticmethod
+    def _find_peak_overlaps(mzs_df, peak_rows):
+        overlaps = defaultdict(list)
+        _ids = mzs_df.id.values
+        _ion_formulas = mzs_df.ion_formula.values
+        _peak_ns = mzs_df.peak_n.values
+        for lower_idx, upper_idx, ion_formula, peak_n in peak_rows[
+            ['lower_idx', 'upper_idx', 'ion_formula', 'peak_n']
+        ].itertuples(False, None):
+            peak_overlap_is = (
+                np.nonzero(_ion_formulas[lower_idx:upper_idx] < ion_formula)[0] + lower_idx
+            )
+            for peak_overlap_i in peak_overlap_is:
+                overlaps[_ids[peak_overlap_i]].append((int(peak_n), int(_peak_ns[peak_overlap_i])))
+        return overlaps
+
+    @staticmethod
+    def _apply_overlap_group(ann_infos, isobars, ann_id, overlaps):
+        for overlap_id, overlap_rows in overlaps.items():
+            peak_ns = sorted(overlap_rows)
+            if len(peak_ns) > 1 or (1, 1) in peak_ns:
+                isobars[ann_id].append({**ann_infos[overlap_id], 'peak_ns': peak_ns})
+                isobars[overlap_id].append(
+                    {**ann_infos[ann_id], 'peak_ns': [(b, a) for a, b in peak_ns]}
+                )
+
+
+def make_annotations(rng, n_anns, n_peaks, mz_range, n_formulas):
+    """Random annotations with 1..n_peaks peaks each. A small m/z range and a limited set of
+    ion formulas make overlaps and shared formulas common, as in crowded real spectra"""
+    ann_ids = rng.permutation(n_anns) + 1
+    ion_formulas = [f'C{i}H{i % 13}O{i % 5}+H' for i in rng.integers(n_formulas, size=n_anns)]
+    ions = [f'{f}_{i}' for i, f in enumerate(ion_formulas)]
+    msms = rng.random(n_anns).round(3).tolist()
+
+    peak_counts = rng.integers(1, n_peaks + 1, size=n_anns)
+    peak_ann_ids = np.repeat(ann_ids, peak_counts).astype('O')
+    peak_ns = np.concatenate([np.arange(1, n + 1) for n in peak_counts])
+    base_mzs = rng.uniform(*mz_range, size=n_anns)
+    peak_mzs = np.repeat(base_mzs, peak_counts) + (peak_ns - 1) * 1.003355
+    return ann_ids.tolist(), ions, ion_formulas, msms, (peak_ann_ids, peak_ns, peak_mzs)
+
+
+def run_benchmark(n_anns_list, n_peaks, mz_range, n_formulas, ppm):
+    rng = np.random.default_rng(42)
+    isocalc = IsocalcWrapper(
+        {
+            'analysis_version': 1,
+            'isotope_generation': {
+                'instrument': 'TOF',
+                'charge': 1,
+                'isocalc_sigma': 0.001238,
+                'n_peaks': n_peaks,
+            },
+            'image_generation': {'ppm': ppm},
+        }
+    )
+
+    print(
+        f'{"annotations":>12} {"isobar links":>13} {"groupby, s":>11} {"arrays, s":>10} {"speedup":>8}'
+    )
+    for n_anns in n_anns_list:
+        args = (*make_annotations(rng, n_anns, n_peaks, mz_range, n_formulas), isocalc)
+
+        start = time.perf_counter()
+        old_isobars = GroupbyESExporterIsobars.get_isobars(*args)
+        old_t = time.perf_counter() - start
+
+        start = time.perf_counter()
+        isobars = ESExporterIsobars.get_isobars(*args)
+        new_t = time.perf_counter() - start
+
+        assert isobars == old_isobars
+        n_links = sum(len(entries) for entries in isobars.values())
+        print(f'{n_anns:>12} {n_links:>13} {old_t:>11.2f} {new_t:>10.2f} {old_t / new_t:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark array-based vs groupby-based isobar detection on random annotations'
+    )
+    parser.add_argument(
+        '--n-anns', type=int, nargs='+', default=[1000, 10000, 50000], help='Annotation counts'
+    )
+    parser.add_argument('--n-peaks', type=int, default=4, help='Max peaks per annotation')
+    parser.add_argument(
+        '--mz-range', type=float, nargs=2, default=[100, 1000], help='Range of first peak m/z'
+    )
+    parser.add_argument(
+        '--n-formulas', type=int, default=5000, help='Number of distinct ion formulas'
+    )
+    parser.add_argument('--ppm', type=float, default=3, help='Mass accuracy')
+    args = parser.parse_args()
+
+    run_benchmark(args.n_anns, args.n_peaks, args.mz_range, args.n_formulas, args.ppm)
@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import numpy as np
+from cpyImagingMSpec import measure_of_chaos
+from scipy.ndimage import gaussian_filter
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation.image_measures import measure_of_chaos_sparse
+
+
+def make_ion_image(rng, nrows, ncols, density):
+    """Random ion image with roughly `density` of its pixels non-zero, organized in blobs
+    like real ion images rather than in uniformly scattered pixels"""
+    noise = gaussian_filter(rng.random((nrows, ncols)), sigma=2)
+    threshold = np.quantile(noise, 1 - density)
+    img = np.where(noise > threshold, rng.random((nrows, ncols)) * 1000, 0).astype(np.float32)
+    return coo_matrix(img)
+
+
+def time_fn(fn, images, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for img in images:
+            fn(img)
+        best = min(best, time.perf_counter() - start)
+    return best / len(images)
+
+
+def run_benchmark(sizes, densities, n_images, n_levels, repeats):
+    rng = np.random.default_rng(42)
+
+    def dense(img):
+        return measure_of_chaos(img.toarray(), n_levels)
+
+    def sparse(img):
+        return measure_of_chaos_sparse(
+            img.row.astype(np.int64) * img.shape[1] + img.col, img.data, *img.shape, n_levels
+        )
+
+    print(f'{"size":>11} {"density":>8} {"dense, ms":>10} {"sparse, ms":>11} {"speedup":>8}')
+    for size in sizes:
+        for density in densities:
+            images = [make_ion_image(rng, size, size, density) for _ in range(n_images)]
+            for img in images:
+                dense_moc, sparse_moc = dense(img), sparse(img)
+                assert dense_moc == sparse_moc or (np.isnan(dense_moc) and np.isnan(sparse_moc))
+
+            dense_t = time_fn(dense, images, repeats)
+            sparse_t = time_fn(sparse, images, repeats)
+            print(
+                f'{size:>5}x{size:<5} {density:>8.3f} {dense_t * 1000:>10.3f} '
+                f'{sparse_t * 1000:>11.3f} {dense_t / sparse_t:>8.2f}'
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark sparse vs dense measure of chaos on random ion images'
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 300, 1000], help='Image side lengths'
+    )
+    parser.add_argument(
+        '--densities',
+        type=float,
+        nargs='+',
+        default=[0.001, 0.01, 0.05, 0.2, 0.5],
+        help='Fractions of non-zero pixels',
+    )
+    parser.add_argument('--n-images', type=int, default=20, help='Images per size and density')
+    parser.add_argument('--n-levels', type=int, default=30, help='Number of intensity levels')
+    parser.add_argument('--repeats', type=int, default=3, help='Timing repeats (best is taken)')
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.densities, args.n_images, args.n_levels, args.repeats)
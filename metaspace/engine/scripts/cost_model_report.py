@@ -0,0 +1,62 @@
+import argparse
+import logging
+
+import pandas as pd
+
+from sm.engine.annotation_lithops.cost_model import (
+    CostModel,
+    load_history,
+    prediction_report,
+    summarize_report,
+)
+from sm.engine.db import DB
+from sm.engine.util import GlobalInit
+
+
+def run(history_limit, show_activations):
+    history = load_history(DB(), history_limit)
+    cost_model = CostModel.from_history((name, extra_data) for _, name, extra_data in history)
+    for stage, model in cost_model.stage_models.items():
+        coefs = dict(zip(model.factor_names, model.coefs.tolist()))
+        print(
+            f'{stage}: overhead {model.overhead_s:.2f}s, seconds per unit {coefs}, '
+            f'fitted to {model.n_activations} activations'
+        )
+
+    summaries = []
+    for profile_id, name, extra_data in history:
+        report = prediction_report(cost_model, name, extra_data)
+        if report is not None:
+            summaries.append({'profile_id': profile_id, 'stage': name, **summarize_report(report)})
+            if show_activations:
+                print(f'Profile {profile_id} {name}:\n{report.to_string()}')
+
+    if summaries:
+        with pd.option_context('display.max_rows', None, 'display.width', 1000):
+            print(
+                pd.DataFrame(summaries).sort_values(['stage', 'profile_id']).to_string(index=False)
+            )
+    else:
+        logger.warning('Not enough perf profile history to fit the cost model')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare cost model predictions against actual Lithops activation times. '
+        'Note that the model is evaluated on the same history that it is fitted to.'
+    )
+    parser.add_argument('--config', default='conf/config.json', help='SM config path')
+    parser.add_argument(
+        '--history-limit',
+        type=int,
+        default=200,
+        help='Number of most recent perf profile entries per stage to use',
+    )
+    parser.add_argument(
+        '--show-activations', action='store_true', help='Print times of every activation'
+    )
+    args = parser.parse_args()
+    logger = logging.getLogger('engine')
+
+    with GlobalInit(config_path=args.config):
+        run(history_limit=args.history_limit, show_activations=args.show_activations)
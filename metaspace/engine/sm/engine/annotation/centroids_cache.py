@@ -0,0 +1,261 @@
+"""Cache of theoretical isotope patterns, shared by the daemons, the REST API and scripts.
+
+Recently used patterns are kept in a bounded in-memory LRU. If a path is configured, patterns
+are also stored in a local SQLite file, so that they survive restarts and are shared between
+processes on the same machine. The file is bounded too: when it holds too many patterns,
+the least recently used ones are deleted. Writes to the file are batched, so patterns that were
+computed just before a process exits without closing the cache may not be stored.
+"""
+import atexit
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger('engine')
+
+DEFAULT_MAX_ITEMS = 100000
+DEFAULT_MAX_DISK_ITEMS = 5000000
+# Counting rows takes a full index scan, so the on-disk size is only checked every N writes
+DISK_SIZE_CHECK_INTERVAL = 1000
+# When the on-disk store is full, it's shrunk to this fraction of its limit so that
+# the eviction doesn't have to run again after the next few writes
+DISK_EVICTION_TARGET = 0.9
+# Patterns are written to disk in a single transaction once this many are pending,
+# or once the oldest pending one has waited this long
+DISK_WRITE_BATCH_SIZE = 100
+DISK_WRITE_MAX_DELAY_S = 10
+# A disk hit only updates the pattern's last used time if it's older than this, so that reads
+# don't turn into writes. Eviction only needs to tell apart patterns unused for much longer
+LAST_USED_UPDATE_INTERVAL_S = 600
+
+
+class CentroidsCache:
+    """Bounded LRU cache in front of an optional SQLite store. Thread- and fork-safe.
+
+    Keys must be tuples of primitive values, as their repr is used as the on-disk key.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_items: int = DEFAULT_MAX_ITEMS,
+        max_disk_items: int = DEFAULT_MAX_DISK_ITEMS,
+    ):
+        self.path = path
+        self.max_items = max_items
+        self.max_disk_items = max_disk_items
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._disk_puts_since_size_check = 0
+        self._pending_disk_puts: Dict[str, Any] = {}
+        self._pending_disk_puts_since = 0.0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.disk_errors = 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        # SQLite connections must not be shared with forked processes
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS centroids '
+                '(key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL DEFAULT 0)'
+            )
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(centroids)')]
+            if 'last_used' not in columns:
+                # Files created before the on-disk store was bounded
+                conn.execute('ALTER TABLE centroids ADD COLUMN last_used REAL NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS centroids_last_used ON centroids (last_used)')
+            self._conn, self._conn_pid = conn, os.getpid()
+            self._evict_from_disk()
+        return self._conn
+
+    def _evict_from_disk(self):
+        """Deletes the least recently used patterns if the on-disk store is over its limit"""
+        self._disk_puts_since_size_check = 0
+        (disk_items,) = self._conn.execute('SELECT COUNT(*) FROM centroids').fetchone()
+        if disk_items > self.max_disk_items:
+            n_evicted = disk_items - int(self.max_disk_items * DISK_EVICTION_TARGET)
+            self._conn.execute(
+                'DELETE FROM centroids WHERE key IN '
+                '(SELECT key FROM centroids ORDER BY last_used LIMIT ?)',
+                (n_evicted,),
+            )
+            self.disk_evictions += n_evicted
+
+    def _disk_get(self, key: Hashable):
+        key_repr = repr(key)
+        if key_repr in self._pending_disk_puts:
+            return True, self._pending_disk_puts[key_repr]
+        try:
+            conn = self._connection()
+            if conn is not None:
+                row = conn.execute(
+                    'SELECT value, last_used FROM centroids WHERE key = ?', (key_repr,)
+                ).fetchone()
+                if row is not None:
+                    value, last_used = row
+                    now = time.time()
+                    if now - last_used >= LAST_USED_UPDATE_INTERVAL_S:
+                        conn.execute(
+                            'UPDATE centroids SET last_used = ? WHERE key = ?', (now, key_repr)
+                        )
+                    return True, pickle.loads(value)
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f'Centroids cache read failed: {e}')
+        return False, None
+
+    def _disk_put(self, key: Hashable, value: Any):
+        if self.path is None:
+            return
+        now = time.time()
+        if not self._pending_disk_puts:
+            self._pending_disk_puts_since = now
+        self._pending_disk_puts[repr(key)] = value
+        if (
+            len(self._pending_disk_puts) >= DISK_WRITE_BATCH_SIZE
+            or now - self._pending_disk_puts_since >= DISK_WRITE_MAX_DELAY_S
+        ):
+            self._flush_disk_puts()
+
+    def _flush_disk_puts(self):
+        if not self._pending_disk_puts:
+            return
+        pending, self._pending_disk_puts = self._pending_disk_puts, {}
+        now = time.time()
+        rows = [
+            (key_repr, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now)
+            for key_repr, value in pending.items()
+        ]
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO centroids (key, value, last_used) VALUES (?, ?, ?)',
+                    rows,
+                )
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            self._disk_puts_since_size_check += len(rows)
+            if self._disk_puts_since_size_check >= DISK_SIZE_CHECK_INTERVAL:
+                self._evict_from_disk()
+        except sqlite3.Error as e:
+            self.disk_errors += 1
+            logger.warning(f'Centroids cache write failed: {e}')
+
+    def _memory_put(self, key: Hashable, value: Any):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key]
+
+            found, value = self._disk_get(key)
+            if found:
+                self.disk_hits += 1
+                self._memory_put(key, value)
+                return value
+
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._memory_put(key, value)
+            self._disk_put(key, value)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]):
+        """Returns the cached value, or computes and caches it. Computation is done outside of the
+        lock, so the same value may occasionally be computed by several threads at once."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def flush(self):
+        """Writes pending patterns to disk"""
+        with self._lock:
+            self._flush_disk_puts()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'items': len(self._items),
+            'max_items': self.max_items,
+            'max_disk_items': self.max_disk_items,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'disk_evictions': self.disk_evictions,
+            'disk_errors': self.disk_errors,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_disk_puts()
+            if self._conn is not None and self._conn_pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+_instance: Optional[CentroidsCache] = None
+
+
+def get_instance() -> Optional[CentroidsCache]:
+    return _instance
+
+
+def set_instance(cache: Optional[CentroidsCache]):
+    # pylint: disable=global-statement
+    global _instance
+    if _instance is not None and _instance is not cache:
+        _instance.close()
+    _instance = cache
+
+
+@atexit.register
+def _flush_instance():
+    if _instance is not None:
+        _instance.flush()
+
+
+def init(sm_config: Dict):
+    """Enables the shared cache if the "centroids_cache" config section is present"""
+    cache_config = sm_config.get('centroids_cache')
+    if cache_config:
+        set_instance(
+            CentroidsCache(
+                cache_config.get('path'),
+                cache_config.get('max_items', DEFAULT_MAX_ITEMS),
+                cache_config.get('max_disk_items', DEFAULT_MAX_DISK_ITEMS),
+            )
+        )
@@ -1,5 +1,6 @@
 import logging
 from itertools import product
+from typing import NamedTuple, Optional
 
 import numpy as np
 import pandas as pd
@@ -91,6 +92,9 @@ DECOY_ADDUCTS = [
     '+Ta',
 ]
 
+# Number of target formulas to choose decoys for at a time, to limit the memory used for sampling
+DECOY_SELECTION_BATCH = 10000
+
 
 def _make_target_modifiers_df(chem_mods, neutral_losses, target_adducts):
     """
@@ -111,6 +115,35 @@ def _make_target_modifiers_df(chem_mods, neutral_losses, target_adducts):
     return df
 
 
+class TargetDecoyTable(NamedTuple):
+    """Integer-coded decoys of each target ion, so that large databases don't need a Python string
+    for every (formula, target modifier, decoy modifier) combination"""
+
+    formulas: np.ndarray
+    target_modifiers: np.ndarray
+    decoy_modifiers: np.ndarray
+    dm_i: np.ndarray
+    """shape: (formulas, target modifiers, decoys per target ion). Index into `decoy_modifiers` of
+    each decoy ion. The i-th decoy of each target ion belongs to the i-th decoy sample"""
+
+    def to_df(self):
+        """The table as a DataFrame with columns: formula, tm, dm"""
+        n_formulas, n_tms, n_decoys = self.dm_i.shape
+        return pd.DataFrame(
+            {
+                'formula': np.repeat(self.formulas, n_tms * n_decoys),
+                'tm': np.tile(np.repeat(self.target_modifiers, n_decoys), n_formulas),
+                'dm': self.decoy_modifiers[self.dm_i.ravel()],
+            }
+        )
+
+    def subset(self, formulas):
+        """The decoys of `formulas`, which must all be in this table"""
+        formula_i = pd.Index(self.formulas).get_indexer(pd.unique(pd.Series(formulas, dtype='O')))
+        assert (formula_i >= 0).all(), 'Formulas are missing from the target-decoy table'
+        return self._replace(formulas=self.formulas[formula_i], dm_i=self.dm_i[formula_i])
+
+
 class FDR:
     fdr_levels = [0.05, 0.1, 0.2, 0.5]
 
@@ -120,41 +153,114 @@ class FDR:
         self.neutral_losses = neutral_losses
         self.target_adducts = target_adducts
         self.analysis_version = analysis_version
-        self.td_df = None
+        self.td_table: Optional[TargetDecoyTable] = None
         self.random_seed = 42
         self.target_modifiers_df = _make_target_modifiers_df(
             chem_mods, neutral_losses, target_adducts
         )
 
-    def _choose_decoys(self, decoys):
-        copy = decoys.copy()
-        np.random.shuffle(copy)
-        return copy[: self.decoy_sample_size]
+    def __setstate__(self, state):
+        # FDR objects pickled before decoys were integer-coded (e.g. in the centroids cache) have
+        # a `td_df` DataFrame instead of `td_table`
+        if 'td_df' in state:
+            state = state.copy()
+            td_df = state.pop('td_df')
+            state['td_table'] = None if td_df is None else self._td_table_from_df(state, td_df)
+        self.__dict__.update(state)
 
-    def _decoy_adduct_gen(self, target_formulas, decoy_adducts_cand):
-        np.random.seed(self.random_seed)
-        target_modifiers = list(self.target_modifiers_df.decoy_modifier_prefix.items())
-        # pylint: disable=invalid-name
-        for formula, (tm, dm_prefix) in product(target_formulas, target_modifiers):
-            for da in self._choose_decoys(decoy_adducts_cand):
-                yield (formula, tm, dm_prefix + da)
+    @staticmethod
+    def _td_table_from_df(state, td_df):
+        """Converts a DataFrame with columns: formula, tm, dm, that has `n_decoys` consecutive rows
+        for each target ion, into a `TargetDecoyTable`"""
+        decoy_adduct_cand = [add for add in DECOY_ADDUCTS if add not in state['target_adducts']]
+        n_decoys = min(state['decoy_sample_size'], len(decoy_adduct_cand))
+        # Only the first set of decoys of a target ion was used if it was listed more than once
+        target_ions = td_df[['formula', 'tm']].iloc[::n_decoys]
+        is_first = ~target_ions.duplicated().values
+        formula_i, formulas = pd.factorize(target_ions.formula.values[is_first])
+        tm_i, target_modifiers = pd.factorize(target_ions.tm.values[is_first])
+        dm_codes, decoy_modifiers = pd.factorize(td_df.dm.values)
+        dm_codes = dm_codes.astype(np.min_scalar_type(max(len(decoy_modifiers) - 1, 0)))
+
+        dm_i = np.empty((len(formulas), len(target_modifiers), n_decoys), dtype=dm_codes.dtype)
+        assert len(formula_i) == dm_i.shape[0] * dm_i.shape[1], 'Target-decoy table is incomplete'
+        dm_i[formula_i, tm_i] = dm_codes.reshape(-1, n_decoys)[is_first]
+        return TargetDecoyTable(
+            formulas=np.asarray(formulas, dtype='O'),
+            target_modifiers=np.asarray(target_modifiers, dtype='O'),
+            decoy_modifiers=np.asarray(decoy_modifiers, dtype='O'),
+            dm_i=dm_i,
+        )
+
+    def decoy_adducts_selection(
+        self, target_formulas, shared_td_table: Optional[TargetDecoyTable] = None
+    ):
+        """Randomly chooses `decoy_sample_size` decoy adducts for each target ion.
+
+        Args
+        -----
+        target_formulas: Formulas of the database
+        shared_td_table: If set, decoys are taken from this table instead of being chosen, so that
+            databases that have formulas in common can share their decoy ions. It must have been
+            made by an FDR with the same config, from formulas that include `target_formulas`
+        """
+        if shared_td_table is not None:
+            self.td_table = shared_td_table.subset(target_formulas)
+            return
 
-    def decoy_adducts_selection(self, target_formulas):
         decoy_adduct_cand = [add for add in DECOY_ADDUCTS if add not in self.target_adducts]
-        self.td_df = pd.DataFrame(
-            self._decoy_adduct_gen(target_formulas, decoy_adduct_cand),
-            columns=['formula', 'tm', 'dm'],
+        n_decoys = min(self.decoy_sample_size, len(decoy_adduct_cand))
+        formulas = pd.unique(pd.Series(target_formulas, dtype='O'))
+        # Decoys are drawn for every row, but only the first row of a duplicated target modifier
+        # is kept, so that the same random numbers are used as when decoys were stored as strings
+        is_first = ~self.target_modifiers_df.index.duplicated()
+        tm_df = self.target_modifiers_df[is_first]
+
+        # Decoy modifier of each (target modifier, decoy adduct) pair
+        dm_codes, decoy_modifiers = pd.factorize(
+            [prefix + da for prefix in tm_df.decoy_modifier_prefix for da in decoy_adduct_cand]
+        )
+        dm_codes = dm_codes.reshape(len(tm_df), len(decoy_adduct_cand))
+        dm_codes = dm_codes.astype(np.min_scalar_type(max(len(decoy_modifiers) - 1, 0)))
+
+        # Shuffling integer codes with the legacy RandomState consumes the same random numbers as
+        # shuffling the list of decoy adducts did, so the chosen decoys stay the same
+        random_state = np.random.RandomState(self.random_seed)
+        n_rows = len(self.target_modifiers_df)
+        dm_i = np.empty((len(formulas), len(tm_df), n_decoys), dtype=dm_codes.dtype)
+        for start in range(0, len(formulas), DECOY_SELECTION_BATCH):
+            batch = dm_i[start : start + DECOY_SELECTION_BATCH]
+            perms = np.tile(np.arange(len(decoy_adduct_cand)), (len(batch) * n_rows, 1))
+            for perm in perms:
+                random_state.shuffle(perm)
+            perms = perms.reshape(len(batch), n_rows, -1)[:, is_first, :n_decoys]
+            batch[:] = dm_codes[np.arange(len(tm_df))[None, :, None], perms]
+
+        self.td_table = TargetDecoyTable(
+            formulas=formulas,
+            target_modifiers=tm_df.index.values,
+            decoy_modifiers=np.asarray(decoy_modifiers, dtype='O'),
+            dm_i=dm_i,
         )
 
+    def _decoy_keys(self):
+        """Unique integer key of each decoy ion in `td_table.dm_i`"""
+        td_table = self.td_table
+        formula_i = np.arange(len(td_table.formulas), dtype=np.int64)[:, None, None]
+        return formula_i * len(td_table.decoy_modifiers) + td_table.dm_i
+
     def ion_tuples(self):
         """Returns list of tuples in List[(formula, modifier)] form.
 
         All ions needed for FDR calculation as a list of (formula, modifier),
         where modifier is a combination of chemical modification, neutral loss and adduct
         """
-        d_ions = self.td_df[['formula', 'dm']].drop_duplicates().values.tolist()
-        t_ions = self.td_df[['formula', 'tm']].drop_duplicates().values.tolist()
-        return list(map(tuple, t_ions + d_ions))
+        td_table = self.td_table
+        t_ions = list(product(td_table.formulas, td_table.target_modifiers))
+        decoy_keys = pd.unique(self._decoy_keys().ravel())
+        formula_i, dm_i = np.divmod(decoy_keys, len(td_table.decoy_modifiers))
+        d_ions = list(zip(td_table.formulas[formula_i], td_table.decoy_modifiers[dm_i]))
+        return t_ions + d_ions
 
     def target_modifiers(self):
         """ List of possible modifier values for target ions """
@@ -168,18 +274,40 @@ class FDR:
         return 1.0
 
     @staticmethod
-    def _msm_fdr_map(target_msm, decoy_msm):
-        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
-        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
-        msm_df = (
-            pd.concat([target_msm_hits, decoy_msm_hits], axis=1)
-            .fillna(0)
-            .sort_index(ascending=False)
-        )
-        msm_df['target_cum'] = msm_df.target.cumsum()
-        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
-        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
-        return msm_df.fdr
+    def _msm_fdr(target_msm, decoy_msm, decoy_sample_i, decoy_sample_size):
+        """FDR of each target's MSM: the median across decoy samples of the number of decoys
+        with an MSM at least as high, divided by the number of targets with an MSM at least as high.
+
+        Args
+        -----
+        target_msm: MSMs of the targets
+        decoy_msm: MSMs of the decoys of all samples
+        decoy_sample_i: Decoy sample index of each decoy MSM
+        decoy_sample_size: Number of decoy samples
+        Returns
+        -----
+        np.ndarray: FDR of each target, NaN for targets without an MSM
+        """
+        fdr = np.full(len(target_msm), np.nan)
+        has_msm = ~np.isnan(target_msm)
+        msm_levels, target_level_i = np.unique(target_msm[has_msm], return_inverse=True)
+        if len(msm_levels) == 0:
+            return fdr
+
+        target_hits = np.bincount(target_level_i, minlength=len(msm_levels))
+        target_cum = np.cumsum(target_hits[::-1])[::-1]
+
+        # Each decoy is counted at the highest target MSM level that it reaches
+        decoy_level_i = np.searchsorted(msm_levels, decoy_msm, side='right') - 1
+        is_counted = (decoy_level_i >= 0) & ~np.isnan(decoy_msm)
+        decoy_hits = np.bincount(
+            decoy_sample_i[is_counted] * len(msm_levels) + decoy_level_i[is_counted],
+            minlength=decoy_sample_size * len(msm_levels),
+        ).reshape(decoy_sample_size, len(msm_levels))
+        decoy_cum = np.cumsum(decoy_hits[:, ::-1], axis=1)[:, ::-1]
+
+        fdr[has_msm] = np.median(decoy_cum / target_cum, axis=0)[target_level_i]
+        return fdr
 
     def _digitize_fdr(self, fdr_df):
         if self.analysis_version < 2:
@@ -198,28 +326,31 @@ class FDR:
 
     def estimate_fdr(self, formula_msm):
         logger.info('Estimating FDR')
+        td_table = self.td_table
+        n_decoys = td_table.dm_i.shape[2]
+
+        # Look up the MSMs of all decoy ions with one hash join on their integer keys
+        formula_i = pd.Index(td_table.formulas).get_indexer(formula_msm.formula)
+        dm_i = pd.Index(td_table.decoy_modifiers).get_indexer(formula_msm.modifier)
+        is_decoy = (formula_i >= 0) & (dm_i >= 0)
+        msm_keys = pd.Index(
+            formula_i[is_decoy].astype(np.int64) * len(td_table.decoy_modifiers) + dm_i[is_decoy]
+        )
+        # The last value is used for decoy ions without an MSM
+        decoy_msms = np.append(formula_msm.msm.values[is_decoy].astype(np.float64), np.nan)
+        decoy_keys = self._decoy_keys()
+        decoy_sample_i = np.tile(np.arange(n_decoys), len(td_table.formulas))
 
-        td_df = self.td_df.set_index('tm')
+        msm_by_modifier = dict(tuple(formula_msm.groupby('modifier', sort=False)))
 
         target_fdr_df_list = []
-        for tm in self.target_modifiers_df.index.drop_duplicates():  # pylint: disable=invalid-name
-            target_msm = formula_msm[formula_msm.modifier == tm]
-            full_decoy_df = td_df.loc[tm, ['formula', 'dm']]
-
-            msm_fdr_list = []
-            for i in range(self.decoy_sample_size):
-                decoy_subset_df = full_decoy_df[i :: self.decoy_sample_size]
-                decoy_msm = pd.merge(
-                    formula_msm,
-                    decoy_subset_df,
-                    left_on=['formula', 'modifier'],
-                    right_on=['formula', 'dm'],
-                )
-                msm_fdr = self._msm_fdr_map(target_msm, decoy_msm)
-                msm_fdr_list.append(msm_fdr)
-
-            msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
-            target_fdr = self._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
+        for tm_i, tm in enumerate(td_table.target_modifiers):  # pylint: disable=invalid-name
+            target_msm = msm_by_modifier.get(tm, formula_msm.iloc[:0])
+            decoy_msm = decoy_msms[msm_keys.get_indexer(decoy_keys[:, tm_i, :].ravel())]
+            fdr = self._msm_fdr(
+                target_msm.msm.values.astype(np.float64), decoy_msm, decoy_sample_i, n_decoys
+            )
+            target_fdr = self._digitize_fdr(target_msm.assign(fdr=fdr))
             target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
 
         return pd.concat(target_fdr_df_list, axis=0)
@@ -1,8 +1,12 @@
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from itertools import repeat
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
@@ -16,18 +20,62 @@ from sm.engine.storage import get_s3_client
 
 logger = logging.getLogger('engine')
 
+# Below this number of formulas, starting Spark jobs takes longer than generating the centroids
+LOCAL_GENERATION_MAX_FORMULAS = 20000
+LOCAL_GENERATION_CHUNK_SIZE = 1000
+CENTROIDS_SCHEMA = pa.schema(
+    [
+        ('formula_i', pa.int64()),
+        ('peak_i', pa.int64()),
+        ('mz', pa.float64()),
+        ('int', pa.float64()),
+    ]
+)
+
+
+def _calc_centroids_chunk(isocalc, formula_items):
+    """Returns the centroids of formulas as a table, skipping formulas that failed
+
+    Args
+    ---
+    formula_items: iterable of (formula_i, formula)
+    """
+    formula_is, mzs, ints = [], [], []
+    for formula_i, formula in formula_items:
+        formula_mzs, formula_ints = isocalc.centroids(formula)
+        if formula_mzs is not None:
+            formula_is.append(np.full(len(formula_mzs), formula_i, dtype=np.int64))
+            mzs.append(formula_mzs)
+            ints.append(formula_ints)
+
+    if not formula_is:
+        return CENTROIDS_SCHEMA.empty_table()
+    peak_is = np.concatenate([np.arange(len(formula_mzs)) for formula_mzs in mzs])
+    return pa.Table.from_arrays(
+        [
+            pa.array(np.concatenate(formula_is)),
+            pa.array(peak_is, type=pa.int64()),
+            pa.array(np.concatenate(mzs), type=pa.float64()),
+            pa.array(np.concatenate(ints), type=pa.float64()),
+        ],
+        schema=CENTROIDS_SCHEMA,
+    )
+
 
 class CentroidsGenerator:
     """Generator of theoretical isotope peaks for all molecules in database."""
 
-    def __init__(self, sc, isocalc):
+    def __init__(self, sc, isocalc, n_workers=None):
         """
         Args:
-            sc (SparkContext):
+            sc (Optional[SparkContext]): if None, centroids are always generated locally
             isocalc (IsocalcWrapper):
+            n_workers (Optional[int]): number of processes for local generation.
+                Defaults to the number of CPUs
         """
         self._sc = sc
         self._isocalc = isocalc
+        self._n_workers = n_workers or os.cpu_count()
         self._sm_config = SMConfig.get_conf()
         self._parquet_chunks_n = 64
         self._iso_gen_part_n = 512
@@ -57,35 +105,63 @@ class CentroidsGenerator:
 
         self._s3 = get_s3_client()
 
+    def _generate_chunks_spark(self, formulas_df):
+        # toLocalIterator would run a separate Spark job per partition, so all partitions'
+        # tables are collected in one job instead. They are compact Arrow tables, not Python rows
+        isocalc = deepcopy(self._isocalc)
+
+        def calc_centroids(items):
+            yield _calc_centroids_chunk(isocalc, items)
+
+        return (
+            self._sc.parallelize(formulas_df.reset_index().values, numSlices=self._iso_gen_part_n)
+            .mapPartitions(calc_centroids)
+            .collect()
+        )
+
+    def _generate_chunks_local(self, formulas_df):
+        items = list(formulas_df.formula.items())
+        chunks = [
+            items[i : i + LOCAL_GENERATION_CHUNK_SIZE]
+            for i in range(0, len(items), LOCAL_GENERATION_CHUNK_SIZE)
+        ]
+        n_workers = min(self._n_workers, len(chunks))
+        if n_workers <= 1:
+            yield from map(partial(_calc_centroids_chunk, self._isocalc), chunks)
+        else:
+            # The daemons call this from their queue consumer threads. Forking a process that runs
+            # other threads can leave the children deadlocked on locks that those threads held,
+            # so the workers are started from a clean interpreter instead.
+            with ProcessPoolExecutor(n_workers, mp_context=get_context('spawn')) as executor:
+                yield from executor.map(partial(_calc_centroids_chunk, self._isocalc), chunks)
+
     def _generate(self, formulas, index_start=0):
         """Generate isotopic peaks
 
+        Uses Spark for large numbers of formulas and a local process pool otherwise.
+        Centroids are received chunk by chunk as Arrow tables,
+        so that they are never held in memory as Python objects.
+
         Args
         ---
         formulas: list
         """
-        logger.info('Generating molecular isotopic peaks')
-
-        isocalc = deepcopy(self._isocalc)
-
-        def calc_centroids(args):
-            formula_i, formula = args
-            mzs, ints = isocalc.centroids(formula)
-            if mzs is not None:
-                return zip(repeat(formula_i), range(0, len(mzs)), map(float, mzs), map(float, ints))
-            return []
-
         formulas_df = pd.DataFrame(
             list(enumerate(formulas, index_start)), columns=['formula_i', 'formula']
         ).set_index('formula_i')
-        centroids_rdd = self._sc.parallelize(
-            formulas_df.reset_index().values, numSlices=self._iso_gen_part_n
-        ).flatMap(calc_centroids)
-        centroids_df = (
-            pd.DataFrame(data=centroids_rdd.collect(), columns=['formula_i', 'peak_i', 'mz', 'int'])
-            .sort_values(by='mz')
-            .set_index('formula_i')
+
+        if self._sc is not None and len(formulas) >= LOCAL_GENERATION_MAX_FORMULAS:
+            logger.info(f'Generating molecular isotopic peaks for {len(formulas)} formulas: Spark')
+            chunks = self._generate_chunks_spark(formulas_df)
+        else:
+            logger.info(f'Generating molecular isotopic peaks for {len(formulas)} formulas: local')
+            chunks = self._generate_chunks_local(formulas_df)
+
+        # concat_tables doesn't copy the chunks, so the only copy is the conversion to pandas
+        centroids_table = pa.concat_tables(
+            [chunk for chunk in chunks if chunk.num_rows] or [CENTROIDS_SCHEMA.empty_table()]
         )
+        centroids_df = centroids_table.to_pandas().sort_values(by='mz').set_index('formula_i')
 
         # to exclude all formulas that failed
         formulas_df = formulas_df.loc[centroids_df.index.unique()]
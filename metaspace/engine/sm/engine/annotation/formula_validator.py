@@ -1,7 +1,7 @@
 """
 Classes and functions for isotope image validation
 """
-from collections import OrderedDict, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from typing import (
     Tuple,
     Dict,
@@ -12,6 +12,7 @@ from typing import (
     Optional,
     Iterable,
     TypedDict,
+    Union,
 )
 
 import numpy as np
@@ -20,6 +21,7 @@ from pyImagingMSpec.image_measures import isotope_image_correlation, isotope_pat
 from cpyImagingMSpec import measure_of_chaos
 from scipy.sparse import coo_matrix
 
+from sm.engine.annotation.image_measures import measure_of_chaos_sparse
 from sm.engine.ds_config import DSConfigImageGeneration
 
 METRICS = OrderedDict(
@@ -33,6 +35,14 @@ METRICS = OrderedDict(
         ('max_iso_ints', [0.0, 0.0, 0.0, 0.0]),
     ]
 )
+# Images with a higher fraction of non-zero pixels, or fewer pixels in total, are faster to process
+# with the dense implementation of measure of chaos. See scripts/benchmark_measure_of_chaos.py
+CHAOS_SPARSE_MAX_DENSITY = 0.1
+CHAOS_SPARSE_MIN_PIXELS = 20000
+
+
+def _use_sparse_chaos(n_nonzero: int, n_pixels: int) -> bool:
+    return n_pixels >= CHAOS_SPARSE_MIN_PIXELS and n_nonzero < n_pixels * CHAOS_SPARSE_MAX_DENSITY
 
 
 class MetricsDict(TypedDict):
@@ -53,7 +63,19 @@ FormulaImageSet = Tuple[int, List[float], List[Optional[coo_matrix]]]
 # images isn't present for decoy ions
 FormulaMetricSet = Tuple[int, MetricsDict, Optional[List[Optional[coo_matrix]]]]
 
-ComputeMetricsFunc = Callable[[List[Optional[coo_matrix]], List[float]], MetricsDict]
+# Takes images, predicted intensities and optionally whether the formula can be pruned.
+# Returns PrunedMetrics for pruned formulas
+ComputeMetricsFunc = Callable[..., MetricsDict]
+# Takes a list of (images, predicted intensities) and optionally a list of whether each formula
+# can be pruned. Returns metrics (PrunedMetrics for pruned formulas) for each item
+ComputeMetricsBatchFunc = Callable[..., List[MetricsDict]]
+
+
+class PrunedMetrics(OrderedDict):
+    """Metrics of a formula whose spatial and chaos metrics weren't computed, because its MSM
+    can't reach `decoy_msm_floor`. They're replaced by their upper bounds, so `msm` is an upper
+    bound of the formula's MSM. Pruned decoys are still counted in FDR estimation with this MSM,
+    so FDRs at MSMs above the floor are exact, and FDRs below it can only be overestimated."""
 
 
 def replace_nan(val, default=0):
@@ -69,11 +91,52 @@ def replace_nan(val, default=0):
     return replace(val)
 
 
+def spatial_upper_bound(first_peak_pixel_ints, formula_ints, min_iso_ints) -> float:
+    """Cheap upper bound of `isotope_image_correlation`, based on which isotopic peak images
+    overlap with the first peak image.
+
+    The correlation between two non-negative images that don't overlap can't be positive, so
+    the weighted average of correlations can't exceed the total weight of overlapping peaks.
+
+    Args
+    -----
+    first_peak_pixel_ints: List[ndarray]
+        intensities of each peak image in the sample area pixels
+        where the first peak image is non-zero
+    formula_ints: List[float]
+        predicted intensities, used as weights of the correlations
+    min_iso_ints: List[float]
+        minimal intensities of each peak image
+    Returns
+    -----
+        float
+    """
+    if len(first_peak_pixel_ints) < 2 or len(first_peak_pixel_ints[0]) < 2:
+        return 0.0
+
+    weights = np.asarray(formula_ints[1:], dtype=np.float64)
+    if min(min_iso_ints) < 0 or (weights < 0).any() or weights.sum() <= 0:
+        return 1.0
+
+    overlaps = np.array([np.count_nonzero(ints) for ints in first_peak_pixel_ints[1:]])
+    return min(weights[overlaps > 0].sum() / weights.sum(), 1.0)
+
+
+def _pruned_metrics(doc, spatial_bound):
+    doc['spatial'] = spatial_bound
+    doc['chaos'] = 1.0
+    doc['msm'] = doc['spectral'] * spatial_bound
+    return PrunedMetrics((k, replace_nan(v)) for k, v in doc.items())
+
+
 def make_compute_image_metrics(
     sample_area_mask: np.ndarray, nrows: int, ncols: int, img_gen_config: DSConfigImageGeneration
 ) -> ComputeMetricsFunc:
     """Returns a function for computing formula images metrics
 
+    If `decoy_msm_floor` is set in `img_gen_config`, the function returns `PrunedMetrics` for
+    formulas marked as prunable, if their MSM can't reach the floor.
+
     Args
     -----
     sample_area_mask: ndarray[bool]
@@ -85,10 +148,13 @@ def make_compute_image_metrics(
     -----
         function
     """
+    n_levels = img_gen_config.get('n_levels', 30)
+    msm_floor = img_gen_config.get('decoy_msm_floor')
+    n_pixels = nrows * ncols
     empty_matrix = np.zeros((nrows, ncols))
     sample_area_mask_flat = sample_area_mask.flatten()
 
-    def compute_metrics(iso_images_sparse, formula_ints):
+    def compute_metrics(iso_images_sparse, formula_ints, prunable=False):
         np.seterr(invalid='ignore')  # to ignore division by zero warnings
 
         doc = METRICS.copy()
@@ -106,11 +172,26 @@ def make_compute_image_metrics(
 
             doc['spectral'] = isotope_pattern_match(iso_imgs_flat, formula_ints)
             if doc['spectral'] > 0:
+                if prunable and msm_floor is not None:
+                    first_peak_pixels = iso_imgs_flat[0] > 0
+                    first_peak_pixel_ints = [img[first_peak_pixels] for img in iso_imgs_flat]
+                    spatial_bound = spatial_upper_bound(
+                        first_peak_pixel_ints, formula_ints, doc['min_iso_ints']
+                    )
+                    if doc['spectral'] * spatial_bound < msm_floor:
+                        return _pruned_metrics(doc, spatial_bound)
 
                 doc['spatial'] = isotope_image_correlation(iso_imgs_flat, weights=formula_ints[1:])
                 if doc['spatial'] > 0:
 
-                    moc = measure_of_chaos(iso_imgs[0], img_gen_config.get('n_levels', 30))
+                    first_img = iso_images_sparse[0]
+                    if first_img is not None and _use_sparse_chaos(first_img.nnz, n_pixels):
+                        pixels, values = _sum_duplicates(
+                            first_img.row.astype(np.int64) * ncols + first_img.col, first_img.data
+                        )
+                        moc = measure_of_chaos_sparse(pixels, values, nrows, ncols, n_levels)
+                    else:
+                        moc = measure_of_chaos(iso_imgs[0], n_levels)
                     doc['chaos'] = 0 if np.isclose(moc, 1.0) else moc
                     if doc['chaos'] > 0:
 
@@ -120,6 +201,208 @@ def make_compute_image_metrics(
     return compute_metrics
 
 
+def _sum_duplicates(keys, values):
+    """Sorts entries by key and sums the values of duplicate keys in their original order,
+    so that the sums match `coo_matrix.toarray` exactly."""
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+
+    is_first = np.ones(len(keys), dtype=bool)
+    is_first[1:] = keys[1:] != keys[:-1]
+    if not is_first.all():
+        # Sum duplicates one "layer" at a time, to match the summation order of coo_todense
+        group_i = np.cumsum(is_first) - 1
+        rank = np.arange(len(keys)) - np.flatnonzero(is_first)[group_i]
+        summed = values[is_first]
+        for dup_rank in range(1, rank.max() + 1):
+            dup_mask = rank == dup_rank
+            summed[group_i[dup_mask]] += values[dup_mask]
+        keys, values = keys[is_first], summed
+
+    return keys, values
+
+
+def _stack_images(image_sets, n_peaks, n_pixels, ncols):
+    """Stacks all images of a batch into a single sparse matrix of shape
+    (len(image_sets) * n_peaks, n_pixels) in coordinate form.
+
+    Returns (rows, pixels, values, is_present). Entries are sorted by row and pixel. Duplicate
+    entries are summed in their original order, so that values match `coo_matrix.toarray` exactly.
+    `is_present` marks the rows that had a (possibly empty) image instead of None.
+    """
+    is_present = np.zeros(len(image_sets) * n_peaks, dtype=bool)
+    row_ids, imgs = [], []
+    for set_i, (f_images, _) in enumerate(image_sets):
+        for peak_i, img in enumerate(f_images):
+            if img is not None:
+                is_present[set_i * n_peaks + peak_i] = True
+                if img.nnz > 0:
+                    row_ids.append(set_i * n_peaks + peak_i)
+                    imgs.append(img)
+
+    if not imgs:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), is_present
+
+    rows = np.repeat(np.array(row_ids, dtype=np.int64), [img.nnz for img in imgs])
+    pixels = np.concatenate([img.row.astype(np.int64) * ncols + img.col for img in imgs])
+    values = np.concatenate([img.data for img in imgs])
+
+    keys, values = _sum_duplicates(rows * n_pixels + pixels, values)
+    return keys // n_pixels, keys % n_pixels, values, is_present
+
+
+def make_compute_image_metrics_batch(
+    sample_area_mask: np.ndarray, nrows: int, ncols: int, img_gen_config: DSConfigImageGeneration
+) -> ComputeMetricsBatchFunc:
+    """Returns a function for computing the metrics of many formulas at once.
+
+    Gives identical results to the function returned by `make_compute_image_metrics`, except for
+    `total_iso_ints`, which are accumulated in double precision instead of the image's dtype.
+    Instead of densifying every image, all images of a batch are stacked into one sparse matrix.
+    Intensity statistics are computed directly on it, the spectral score only needs the
+    pixels of the first peak's image, and dense sample-area images are only built for formulas
+    that pass the spectral check. Formulas are pruned the same way as in
+    `make_compute_image_metrics`.
+
+    Args
+    -----
+    sample_area_mask: ndarray[bool]
+        mask for separating sampled pixels (True) from non-sampled (False)
+
+    img_gen_config : dict
+        isotope_generation section of the dataset config
+    Returns
+    -----
+        function
+    """
+    n_levels = img_gen_config.get('n_levels', 30)
+    msm_floor = img_gen_config.get('decoy_msm_floor')
+    n_pixels = nrows * ncols
+    sample_area_mask_flat = sample_area_mask.flatten()
+    n_sample_pixels = np.count_nonzero(sample_area_mask_flat)
+    # Index of each pixel in the flattened sample area, -1 for pixels outside the sample area
+    sample_pixel_idxs = np.full(n_pixels, -1, dtype=np.int64)
+    sample_pixel_idxs[sample_area_mask_flat] = np.arange(n_sample_pixels)
+
+    def spectral_images(rows, pixels, values, is_present, n_sets, n_peaks):
+        """For each formula, gathers the pixels where the first peak's image is non-zero, which
+        are the only pixels used by isotope_pattern_match."""
+        is_first_peak = (rows % n_peaks == 0) & (values > 0) & (sample_pixel_idxs[pixels] >= 0)
+        first_sets, first_pixels = rows[is_first_peak] // n_peaks, pixels[is_first_peak]
+        set_bounds = np.searchsorted(first_sets, np.arange(n_sets + 1))
+
+        keys = rows * n_pixels + pixels
+        peak_values = []
+        for peak_i in range(n_peaks):
+            query = (first_sets * n_peaks + peak_i) * n_pixels + first_pixels
+            idxs = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+            found = keys[idxs] == query if len(keys) else np.zeros(len(query), dtype=bool)
+            peak_vals = np.zeros(len(query), dtype=values.dtype)
+            peak_vals[found] = values[idxs[found]]
+            peak_values.append(peak_vals)
+
+        for set_i in range(n_sets):
+            start, end = set_bounds[set_i], set_bounds[set_i + 1]
+            yield [
+                peak_values[peak_i][start:end]
+                if is_present[set_i * n_peaks + peak_i]
+                else np.zeros(end - start)
+                for peak_i in range(n_peaks)
+            ]
+
+    def compute_metrics_batch(image_sets, prunable=None):
+        np.seterr(invalid='ignore')  # to ignore division by zero warnings
+
+        n_sets = len(image_sets)
+        n_peaks = max((len(f_images) for f_images, _ in image_sets), default=0)
+        rows, pixels, values, is_present = _stack_images(image_sets, n_peaks, n_pixels, ncols)
+        row_bounds = np.searchsorted(rows, np.arange(n_sets * n_peaks + 1))
+        row_nnz = np.diff(row_bounds)
+
+        row_totals = np.bincount(rows, weights=values, minlength=n_sets * n_peaks)
+        row_mins = np.zeros(n_sets * n_peaks, dtype=values.dtype)
+        row_maxs = np.zeros(n_sets * n_peaks, dtype=values.dtype)
+        non_empty_rows = np.flatnonzero(row_nnz)
+        if len(non_empty_rows):
+            row_mins[non_empty_rows] = np.minimum.reduceat(values, row_bounds[non_empty_rows])
+            row_maxs[non_empty_rows] = np.maximum.reduceat(values, row_bounds[non_empty_rows])
+        # Images that don't cover every pixel contain zeros when densified
+        not_full = row_nnz < n_pixels
+        row_mins[not_full] = np.minimum(row_mins[not_full], 0)
+        row_maxs[not_full] = np.maximum(row_maxs[not_full], 0)
+
+        # Reusable buffers for densified images. Only pixels that were set get cleared afterwards
+        sample_imgs_buf = np.zeros((n_peaks, n_sample_pixels), dtype=values.dtype)
+        empty_sample_img = np.zeros(n_sample_pixels)
+        first_img_buf = np.zeros(n_pixels, dtype=values.dtype)
+
+        spectral_imgs_it = spectral_images(rows, pixels, values, is_present, n_sets, n_peaks)
+        prunable = prunable if msm_floor is not None else None
+        metrics_list: List[MetricsDict] = []
+        for set_i, ((iso_images_sparse, formula_ints), spectral_imgs) in enumerate(
+            zip(image_sets, spectral_imgs_it)
+        ):
+            doc = METRICS.copy()
+            if iso_images_sparse:
+                set_rows = slice(set_i * n_peaks, set_i * n_peaks + len(iso_images_sparse))
+                doc['total_iso_ints'] = list(row_totals[set_rows])
+                doc['min_iso_ints'] = list(row_mins[set_rows])
+                doc['max_iso_ints'] = list(row_maxs[set_rows])
+
+                doc['spectral'] = isotope_pattern_match(
+                    spectral_imgs[: len(formula_ints)], formula_ints
+                )
+                if doc['spectral'] > 0 and prunable and prunable[set_i]:
+                    spatial_bound = spatial_upper_bound(
+                        spectral_imgs[: len(formula_ints)], formula_ints, doc['min_iso_ints']
+                    )
+                    if doc['spectral'] * spatial_bound < msm_floor:
+                        metrics_list.append(_pruned_metrics(doc, spatial_bound))
+                        continue
+
+                if doc['spectral'] > 0:
+                    iso_imgs_flat, set_pixels = [], []
+                    for peak_i in range(len(formula_ints)):
+                        row_i = set_i * n_peaks + peak_i
+                        if is_present[row_i]:
+                            start, end = row_bounds[row_i], row_bounds[row_i + 1]
+                            sample_idxs = sample_pixel_idxs[pixels[start:end]]
+                            in_sample = sample_idxs >= 0
+                            sample_idxs = sample_idxs[in_sample]
+                            sample_imgs_buf[peak_i, sample_idxs] = values[start:end][in_sample]
+                            set_pixels.append((peak_i, sample_idxs))
+                            iso_imgs_flat.append(sample_imgs_buf[peak_i])
+                        else:
+                            iso_imgs_flat.append(empty_sample_img)
+
+                    doc['spatial'] = isotope_image_correlation(
+                        iso_imgs_flat, weights=formula_ints[1:]
+                    )
+                    if doc['spatial'] > 0:
+                        start, end = row_bounds[set_i * n_peaks], row_bounds[set_i * n_peaks + 1]
+                        if _use_sparse_chaos(end - start, n_pixels):
+                            moc = measure_of_chaos_sparse(
+                                pixels[start:end], values[start:end], nrows, ncols, n_levels
+                            )
+                        else:
+                            first_img_buf[pixels[start:end]] = values[start:end]
+                            moc = measure_of_chaos(first_img_buf.reshape(nrows, ncols), n_levels)
+                            first_img_buf[pixels[start:end]] = 0
+                        doc['chaos'] = 0 if np.isclose(moc, 1.0) else moc
+                        if doc['chaos'] > 0:
+
+                            doc['msm'] = doc['chaos'] * doc['spatial'] * doc['spectral']
+
+                    for peak_i, sample_idxs in set_pixels:
+                        sample_imgs_buf[peak_i, sample_idxs] = 0
+            metrics_list.append(OrderedDict((k, replace_nan(v)) for k, v in doc.items()))
+
+        return metrics_list
+
+    return compute_metrics_batch
+
+
 def iter_images_in_sets(
     formula_images_it: Iterable[FormulaImageItem], n_peaks: int
 ) -> Iterator[FormulaImageSet]:
@@ -168,12 +451,21 @@ def nullify_images_with_too_few_pixels(f_images, min_px):
     return [img if (img is not None and img.nnz >= min_px) else None for img in f_images]
 
 
+def _iter_complete_image_sets(formula_image_set_it, targeted_database_formula_inds, min_px):
+    for f_i, f_ints, f_images in formula_image_set_it:
+        f_images = nullify_images_with_too_few_pixels(f_images, min_px)
+        is_targeted = f_i in targeted_database_formula_inds
+        if complete_image_list(f_images, require_first=not is_targeted):
+            yield f_i, f_ints, f_images, is_targeted
+
+
 def compute_and_filter_metrics(
     formula_image_set_it: Iterable[FormulaImageSet],
     compute_metrics: Callable,
     target_formula_inds: Set[int],
     targeted_database_formula_inds: Set[int],
     min_px: int,
+    metrics_stats: Optional[Counter] = None,
 ) -> Iterator[FormulaMetricSet]:
     """Compute isotope image metrics for each formula.
 
@@ -185,18 +477,61 @@ def compute_and_filter_metrics(
         targeted_database_formula_inds: Indices of ion formulas
             that correspond to targeted databases.
         min_px: Minimum number of pixels each image should have.
+        metrics_stats: If provided, the number of decoy formulas that were pruned
+            by the metrics function is added to its 'skipped' key.
     """
-    for f_i, f_ints, f_images in formula_image_set_it:
-        f_images = nullify_images_with_too_few_pixels(f_images, min_px)
-        is_targeted = f_i in targeted_database_formula_inds
-        if complete_image_list(f_images, require_first=not is_targeted):
-            f_metrics = compute_metrics(f_images, f_ints)
+    for f_i, f_ints, f_images, is_targeted in _iter_complete_image_sets(
+        formula_image_set_it, targeted_database_formula_inds, min_px
+    ):
+        f_metrics = compute_metrics(f_images, f_ints, f_i not in target_formula_inds)
+        if isinstance(f_metrics, PrunedMetrics) and metrics_stats is not None:
+            metrics_stats['skipped'] += 1
+        if f_metrics['msm'] > 0 or is_targeted:
+            if f_i in target_formula_inds:
+                yield f_i, f_metrics, f_images
+            else:
+                yield f_i, f_metrics, None
+
+
+def compute_and_filter_metrics_batch(
+    formula_image_set_it: Iterable[FormulaImageSet],
+    compute_metrics_batch: ComputeMetricsBatchFunc,
+    target_formula_inds: Set[int],
+    targeted_database_formula_inds: Set[int],
+    min_px: int,
+    batch_size: int,
+    metrics_stats: Optional[Counter] = None,
+) -> Iterator[FormulaMetricSet]:
+    """Same as `compute_and_filter_metrics`, but computes the metrics of up to `batch_size`
+    formulas at a time with a function from `make_compute_image_metrics_batch`.
+    """
+
+    def process_batch(batch):
+        metrics_list = compute_metrics_batch(
+            [(f_images, f_ints) for _, f_ints, f_images, _ in batch],
+            [f_i not in target_formula_inds for f_i, _, _, _ in batch],
+        )
+        for (f_i, _, f_images, is_targeted), f_metrics in zip(batch, metrics_list):
+            if isinstance(f_metrics, PrunedMetrics) and metrics_stats is not None:
+                metrics_stats['skipped'] += 1
             if f_metrics['msm'] > 0 or is_targeted:
                 if f_i in target_formula_inds:
                     yield f_i, f_metrics, f_images
                 else:
                     yield f_i, f_metrics, None
 
+    batch = []
+    for image_set in _iter_complete_image_sets(
+        formula_image_set_it, targeted_database_formula_inds, min_px
+    ):
+        batch.append(image_set)
+        if len(batch) >= batch_size:
+            yield from process_batch(batch)
+            batch = []
+
+    if batch:
+        yield from process_batch(batch)
+
 
 def collect_metrics_as_df(
     metrics_it: Iterable[FormulaMetricSet],
@@ -221,19 +556,36 @@ def collect_metrics_as_df(
 
 def formula_image_metrics(
     formula_images_it: Iterable[FormulaImageItem],
-    compute_metrics: ComputeMetricsFunc,
+    compute_metrics: Union[ComputeMetricsFunc, ComputeMetricsBatchFunc],
     target_formula_inds: Set[int],
     targeted_database_formula_inds: Set[int],
     n_peaks: int,
     min_px: int,
+    metrics_batch_size: Optional[int] = None,
+    metrics_stats: Optional[Counter] = None,
 ) -> Tuple[pd.DataFrame, Dict]:
+    """If `metrics_batch_size` is set, `compute_metrics` must be a batch metrics function
+    from `make_compute_image_metrics_batch`. See `compute_and_filter_metrics` for `metrics_stats`.
+    """
     formula_image_set_it = iter_images_in_sets(formula_images_it, n_peaks)
-    metrics_it = compute_and_filter_metrics(
-        formula_image_set_it,
-        compute_metrics,
-        target_formula_inds,
-        targeted_database_formula_inds,
-        min_px,
-    )
+    if metrics_batch_size:
+        metrics_it = compute_and_filter_metrics_batch(
+            formula_image_set_it,
+            compute_metrics,
+            target_formula_inds,
+            targeted_database_formula_inds,
+            min_px,
+            metrics_batch_size,
+            metrics_stats,
+        )
+    else:
+        metrics_it = compute_and_filter_metrics(
+            formula_image_set_it,
+            compute_metrics,
+            target_formula_inds,
+            targeted_database_formula_inds,
+            min_px,
+            metrics_stats,
+        )
     formula_metrics_df, formula_images = collect_metrics_as_df(metrics_it)
     return formula_metrics_df, formula_images
@@ -1,8 +1,9 @@
 from __future__ import annotations
+from copy import copy
 from pathlib import Path
 from threading import Lock
 from traceback import format_exc
-from typing import TYPE_CHECKING, Sequence
+from typing import TYPE_CHECKING, Optional, Sequence
 
 import numpy as np
 from pyimzml.ImzMLParser import ImzMLParser
@@ -85,6 +86,13 @@ class ImzMLReader:
         image[~self.mask] = np.nan
         return image
 
+    @property
+    def has_spectra_stats(self):
+        """Whether the TICs and mz range of all spectra are known, either from the metadata or
+        because all spectra have been read"""
+        has_tics = self.is_tic_from_metadata or not np.isnan(self._sp_tic).any()
+        return has_tics and (self.is_mz_from_metadata or bool(np.isfinite(self.min_mz)))
+
     def tic_image(self):
         if not self.is_tic_from_metadata:
             assert (~np.isnan(self._sp_tic)).all(), 'Read all spectra before calling tic_image'
@@ -108,6 +116,17 @@ class ImzMLReader:
 
         return idx, mzs, ints
 
+    def get_spectra_stats(self, sp_idxs):
+        """Returns the per-spectrum data gathered while reading the given spectra, so that a copy
+        of this reader in another process can pass it to `update_spectra_stats`"""
+        return self._sp_tic[sp_idxs], self.min_mz, self.max_mz
+
+    def update_spectra_stats(self, sp_idxs, spectra_stats):
+        sp_tic, min_mz, max_mz = spectra_stats
+        self._sp_tic[sp_idxs] = sp_tic
+        self.min_mz = min(self.min_mz, min_mz)
+        self.max_mz = max(self.max_mz, max_mz)
+
     # iter_spectra method has an intentionally implementation-dependent signature,
     # as the Lithops implementation needs an external reference to Storage to remain pickleable
 
@@ -126,6 +145,13 @@ class FSImzMLReader(ImzMLReader):
 
         super().__init__(self._imzml_parser)
 
+    def reopen(self):
+        """Reopens the .ibd file. Forked processes must call this before reading spectra,
+        as they would otherwise share the file position with the parent process"""
+        ibd_path = self._imzml_parser.m.name
+        self._imzml_parser.m.close()
+        self._imzml_parser.m = open(ibd_path, 'rb')
+
     def iter_spectra(self, sp_idxs: Sequence[int]):
         for sp_idx in sp_idxs:
             mzs, ints = self._imzml_parser.getspectrum(sp_idx)
@@ -133,6 +159,85 @@ class FSImzMLReader(ImzMLReader):
             yield sp_idx, mzs, ints
 
 
+class MmapImzMLReader(FSImzMLReader):
+    """Reads spectra from a local .ibd file that is memory-mapped once, instead of seeking and
+    reading each spectrum separately. Spectra are returned as views into the mapped file,
+    and `read_spectra_block` copies many spectra directly into preallocated concatenated arrays.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        parser = self._imzml_parser
+        self._mz_offsets = np.array(parser.mzOffsets, dtype=np.int64)
+        self._mz_lengths = np.array(parser.mzLengths, dtype=np.int64)
+        self._int_offsets = np.array(parser.intensityOffsets, dtype=np.int64)
+        self._int_lengths = np.array(parser.intensityLengths, dtype=np.int64)
+        self._int_precision = parser.intensityPrecision
+        # np.memmap can't map empty files
+        ibd_path = parser.m.name
+        self._ibd = (
+            np.memmap(ibd_path, dtype=np.uint8, mode='r') if Path(ibd_path).stat().st_size else b''
+        )
+
+    def _spectrum_views(self, sp_idx):
+        mzs = np.frombuffer(
+            self._ibd,
+            dtype=self.mz_precision,
+            count=self._mz_lengths[sp_idx],
+            offset=self._mz_offsets[sp_idx],
+        )
+        ints = np.frombuffer(
+            self._ibd,
+            dtype=self._int_precision,
+            count=self._int_lengths[sp_idx],
+            offset=self._int_offsets[sp_idx],
+        )
+        return mzs, ints
+
+    def iter_spectra(self, sp_idxs: Sequence[int]):
+        for sp_idx in sp_idxs:
+            mzs, ints = self._spectrum_views(sp_idx)
+            sp_idx, mzs, ints = self._process_spectrum(sp_idx, mzs, ints)
+            yield sp_idx, mzs, ints
+
+    def read_spectra_block(self, sp_idxs: Sequence[int]):
+        """Reads many spectra into concatenated arrays, equivalent to concatenating the output
+        of `iter_spectra`, but without allocating separate arrays for each spectrum.
+
+        Returns
+        -----
+            (sp_idxs, mzs, ints) arrays with one item per peak, where sp_idxs holds
+            the spectrum index of each peak
+        """
+        sp_idxs = np.asarray(sp_idxs, dtype=np.int64)
+        lengths = self._mz_lengths[sp_idxs]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        mzs = np.empty(ends[-1] if len(ends) else 0, dtype=self.mz_precision)
+        ints = np.empty(len(mzs), dtype=self._int_precision)
+        for sp_idx, start, end in zip(sp_idxs, starts, ends):
+            mzs[start:end], ints[start:end] = self._spectrum_views(sp_idx)
+        # Position of each peak's spectrum in sp_idxs
+        peak_block_idxs = np.repeat(np.arange(len(sp_idxs)), lengths)
+
+        # Same as _process_spectrum, but for all spectra at once
+        nonzero_ints_mask = ints > 0
+        if not np.all(nonzero_ints_mask):
+            peak_block_idxs = peak_block_idxs[nonzero_ints_mask]
+            mzs, ints = mzs[nonzero_ints_mask], ints[nonzero_ints_mask]
+
+        if not self.is_tic_from_metadata:
+            self._sp_tic[sp_idxs] = np.bincount(
+                peak_block_idxs, weights=ints, minlength=len(sp_idxs)
+            )
+
+        if len(mzs) and not self.is_mz_from_metadata:
+            self.min_mz = min(self.min_mz, np.min(mzs))
+            self.max_mz = max(self.max_mz, np.max(mzs))
+
+        return sp_idxs[peak_block_idxs], mzs, ints
+
+
 class LithopsImzMLReader(ImzMLReader):
     def __init__(self, storage: Storage, imzml_cobject: CloudObject, ibd_cobject: CloudObject):
         imzml_parser = ImzMLParser(
@@ -147,9 +252,28 @@ class LithopsImzMLReader(ImzMLReader):
 
         super().__init__(imzml_parser)
 
-    def iter_spectra(self, storage: Storage, sp_inds: Sequence[int]):
+    @property
+    def ibd_cobject(self) -> CloudObject:
+        return self._ibd_cobject
+
+    def with_ibd_cobject(self, ibd_cobject: Optional[CloudObject]) -> LithopsImzMLReader:
+        """A copy of this reader that reads spectra from another copy of the same .ibd file"""
+        reader = copy(self)
+        reader._ibd_cobject = ibd_cobject  # pylint: disable=protected-access
+        return reader
+
+    def iter_spectra(self, storage: Storage, sp_inds: Sequence[int], range_reader=None):
+        """
+        Args
+        -----
+        range_reader: Optional[CObjRangeReader] for the .ibd file. Pass the same reader to
+            subsequent calls to reuse its tuned concurrency and accumulate its stats
+        """
         # pylint: disable=import-outside-toplevel # avoid pulling Lithops into Spark pipeline
-        from sm.engine.annotation_lithops.io import get_ranges_from_cobject
+        from sm.engine.annotation_lithops.io import CObjRangeReader
+
+        if range_reader is None:
+            range_reader = CObjRangeReader(storage, self._ibd_cobject)
 
         mz_starts = np.array(self.imzml_reader.mzOffsets)[sp_inds]
         mz_ends = (
@@ -165,7 +289,7 @@ class LithopsImzMLReader(ImzMLReader):
         )
         int_ranges = np.stack([int_starts, int_ends], axis=1)
         ranges_to_read = np.vstack([mz_ranges, int_ranges])
-        data_ranges = get_ranges_from_cobject(storage, self._ibd_cobject, ranges_to_read)
+        data_ranges = range_reader.read(ranges_to_read)
         mz_data = data_ranges[: len(sp_inds)]
         int_data = data_ranges[len(sp_inds) :]
         del data_ranges
@@ -1,12 +1,13 @@
 import logging
-from collections import defaultdict
-from typing import Dict, Optional
+from typing import Optional
 
 import numpy as np
 import cpyMSpec as cpyMSpec_0_4_2
 import cpyMSpec_0_3_5
 from pyMSpec.pyisocalc import pyisocalc
 
+from sm.engine.annotation import centroids_cache
+from sm.engine.annotation.centroids_cache import CentroidsCache
 from sm.engine.ds_config import DSConfig
 
 assert cpyMSpec_0_4_2.utils.VERSION == '0.4.2'
@@ -24,18 +25,21 @@ class IsocalcWrapper:
     centroids and profiles for a sum formula.
     """
 
-    _all_centroids_caches: Optional[Dict] = None
+    use_centroids_cache = True
 
     @classmethod
     def set_centroids_cache_enabled(cls, enabled):
-        """Turns on/off the centroids cache. This cache can become a massive memory leak
-        if permanently left active. It should only be used for batch processing jobs"""
-        if enabled and not cls._all_centroids_caches:
-            cls._all_centroids_caches = defaultdict(dict)
-        else:
-            cls._all_centroids_caches = None
-
-    def __init__(self, ds_config: DSConfig):
+        """Turns on/off the centroids cache for IsocalcWrappers that weren't created with
+        an explicit `use_centroids_cache`. If no cache was configured with `centroids_cache.init`,
+        a bounded in-memory cache is used. Disabling doesn't close the shared cache,
+        as other callers in the same process may still be using it"""
+        cls.use_centroids_cache = enabled
+        if enabled and centroids_cache.get_instance() is None:
+            centroids_cache.set_instance(CentroidsCache())
+
+    def __init__(self, ds_config: DSConfig, use_centroids_cache: Optional[bool] = None):
+        if use_centroids_cache is not None:
+            self.use_centroids_cache = use_centroids_cache
         self.analysis_version = ds_config.get('analysis_version', 1)
 
         isocalc_config = ds_config['isotope_generation']
@@ -45,12 +49,6 @@ class IsocalcWrapper:
         self.n_peaks = isocalc_config['n_peaks']
 
         self.ppm = ds_config['image_generation']['ppm']
-        centroids_cache_key = (self.charge, self.sigma, self.n_peaks, self.analysis_version)
-        if self._all_centroids_caches:
-            # pylint: disable=unsubscriptable-object
-            self._centroids_cache = self._all_centroids_caches[centroids_cache_key]
-        else:
-            self._centroids_cache = None
 
     @staticmethod
     def _trim(mzs, ints, k):
@@ -113,13 +111,17 @@ class IsocalcWrapper:
             return None, None
 
     def centroids(self, formula):
-        if self._centroids_cache is not None:
-            result = self._centroids_cache.get(formula)
-            if not result:
-                result = self._centroids_uncached(formula)
-                # pylint: disable=unsupported-assignment-operation
-                self._centroids_cache[formula] = result
-            return result
+        cache = centroids_cache.get_instance() if self.use_centroids_cache else None
+        if cache is not None:
+            key = (
+                formula,
+                self.charge,
+                self.sigma,
+                self.n_peaks,
+                self.instrument,
+                self.analysis_version,
+            )
+            return cache.get_or_compute(key, lambda: self._centroids_uncached(formula))
 
         return self._centroids_uncached(formula)
 
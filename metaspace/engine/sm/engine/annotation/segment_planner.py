@@ -0,0 +1,163 @@
+"""Planning of dataset segment bounds, shared by the Spark and Lithops pipelines.
+
+Every centroid segment reads all dataset segments that overlap the mz range of its centroids,
+widened by the mass accuracy window. Dataset segments that only partially overlap that range are
+read in full, so segment bounds are chosen to minimize the total amount of data read by all
+centroid segments, while keeping each dataset segment small enough to be processed in memory.
+"""
+import logging
+from typing import NamedTuple
+
+import numpy as np
+
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+
+logger = logging.getLogger('engine')
+
+# Cost of reading each dataset segment in addition to its data, e.g. for request latency
+DEFAULT_SEGM_OVERHEAD_MB = 1
+MAX_CUT_CANDIDATES = 2000
+
+
+class DSSegmentPlan(NamedTuple):
+    bounds: np.ndarray
+    """(n, 2) array of segment [lower, upper) mz bounds. Each upper bound equals the next
+    segment's lower bound"""
+    est_read_amplification: float
+    """Estimated total data read by centroid segments divided by the data they actually need"""
+
+
+def centr_segments_mz_bounds(
+    first_peak_mzs: np.ndarray,
+    min_mzs: np.ndarray,
+    max_mzs: np.ndarray,
+    centr_segm_n: int,
+    isocalc_wrapper: IsocalcWrapper,
+) -> np.ndarray:
+    """Estimates the mz ranges that centroid segments will read, assuming that formulas are split
+    into `centr_segm_n` segments by quantiles of their first peak mz, as both pipelines do.
+
+    Args
+    -----
+    first_peak_mzs, min_mzs, max_mzs: per-formula first peak, lowest and highest centroid mz
+    Returns
+    -----
+        (n, 2) array of the lower and upper mz that each centroid segment reads
+    """
+    if len(first_peak_mzs) == 0:
+        return np.zeros((0, 2))
+    segm_lower_bounds = np.quantile(first_peak_mzs, np.arange(centr_segm_n) / centr_segm_n)
+    segm_idxs = np.searchsorted(segm_lower_bounds, first_peak_mzs, side='right') - 1
+    segm_min_mzs = np.full(centr_segm_n, np.inf)
+    segm_max_mzs = np.full(centr_segm_n, -np.inf)
+    np.minimum.at(segm_min_mzs, segm_idxs, min_mzs)
+    np.maximum.at(segm_max_mzs, segm_idxs, max_mzs)
+
+    non_empty = np.isfinite(segm_min_mzs)
+    lower, _ = isocalc_wrapper.mass_accuracy_bounds(segm_min_mzs[non_empty])
+    _, upper = isocalc_wrapper.mass_accuracy_bounds(segm_max_mzs[non_empty])
+    return np.column_stack([lower, upper])
+
+
+def _cut_candidates(mzs, centr_segm_bounds, max_candidates):
+    """Candidate segment bounds: quantiles of the peak mzs, so that dense regions can be split
+    finely, and centroid segment range ends, so that bounds can be aligned with them"""
+    peak_cuts = mzs[np.linspace(0, len(mzs) - 1, max_candidates).astype(np.int64)]
+    range_ends = np.sort(centr_segm_bounds.ravel())
+    if len(range_ends) > max_candidates:
+        range_ends = range_ends[np.linspace(0, len(range_ends) - 1, max_candidates).astype(int)]
+    cuts = np.unique(np.concatenate([peak_cuts, range_ends]))
+    return cuts[(cuts > mzs[0]) & (cuts <= mzs[-1])]
+
+
+def _n_overlapping(segm_lower, segm_upper, sorted_lowers, sorted_uppers):
+    """Number of [lower, upper] ranges that overlap [segm_lower, segm_upper)"""
+    n_before = np.searchsorted(sorted_uppers, segm_lower, side='left')
+    n_after = len(sorted_lowers) - np.searchsorted(sorted_lowers, segm_upper, side='left')
+    return len(sorted_lowers) - n_before - n_after
+
+
+def estimate_read_amplification(
+    segm_bounds: np.ndarray, mzs: np.ndarray, centr_segm_bounds: np.ndarray
+) -> float:
+    """Total number of rows read by centroid segments, divided by the number of rows within their
+    mz ranges. `mzs` must be sorted and may be a uniform sample of the dataset's peaks."""
+    segm_rows = np.diff(np.searchsorted(mzs, np.append(segm_bounds[:, 0], np.inf), side='left'))
+    lowers, uppers = centr_segm_bounds[:, 0], centr_segm_bounds[:, 1]
+    overlaps = (segm_bounds[:, 0] <= uppers[:, None]) & (lowers[:, None] < segm_bounds[:, 1])
+    # The first and last segments also contain all mzs outside of the planned range
+    overlaps[:, 0] |= lowers < segm_bounds[0, 0]
+    overlaps[:, -1] |= uppers >= segm_bounds[-1, 1]
+    rows_read = (overlaps * segm_rows).sum()
+    rows_needed = np.sum(
+        np.searchsorted(mzs, uppers, side='right') - np.searchsorted(mzs, lowers, side='left')
+    )
+    return float(rows_read / rows_needed) if rows_needed else 1.0
+
+
+def plan_ds_segments(
+    mzs: np.ndarray,
+    centr_segm_bounds: np.ndarray,
+    row_size: int,
+    max_segm_size_mb: float,
+    mz_sample_ratio: float = 1.0,
+    segm_overhead_mb: float = DEFAULT_SEGM_OVERHEAD_MB,
+    max_candidates: int = MAX_CUT_CANDIDATES,
+) -> DSSegmentPlan:
+    """Chooses dataset segment bounds that minimize the total bytes read by centroid segments.
+
+    Accounts for peak density through `mzs`, and for the centroid mz distribution and mass
+    accuracy window through `centr_segm_bounds`. A segment costs its size plus
+    `segm_overhead_mb` for every centroid segment that reads it, and once more for writing it.
+    The optimal bounds among the candidates are found by dynamic programming over
+    candidates sorted by mz, with segments limited to `max_segm_size_mb`.
+
+    Args
+    -----
+    mzs: sorted peak mzs of the dataset, or a uniform sample of them
+    centr_segm_bounds: (n, 2) array of mz ranges that centroid segments read,
+        e.g. from `centr_segments_mz_bounds`
+    row_size: bytes per dataset peak
+    mz_sample_ratio: fraction of the dataset's peaks included in `mzs`
+    """
+    assert len(mzs) > 0, 'Cannot plan segments of an empty dataset'
+    cuts = np.concatenate(
+        [[mzs[0]], _cut_candidates(mzs, centr_segm_bounds, max_candidates), [np.inf]]
+    )
+    cut_bytes = np.searchsorted(mzs, cuts, side='left') * (row_size / mz_sample_ratio)
+    sorted_lowers = np.sort(centr_segm_bounds[:, 0])
+    sorted_uppers = np.sort(centr_segm_bounds[:, 1])
+    # Ranges outside of the planned mz range are read from the first or last segment
+    cut_lowers = cuts.copy()
+    cut_lowers[0] = -np.inf
+    n_before = np.searchsorted(sorted_uppers, cut_lowers, side='left')
+    n_after = len(sorted_lowers) - np.searchsorted(sorted_lowers, cuts, side='left')
+
+    max_segm_bytes = max_segm_size_mb * 2 ** 20
+    overhead_bytes = segm_overhead_mb * 2 ** 20
+    best_cost = np.zeros(len(cuts))
+    best_start = np.zeros(len(cuts), dtype=np.int64)
+    for end in range(1, len(cuts)):
+        # A single candidate interval is always allowed, as it can't be split further
+        first_start = min(
+            np.searchsorted(cut_bytes, cut_bytes[end] - max_segm_bytes, side='left'), end - 1
+        )
+        starts = np.arange(first_start, end)
+        n_reads = len(sorted_lowers) - n_before[starts] - n_after[end] + 1
+        costs = best_cost[starts] + (cut_bytes[end] - cut_bytes[starts] + overhead_bytes) * n_reads
+        best_i = np.argmin(costs)
+        best_cost[end], best_start[end] = costs[best_i], starts[best_i]
+
+    segm_cut_idxs = [len(cuts) - 1]
+    while segm_cut_idxs[-1] > 0:
+        segm_cut_idxs.append(best_start[segm_cut_idxs[-1]])
+    segm_cuts = cuts[segm_cut_idxs[::-1]]
+    segm_cuts[-1] = mzs[-1]
+    bounds = np.column_stack([segm_cuts[:-1], segm_cuts[1:]])
+
+    est_read_amplification = estimate_read_amplification(bounds, mzs, centr_segm_bounds)
+    logger.info(
+        f'Planned {len(bounds)} dataset segments with estimated read amplification '
+        f'{est_read_amplification:.2f}'
+    )
+    return DSSegmentPlan(bounds, est_read_amplification)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import logging
+from collections import Counter
 from typing import List, Dict, Tuple, Optional
 
 import numpy as np
@@ -10,13 +11,16 @@ from scipy.sparse import coo_matrix
 
 from sm.engine.annotation.formula_validator import (
     compute_and_filter_metrics,
+    compute_and_filter_metrics_batch,
     make_compute_image_metrics,
+    make_compute_image_metrics_batch,
     MetricsDict,
     METRICS,
 )
 from sm.engine.annotation.imzml_reader import LithopsImzMLReader
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import save_cobj, load_cobj, CObj, load_cobjs
+from sm.engine.annotation_lithops.image_chunks import serialize_image_chunk
+from sm.engine.annotation_lithops.io import load_cobj, CObj, load_cobjs
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine.utils.perf_profile import Profiler
@@ -29,7 +33,7 @@ class ImagesManager:
     """
     Collects ion images (in sparse coo_matrix format) and formula metrics.
     Images are progressively saved to COS in chunks specified by `max_formula_images_size` to
-    prevent using too much memory.
+    prevent using too much memory. Chunks are saved in the compact format from `image_chunks`.
     """
 
     chunk_size = 100 * 1024 ** 2  # 100MB
@@ -67,8 +71,16 @@ class ImagesManager:
     def _flush_images(self):
         if self._images_buffer:
             print(f'Saving {len(self._images_buffer)} images')
-            cobj_data = dict((f_i, f_images) for f_i, size, f_images in self._images_buffer)
-            cloud_obj = save_cobj(self._storage, cobj_data)
+            chunk_images = dict((f_i, f_images) for f_i, size, f_images in self._images_buffer)
+            nrows, ncols = next(
+                img.shape
+                for _, _, f_images in self._images_buffer
+                for img in f_images
+                if img is not None
+            )
+            cloud_obj = self._storage.put_cloudobject(
+                serialize_image_chunk(chunk_images, nrows, ncols)
+            )
             images_df = pd.DataFrame(
                 {
                     'formula_i': [f_i for f_i, n_pixels, f_images in self._images_buffer],
@@ -102,44 +114,46 @@ class ImagesManager:
 
 
 def gen_iso_image_sets(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, isocalc_wrapper, n_peaks):
+    """Yields (formula index, centroid intensities, images) for each formula in `centr_df`.
+    Intensities and images are ordered by peak and padded with zeros/None up to `n_peaks`.
+    Spectra data must be sorted by mz ascending.
+
+    Slice indexes, pixel coordinates and formula boundaries are computed for all centroids at once,
+    so the per-formula work is limited to slicing the spectra arrays into images.
+    """
     # pylint: disable=too-many-locals
-    # assume sp data is sorted by mz order ascending
-
-    def yield_buffer(buffer):
-        while len(buffer) < n_peaks:
-            buffer.append((buffer[0][0], len(buffer) - 1, 0, None))
-        buffer = np.array(buffer)
-        buffer = buffer[buffer[:, 1].argsort()]  # sort order by peak ascending
-        buffer = pd.DataFrame(buffer, columns=['formula_i', 'peak_i', 'centr_ints', 'image'])
-        buffer.sort_values('peak_i', inplace=True)
-        return buffer.formula_i[0], buffer.centr_ints, buffer.image
-
-    if len(sp_inds) > 0:
-        centr_df = centr_df.sort_values(['formula_i', 'peak_i'])
-        lower_mz, upper_mz = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.values)
-        centr_df = centr_df.assign(
-            lower_idx=np.searchsorted(sp_mzs, lower_mz, 'l'),
-            upper_idx=np.searchsorted(sp_mzs, upper_mz, 'r'),
-        )[['formula_i', 'peak_i', 'int', 'lower_idx', 'upper_idx']]
-
-        buffer = []
-        for formula_i, peak_i, ints, lower_i, upper_i in centr_df.itertuples(False, None):
-            if len(buffer) != 0 and buffer[0][0] != formula_i:
-                yield yield_buffer(buffer)
-                buffer = []
-
-            m = None
-            if upper_i > lower_i:
-                data = sp_ints[lower_i:upper_i]
-                inds = sp_inds[lower_i:upper_i]
-                row_inds, col_inds = np.divmod(inds, ncols)
-                row_inds = row_inds.astype(np.uint16)
-                col_inds = col_inds.astype(np.uint16)
-                m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols), copy=True)
-            buffer.append((formula_i, peak_i, ints, m))
-
-        if len(buffer) != 0:
-            yield yield_buffer(buffer)
+    if len(sp_inds) == 0 or len(centr_df) == 0:
+        return
+
+    centr_df = centr_df.sort_values(['formula_i', 'peak_i'])
+    formula_inds = centr_df.formula_i.values
+    centr_ints = centr_df.int.values
+    lower_mz, upper_mz = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.values)
+    lower_idxs = np.searchsorted(sp_mzs, lower_mz, 'l').tolist()
+    upper_idxs = np.searchsorted(sp_mzs, upper_mz, 'r').tolist()
+
+    row_inds, col_inds = np.divmod(sp_inds, ncols)
+    row_inds = row_inds.astype(np.uint16)
+    col_inds = col_inds.astype(np.uint16)
+
+    formula_bounds = np.flatnonzero(formula_inds[1:] != formula_inds[:-1]) + 1
+    formula_starts = [0, *formula_bounds.tolist()]
+    formula_ends = [*formula_bounds.tolist(), len(formula_inds)]
+    for start, end in zip(formula_starts, formula_ends):
+        f_images = [
+            coo_matrix(
+                (sp_ints[lo:up], (row_inds[lo:up], col_inds[lo:up])),
+                shape=(nrows, ncols),
+                copy=True,
+            )
+            if up > lo
+            else None
+            for lo, up in zip(lower_idxs[start:end], upper_idxs[start:end])
+        ]
+        f_ints = np.zeros(max(n_peaks, end - start))
+        f_ints[: end - start] = centr_ints[start:end]
+        f_images.extend([None] * (n_peaks - len(f_images)))
+        yield formula_inds[start], f_ints, f_images
 
 
 def read_ds_segments(
@@ -217,7 +231,11 @@ def process_centr_segments(
     ds_config: DSConfig,
     ds_segm_size_mb: float,
     is_intensive_dataset: bool,
-) -> Tuple[pd.DataFrame, pd.DataFrame]:
+) -> Tuple[pd.DataFrame, pd.DataFrame, Counter]:
+    """Returns formula metrics, image lookups and stats: the number of decoy formulas whose
+    metrics were skipped because they couldn't reach `decoy_msm_floor` (`metrics_skipped`),
+    the number of dataset rows read (`ds_rows_read`) and the number of them within the mz ranges
+    of the centroid segments (`ds_rows_needed`)"""
     # pylint: disable=too-many-locals
     # Copy needed fields out of imzml_reader so that the other unneeded fields aren't pulled into
     # the pickled `process_centr_segment` function
@@ -226,14 +244,22 @@ def process_centr_segments(
     isocalc_wrapper = IsocalcWrapper(ds_config)
     image_gen_config = ds_config['image_generation']
     n_peaks = ds_config['isotope_generation']['n_peaks']
-    compute_metrics = make_compute_image_metrics(imzml_reader.mask, nrows, ncols, image_gen_config)
+    metrics_batch_size = image_gen_config.get('metrics_batch_size')
+    if metrics_batch_size:
+        compute_metrics = make_compute_image_metrics_batch(
+            imzml_reader.mask, nrows, ncols, image_gen_config
+        )
+    else:
+        compute_metrics = make_compute_image_metrics(
+            imzml_reader.mask, nrows, ncols, image_gen_config
+        )
     min_px = image_gen_config['min_px']
     # TODO: Get available memory from Lithops somehow so it updates if memory is increased on retry
     pw_mem_mb = 2048 if is_intensive_dataset else 1024
 
     def process_centr_segment(
         db_segm_cobject: CObj[pd.DataFrame], *, storage: Storage, perf: Profiler
-    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, Counter]:
         print(f'Reading centroids segment {db_segm_cobject.key}')
         # read database relevant part
         centr_df = load_cobj(storage, db_segm_cobject)
@@ -254,6 +280,10 @@ def process_centr_segments(
             storage,
         )
         perf.record_entry('loaded ds segms', ds_segm_len=len(sp_arr))
+        centr_min_mz, _ = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.min())
+        _, centr_max_mz = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.max())
+        needed_start = np.searchsorted(sp_arr.mz.values, centr_min_mz, 'left')
+        needed_end = np.searchsorted(sp_arr.mz.values, centr_max_mz, 'right')
 
         formula_image_set_it = gen_iso_image_sets(
             sp_inds=sp_arr.sp_i.values,
@@ -266,27 +296,53 @@ def process_centr_segments(
             n_peaks=n_peaks,
         )
 
+        target_formula_inds = set(centr_df.formula_i[centr_df.target])
+        targeted_database_formula_inds = set(centr_df.formula_i[centr_df.targeted])
+        metrics_stats: Counter = Counter()
+        if metrics_batch_size:
+            metrics_it = compute_and_filter_metrics_batch(
+                formula_image_set_it,
+                compute_metrics,
+                target_formula_inds=target_formula_inds,
+                targeted_database_formula_inds=targeted_database_formula_inds,
+                min_px=min_px,
+                batch_size=metrics_batch_size,
+                metrics_stats=metrics_stats,
+            )
+        else:
+            metrics_it = compute_and_filter_metrics(
+                formula_image_set_it,
+                compute_metrics,
+                target_formula_inds=target_formula_inds,
+                targeted_database_formula_inds=targeted_database_formula_inds,
+                min_px=min_px,
+                metrics_stats=metrics_stats,
+            )
+
         images_manager = ImagesManager(storage)
-        for f_i, f_metrics, f_images in compute_and_filter_metrics(
-            formula_image_set_it,
-            compute_metrics,
-            target_formula_inds=set(centr_df.formula_i[centr_df.target]),
-            targeted_database_formula_inds=set(centr_df.formula_i[centr_df.targeted]),
-            min_px=min_px,
-        ):
+        for f_i, f_metrics, f_images in metrics_it:
             images_manager.append(f_i, f_metrics, f_images)
         formula_metrics_df, image_lookups = images_manager.finish()
 
-        perf.add_extra_data(metrics_n=len(formula_metrics_df), images_n=len(image_lookups))
+        perf.add_extra_data(
+            metrics_n=len(formula_metrics_df),
+            images_n=len(image_lookups),
+            metrics_skipped_n=metrics_stats['skipped'],
+        )
 
         print(f'Centroids segment {db_segm_cobject.key} finished')
-        return formula_metrics_df, image_lookups
+        stats = Counter(
+            metrics_skipped=metrics_stats['skipped'],
+            ds_rows_read=len(sp_arr),
+            ds_rows_needed=int(needed_end - needed_start),
+        )
+        return formula_metrics_df, image_lookups, stats
 
     logger.info('Annotating...')
-    formula_metrics_list, image_lookups_list = fexec.map_unpack(
+    formula_metrics_list, image_lookups_list, stats_list = fexec.map_unpack(
         process_centr_segment, [(co,) for co in db_segms_cobjs], runtime_memory=pw_mem_mb
     )
     formula_metrics_df = pd.concat(formula_metrics_list)
     images_df = pd.concat(image_lookups_list)
 
-    return formula_metrics_df, images_df
+    return formula_metrics_df, images_df, sum(stats_list, Counter())
@@ -165,6 +165,13 @@ class LocalAnnotationJob:
     then it will try to connect to the configured postgres database and dump the formulas
     for the specified databases.
     Otherwise, this can be used to run the pipeline without any external dependencies.
+
+    If `local_processes` is set, the pipeline's functions are run in a pool of that many local
+    processes instead of through Lithops. Combined with `localhost` Lithops storage, this runs
+    the whole pipeline on one machine.
+
+    If `incremental` is set, ion metrics are stored in `sm_storage.ion_metrics` and reused when
+    the same files are annotated again, e.g. with additional databases.
     """
 
     def __init__(
@@ -177,8 +184,12 @@ class LocalAnnotationJob:
         use_cache=True,
         out_dir: Optional[str] = None,
         executor: Optional[Executor] = None,
+        local_processes: Optional[int] = None,
+        incremental=False,
     ):
         sm_config = sm_config or SMConfig.get_conf()
+        if executor is None and local_processes:
+            executor = Executor(sm_config['lithops'], local_processes=local_processes)
         self.storage = Storage(config=sm_config['lithops'])
         sm_storage = sm_config['lithops']['sm_storage']
 
@@ -204,8 +215,12 @@ class LocalAnnotationJob:
             self.moldb_defs,
             self.ds_config,
             executor=executor,
+            lithops_config=sm_config['lithops'],
             cache_key=cache_key,
             use_db_mutex=False,
+            ion_metrics_key=jsonhash({'imzml': imzml_file, 'ibd': ibd_file})
+            if incremental
+            else None,
         )
 
     def run(self, save=True, **kwargs):
@@ -244,6 +259,7 @@ class ServerAnnotationJob:
         perf: Profiler,
         sm_config: Optional[Dict] = None,
         use_cache=False,
+        incremental=False,
     ):
         """
         Args
@@ -251,6 +267,9 @@ class ServerAnnotationJob:
 
         use_cache: For development - cache the results after each pipeline step so that it's easier
                    to quickly re-run specific steps.
+        incremental: Store the metrics & images of annotated ions, and only annotate ions that
+                   don't have stored results, e.g. from databases added since the last run.
+                   Pass `use_ion_metrics_cache=False` to `run` to recalculate all ions.
         """
         sm_config = sm_config or SMConfig.get_conf()
         self.sm_storage = sm_config['lithops']['sm_storage']
@@ -279,6 +298,9 @@ class ServerAnnotationJob:
             self.ds.config,
             cache_key=cache_key,
             executor=executor,
+            ion_metrics_key=(
+                jsonhash({'ds_id': ds.id, 'input_path': ds.input_path}) if incremental else None
+            ),
         )
 
         self.results_dfs = None
@@ -320,14 +342,24 @@ class ServerAnnotationJob:
 
         try:
             self.results_dfs, self.png_cobjs = self.pipe(**kwargs)
+            self.perf.add_extra_data(
+                metrics_skipped_n=self.pipe.metrics_skipped_n,
+                ds_read_amplification_est=self.pipe.ds_read_amplification_est,
+                ds_read_amplification=self.pipe.ds_read_amplification,
+            )
             self.db_formula_image_ids = self._store_images(
                 pd.concat(list(self.results_dfs.values())),
                 iter_cobjs_with_prefetch(self.storage, self.png_cobjs),
             )
 
-            # Save non-job-related diagnostics
-            diagnostics = extract_dataset_diagnostics(self.ds.id, self.pipe.imzml_reader)
-            add_diagnostics(diagnostics)
+            # Save non-job-related diagnostics. The spectra aren't read if all ions have stored
+            # metrics, so the diagnostics from the previous run are kept if the spectra stats
+            # weren't stored with the metrics
+            if self.pipe.imzml_reader.has_spectra_stats:
+                diagnostics = extract_dataset_diagnostics(self.ds.id, self.pipe.imzml_reader)
+                add_diagnostics(diagnostics)
+            else:
+                logger.warning('Spectra stats are unavailable, not updating dataset diagnostics')
 
             for moldb_id, job_id in moldb_to_job_map.items():
                 results_df = self.results_dfs[moldb_id]
@@ -37,15 +37,19 @@ class DbFDRData(InputMolDb):
 logger = logging.getLogger('annotation-pipeline')
 
 
-def _get_db_fdr_and_formulas(ds_config: DSConfig, mols: List[str]):
-    # TODO: Decompose the FDR class so that this isn't so awkward
-    fdr = FDR(
+def _make_fdr(ds_config: DSConfig):
+    return FDR(
         fdr_config=ds_config['fdr'],
         chem_mods=ds_config['isotope_generation']['chem_mods'],
         neutral_losses=ds_config['isotope_generation']['neutral_losses'],
         target_adducts=ds_config['isotope_generation']['adducts'],
         analysis_version=ds_config.get('analysis_version', 1),
     )
+
+
+def _get_db_fdr_and_formulas(ds_config: DSConfig, mols: List[str]):
+    # TODO: Decompose the FDR class so that this isn't so awkward
+    fdr = _make_fdr(ds_config)
     fdr.decoy_adducts_selection(mols)
     target_mods = fdr.target_modifiers()
     formulas = [
@@ -61,6 +65,20 @@ def _get_db_fdr_and_formulas(ds_config: DSConfig, mols: List[str]):
     return fdr, formula_map_df
 
 
+def _get_shared_db_fdrs_and_formulas(ds_config: DSConfig, dbs: List[List[str]]):
+    """Like `_get_db_fdr_and_formulas`, but decoys are chosen once for the formulas of all
+    databases. As a formula has the same target & decoy ions in every database, ion formulas are
+    also only generated once"""
+    all_mols = list(dict.fromkeys(mol for mols in dbs for mol in mols))
+    shared_fdr, all_formula_map_df = _get_db_fdr_and_formulas(ds_config, all_mols)
+
+    for mols in dbs:
+        fdr = _make_fdr(ds_config)
+        fdr.decoy_adducts_selection(mols, shared_fdr.td_table)
+        formula_map_df = all_formula_map_df[all_formula_map_df.formula.isin(mols)].copy()
+        yield fdr, formula_map_df
+
+
 def get_formulas_df(
     storage: Storage, ds_config: DSConfig, moldbs: List[InputMolDb]
 ) -> Tuple[List[CObj[DbFDRData]], pd.DataFrame]:
@@ -74,9 +92,13 @@ def get_formulas_df(
     target_ion_formulas = set()
     targeted_ion_formulas = set()
     with ProcessPoolExecutor() as executor:
-        for moldb, (fdr, formula_map_df) in zip(
-            moldbs, executor.map(_get_db_fdr_and_formulas, repeat(ds_config), dbs_iter)
-        ):
+        if ds_config['fdr'].get('share_decoys'):
+            db_fdrs_and_formulas = _get_shared_db_fdrs_and_formulas(ds_config, list(dbs_iter))
+        else:
+            db_fdrs_and_formulas = executor.map(
+                _get_db_fdr_and_formulas, repeat(ds_config), dbs_iter
+            )
+        for moldb, (fdr, formula_map_df) in zip(moldbs, db_fdrs_and_formulas):
             db_datas.append(
                 {
                     **moldb,  # type: ignore # https://github.com/python/mypy/issues/4122
@@ -106,6 +128,8 @@ def get_formulas_df(
 
 
 def store_formula_segments(storage: Storage, formulas_df: pd.DataFrame):
+    if formulas_df.empty:
+        return []
     n_formulas_segments = int(np.ceil(len(formulas_df) / 10000))
     segm_bounds = [
         len(formulas_df) * i // n_formulas_segments for i in range(n_formulas_segments + 1)
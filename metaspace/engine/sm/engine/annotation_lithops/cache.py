@@ -1,16 +1,38 @@
 from __future__ import annotations
 
 import logging
+import time
+from collections import defaultdict
 from functools import wraps
-from typing import Optional
+from typing import List, Optional, Tuple
 
+import numpy as np
+import pandas as pd
 from lithops.storage import Storage
 from lithops.storage.utils import CloudObject, StorageNoSuchKeyError
 
-from sm.engine.annotation_lithops.io import serialize, deserialize, delete_objects_by_prefix
+from sm.engine.annotation.imzml_reader import LithopsImzMLReader
+from sm.engine.annotation_lithops.io import (
+    CObj,
+    serialize,
+    deserialize,
+    delete_objects_by_prefix,
+    iter_cobjects_with_prefetch,
+    save_cobj,
+)
+from sm.engine.annotation_lithops.utils import jsonhash
 
 logger = logging.getLogger('annotation-pipeline')
 
+# Prefix of the DS segments cache, relative to the pipeline cache's root prefix
+DS_SEGMENTS_NAMESPACE = 'ds_segments'
+# Least recently used entries are evicted once the DS segments cache is larger than this
+DS_SEGMENTS_CACHE_MAX_SIZE_MB = 200 * 1024
+# Number of segments to copy into the DS segments cache per activation
+DS_SEGMENTS_COPY_BATCH = 10
+
+DSSegments = Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray]
+
 
 class PipelineCacher:
     def __init__(self, storage: Storage, namespace: str, lithops_config):
@@ -18,6 +40,7 @@ class PipelineCacher:
 
         self.bucket, self.root_prefix = lithops_config['sm_storage']['pipeline_cache']
         self.prefix = f'{self.root_prefix}/{namespace}'
+        self.ds_segments_prefix = f'{self.root_prefix}/{DS_SEGMENTS_NAMESPACE}/'
 
     def resolve_key(self, key):
         return f'{self.prefix}/{key}.cache'
@@ -42,6 +65,8 @@ class PipelineCacher:
 
         cobjects_to_clean = []
         for cache_key in keys:
+            if not cache_key.endswith('.cache'):
+                continue
             cache_data = deserialize(self.storage.get_object(self.bucket, cache_key))
 
             if isinstance(cache_data, tuple):
@@ -57,10 +82,139 @@ class PipelineCacher:
             elif isinstance(cache_data, CloudObject):
                 cobjects_to_clean.append(cache_data)
 
+        # Cached DS segments are shared with other jobs. They're only deleted with all namespaces
+        cobjects_to_clean = [
+            cobj for cobj in cobjects_to_clean if not cobj.key.startswith(self.ds_segments_prefix)
+        ]
         self.storage.delete_cloudobjects(cobjects_to_clean)
         delete_objects_by_prefix(self.storage, self.bucket, prefix)
 
 
+def storage_etag(storage: Storage, cobj: CloudObject) -> Optional[str]:
+    """ETag of an object from its metadata, or None if the storage backend doesn't provide ETags"""
+    head = storage.head_object(cobj.bucket, cobj.key)
+    etag = head.get('etag') or head.get('ETag')
+    return etag.strip('"') if etag else None
+
+
+class DSSegmentsCache:
+    """Cache of `load_ds` results, shared between jobs so that reprocessing a dataset with
+    a different config doesn't need to load and sort it again. Entries are keyed by the ETags of
+    the input files and the segment size, so datasets are only cached if the storage backend
+    provides ETags. The least recently used entries are evicted when the cache grows larger than
+    `max_size_mb`.
+
+    Segment bounds are planned for the centroids of the job that made the entry, so jobs with
+    other databases or adducts may read a bit more of the dataset when using cached segments.
+    """
+
+    def __init__(self, storage: Storage, lithops_config, max_size_mb: Optional[float] = None):
+        self.storage = storage
+        self.bucket, root_prefix = lithops_config['sm_storage']['pipeline_cache']
+        self.prefix = f'{root_prefix}/{DS_SEGMENTS_NAMESPACE}'
+        self.max_size_mb = max_size_mb or lithops_config.get(
+            'ds_segments_cache_max_size_mb', DS_SEGMENTS_CACHE_MAX_SIZE_MB
+        )
+
+    def entry_key(
+        self, imzml_cobject: CloudObject, ibd_cobject: CloudObject, ds_segm_size_mb: float
+    ) -> Optional[str]:
+        """Key of the entry for the input files, or None if they can't be cached as they don't
+        have ETags. Only object metadata is used, as hashing the content would require reading
+        the whole dataset"""
+        imzml_etag = storage_etag(self.storage, imzml_cobject)
+        ibd_etag = storage_etag(self.storage, ibd_cobject)
+        if imzml_etag is None or ibd_etag is None:
+            return None
+        return jsonhash({'imzml': imzml_etag, 'ibd': ibd_etag, 'ds_segm_size_mb': ds_segm_size_mb})
+
+    def _touch(self, entry_key: str):
+        self.storage.put_object(
+            self.bucket, f'{self.prefix}/{entry_key}/last_used', str(time.time()).encode()
+        )
+
+    def load(self, entry_key: str, ibd_cobject: CloudObject) -> Optional[DSSegments]:
+        """Loads an entry, with an ImzML reader that reads spectra from `ibd_cobject`"""
+        try:
+            data = self.storage.get_object(self.bucket, f'{self.prefix}/{entry_key}/meta')
+        except StorageNoSuchKeyError:
+            return None
+        self._touch(entry_key)
+        imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = deserialize(data)
+        return (
+            imzml_reader.with_ibd_cobject(ibd_cobject),
+            ds_segments_bounds,
+            ds_segms_cobjs,
+            ds_segm_lens,
+        )
+
+    def save(self, executor, entry_key: str, ds_segments: DSSegments):
+        """Copies the segments into the cache, as the originals are cleaned up with the job.
+        The ImzML reader is stored without its .ibd file's CloudObject, as that may belong to
+        the job too"""
+        imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = ds_segments
+        dest_bucket, dest_prefix = self.bucket, f'{self.prefix}/{entry_key}/segments'
+
+        def copy_segments(start: int, src_cobjs: List[CloudObject], *, storage: Storage):
+            return [
+                storage.put_cloudobject(data, dest_bucket, f'{dest_prefix}/{start + i:06}')
+                for i, data in enumerate(iter_cobjects_with_prefetch(storage, src_cobjs))
+            ]
+
+        new_segms_cobjs = executor.map_concat(
+            copy_segments,
+            [
+                (start, ds_segms_cobjs[start : start + DS_SEGMENTS_COPY_BATCH])
+                for start in range(0, len(ds_segms_cobjs), DS_SEGMENTS_COPY_BATCH)
+            ],
+            runtime_memory=1024,
+        )
+        # The metadata is saved last so that partially copied entries are never loaded
+        self._touch(entry_key)
+        save_cobj(
+            self.storage,
+            (
+                imzml_reader.with_ibd_cobject(None),
+                ds_segments_bounds,
+                new_segms_cobjs,
+                ds_segm_lens,
+            ),
+            self.bucket,
+            f'{self.prefix}/{entry_key}/meta',
+        )
+        self.evict()
+        return new_segms_cobjs
+
+    def evict(self):
+        entry_sizes: defaultdict = defaultdict(int)
+        for obj in self.storage.list_objects(self.bucket, f'{self.prefix}/'):
+            entry_key = obj['Key'][len(self.prefix) + 1 :].split('/')[0]
+            entry_sizes[entry_key] += int(obj['Size'])
+
+        total_size_mb = sum(entry_sizes.values()) / 2 ** 20
+        if total_size_mb <= self.max_size_mb:
+            return
+
+        def last_used(entry_key):
+            try:
+                key = f'{self.prefix}/{entry_key}/last_used'
+                return float(self.storage.get_object(self.bucket, key))
+            except (StorageNoSuchKeyError, ValueError):
+                return 0.0
+
+        for entry_key in sorted(entry_sizes, key=last_used)[:-1]:
+            logger.info(f'Evicting DS segments cache entry {entry_key}')
+            delete_objects_by_prefix(self.storage, self.bucket, f'{self.prefix}/{entry_key}/')
+            total_size_mb -= entry_sizes[entry_key] / 2 ** 20
+            if total_size_mb <= self.max_size_mb:
+                break
+
+    def clean(self):
+        keys = self.storage.list_keys(self.bucket, f'{self.prefix}/')
+        if keys:
+            self.storage.delete_objects(self.bucket, keys)
+
+
 def use_pipeline_cache(f):
     """Decorator to cache individual pipeline stages in the Pipeline class. It works by tracking
     which class properties change during the first call to the wrapped method, and re-applying those
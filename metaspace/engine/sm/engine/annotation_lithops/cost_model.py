@@ -0,0 +1,211 @@
+"""Per-stage models of Lithops activation time, fitted to previously recorded perf profiles.
+
+`Executor.map` records the `cost_factors` and the custom subtask data of every activation, along
+with its execution time, into `perf_profile_entry`. For stages listed in `STAGE_FACTORS`, the
+activation time is modelled as a constant overhead plus a non-negative linear combination of
+the factors, which is enough to split work into activations with balanced runtimes.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import nnls
+
+logger = logging.getLogger('annotation-pipeline')
+
+# Factors of each modelled stage. They must be in the stage's cost_factors or subtask data
+STAGE_FACTORS: Dict[str, Tuple[str, ...]] = {
+    'process_centr_segment': ('db_segm_len', 'ds_segm_len'),
+    'save_png_chunk': ('n_formulas', 'n_pixels', 'image_area', 'n_cobjs'),
+}
+# Number of most recent perf profile entries per stage to fit models to
+HISTORY_LIMIT = 200
+# Stages with fewer recorded activations aren't modelled
+MIN_ACTIVATIONS = 20
+
+
+class StageModel(NamedTuple):
+    factor_names: Tuple[str, ...]
+    overhead_s: float
+    coefs: np.ndarray
+    """Seconds per unit of each factor"""
+    n_activations: int
+
+    def predict(self, factors: pd.DataFrame) -> np.ndarray:
+        """Predicted seconds for each row of `factors`"""
+        return self.overhead_s + self.variable_cost(factors)
+
+    def variable_cost(self, factors: pd.DataFrame) -> np.ndarray:
+        """Predicted seconds for each row of `factors`, excluding the per-activation overhead"""
+        return factors[list(self.factor_names)].to_numpy(dtype=np.float64) @ self.coefs
+
+
+def _entry_activations(extra_data: Dict, factor_names: Sequence[str]) -> Optional[pd.DataFrame]:
+    """Extracts the factors and execution time of each activation of a recorded Executor.map"""
+    columns = {
+        **(extra_data.get('subtask_data') or {}),
+        **(extra_data.get('cost_factors') or {}),
+        'exec_time': extra_data.get('exec_times'),
+    }
+    if any(not isinstance(columns.get(name), list) for name in [*factor_names, 'exec_time']):
+        return None
+    if len({len(columns[name]) for name in [*factor_names, 'exec_time']}) != 1:
+        return None
+    df = pd.DataFrame({name: columns[name] for name in [*factor_names, 'exec_time']})
+    df = df.apply(pd.to_numeric, errors='coerce').dropna()
+    # Failed activations report negative times
+    return df[df.exec_time > 0]
+
+
+def fit_stage_model(
+    extra_datas: Iterable[Dict], factor_names: Sequence[str]
+) -> Optional[StageModel]:
+    dfs = [_entry_activations(extra_data, factor_names) for extra_data in extra_datas]
+    dfs = [df for df in dfs if df is not None]
+    if not dfs or sum(len(df) for df in dfs) < MIN_ACTIVATIONS:
+        return None
+    df = pd.concat(dfs)
+
+    # Scale factors so that NNLS isn't dominated by factors with large values
+    xs = df[list(factor_names)].to_numpy(dtype=np.float64)
+    scales = np.abs(xs).max(axis=0)
+    scales[scales == 0] = 1
+    design = np.column_stack([np.ones(len(xs)), xs / scales])
+    solution, _ = nnls(design, df.exec_time.to_numpy(dtype=np.float64))
+    return StageModel(tuple(factor_names), float(solution[0]), solution[1:] / scales, len(df))
+
+
+def load_history(db, history_limit: int = HISTORY_LIMIT) -> List[Tuple[int, str, Dict]]:
+    """Returns (profile_id, name, extra_data) of the most recent entries of each modelled stage
+    in successful Lithops annotation perf profiles"""
+    history: List[Tuple[int, str, Dict]] = []
+    for stage in STAGE_FACTORS:
+        history.extend(
+            db.select(
+                'SELECT e.profile_id, e.name, e.extra_data '
+                'FROM perf_profile_entry e '
+                'JOIN perf_profile p ON p.id = e.profile_id '
+                'WHERE p.task_type = %s AND p.error IS NULL AND e.name = %s '
+                'ORDER BY e.id DESC LIMIT %s',
+                ('annotate_lithops', stage, history_limit),
+            )
+        )
+    return history
+
+
+class CostModel:
+    """Predicts activation times of the stages that have enough recorded history.
+    Stages without a model return None from all methods, so callers can fall back to
+    their static heuristics."""
+
+    def __init__(self, stage_models: Optional[Dict[str, StageModel]] = None):
+        self.stage_models = stage_models or {}
+
+    @classmethod
+    def from_history(cls, entries: Iterable[Tuple[str, Dict]]) -> CostModel:
+        """Fits models to (name, extra_data) pairs of perf_profile_entry rows"""
+        extra_datas_by_stage: Dict[str, List[Dict]] = {}
+        for name, extra_data in entries:
+            if name in STAGE_FACTORS and extra_data:
+                extra_datas_by_stage.setdefault(name, []).append(extra_data)
+
+        stage_models = {}
+        for stage, extra_datas in extra_datas_by_stage.items():
+            model = fit_stage_model(extra_datas, STAGE_FACTORS[stage])
+            if model is not None:
+                stage_models[stage] = model
+        return cls(stage_models)
+
+    @classmethod
+    def from_db(cls, db, history_limit: int = HISTORY_LIMIT) -> CostModel:
+        """Fits models to the most recent successful Lithops annotation perf profiles.
+        Returns an empty model if the history can't be loaded."""
+        try:
+            history = load_history(db, history_limit)
+        except Exception:
+            logger.warning('Could not load perf profile history for the cost model', exc_info=True)
+            return cls()
+
+        cost_model = cls.from_history((name, extra_data) for _, name, extra_data in history)
+        for stage, model in cost_model.stage_models.items():
+            logger.debug(f'Cost model for {stage}: {model}')
+        return cost_model
+
+    def predict(self, stage: str, factors: pd.DataFrame) -> Optional[np.ndarray]:
+        model = self.stage_models.get(stage)
+        if model is None or not set(model.factor_names).issubset(factors.columns):
+            return None
+        return model.predict(factors)
+
+    def n_jobs_for_target_time(
+        self,
+        stage: str,
+        total_factors: Dict[str, float],
+        target_s: float,
+        min_job_factors: Optional[Dict[str, float]] = None,
+    ) -> Optional[int]:
+        """Number of activations to split the work into so that each takes approximately
+        `target_s` seconds, assuming work is split evenly
+
+        Args
+        -----
+        min_job_factors: Factors that each activation incurs regardless of how finely the work is
+            split, e.g. because it must read a whole dataset segment
+        """
+        model = self.stage_models.get(stage)
+        if model is None:
+            return None
+        total = np.array([total_factors[name] for name in model.factor_names], dtype=np.float64)
+        min_job = np.array(
+            [(min_job_factors or {}).get(name, 0) for name in model.factor_names], dtype=np.float64
+        )
+
+        def job_variable_s(n_jobs):
+            return float(np.maximum(total / n_jobs, min_job) @ model.coefs)
+
+        # If the time that splitting can't reduce exceeds the target, the best that can be done
+        # is to use activations that take at least twice as long as that time
+        floor_s = model.overhead_s + float(min_job @ model.coefs)
+        per_job_s = max(target_s, 2 * floor_s) - model.overhead_s
+        per_job_s = max(per_job_s, 1e-3)
+        # The time per activation only decreases with more activations, so binary search for the
+        # fewest activations that are within the target
+        lo, hi = 1, 1
+        while job_variable_s(hi) > per_job_s:
+            lo, hi = hi + 1, hi * 2
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if job_variable_s(mid) > per_job_s:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def prediction_report(
+    cost_model: CostModel, stage: str, extra_data: Dict
+) -> Optional[pd.DataFrame]:
+    """Compares predicted and actual times of the activations of a recorded Executor.map"""
+    model = cost_model.stage_models.get(stage)
+    if model is None:
+        return None
+    df = _entry_activations(extra_data, model.factor_names)
+    if df is None or df.empty:
+        return None
+    return pd.DataFrame(
+        {'predicted': model.predict(df), 'actual': df.exec_time.values}, index=df.index
+    )
+
+
+def summarize_report(report: pd.DataFrame) -> Dict[str, float]:
+    errors = (report.predicted - report.actual).abs() / report.actual
+    return {
+        'n_activations': len(report),
+        'mean_abs_pct_error': round(float(errors.mean() * 100), 1),
+        'predicted_max_s': round(float(report.predicted.max()), 1),
+        'actual_max_s': round(float(report.actual.max()), 1),
+        'actual_mean_s': round(float(report.actual.mean()), 1),
+    }
@@ -2,20 +2,37 @@ from __future__ import annotations
 
 import inspect
 import logging
+import os
 import resource
+import time
 import traceback
+from collections import Counter
 from contextlib import ExitStack
 from datetime import datetime
 from itertools import chain
 from threading import Thread, current_thread
-from typing import List, Callable, TypeVar, Iterable, Sequence, Dict, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 import lithops
 import numpy as np
 import pandas as pd
 from lithops.future import ResponseFuture
 from lithops.storage import Storage
+from lithops.wait import ALL_COMPLETED, ALWAYS
 
+from sm.engine.annotation_lithops.cost_model import CostModel, prediction_report, summarize_report
+from sm.engine.annotation_lithops.process_pool import available_memory_mb, run_in_process_pool
 from sm.engine.utils.perf_profile import SubtaskProfiler, Profiler, NullProfiler
 
 logger = logging.getLogger('engine.lithops-wrapper')
@@ -32,6 +49,17 @@ MEM_LIMITS = {
 }
 
 
+# Speculative execution: once SPECULATION_MIN_FINISHED of the items have finished, items that have
+# been running for SPECULATION_RUNTIME_FACTOR times longer than the SPECULATION_PERCENTILE runtime
+# of the finished items are started again, limited to SPECULATION_MAX_DUPLICATES of all items
+SPECULATION_MIN_FINISHED = 0.5
+SPECULATION_PERCENTILE = 90
+SPECULATION_RUNTIME_FACTOR = 1.5
+SPECULATION_MIN_RUNTIME_S = 30
+SPECULATION_MAX_DUPLICATES = 0.1
+SPECULATION_POLL_INTERVAL_S = 2
+
+
 class LithopsStalledException(Exception):
     pass
 
@@ -81,6 +109,9 @@ def _save_subtask_perf(
     attempt: int,
     runtime_memory: int,
     start_time: datetime,
+    cost_model: Optional[CostModel] = None,
+    item_idxs: Optional[List[int]] = None,
+    speculation: Optional[Dict[str, int]] = None,
 ):
     subtask_timings, subtask_data = SubtaskProfiler.make_report(subtask_perfs)
     cost_factors_plain = cost_factors.to_dict('list') if cost_factors is not None else None
@@ -106,6 +137,18 @@ def _save_subtask_perf(
         'subtask_timings': subtask_timings,
         'subtask_data': subtask_data,
     }
+    if item_idxs is not None:
+        # Only the failed items of the previous attempt were retried
+        perf_data['item_idxs'] = item_idxs
+    if speculation:
+        perf_data['speculation'] = speculation
+    report = prediction_report(cost_model, func_name, perf_data) if cost_model else None
+    if report is not None:
+        predicted_times = report.predicted.round(3).reindex(range(len(exec_times)))
+        perf_data['predicted_times'] = [
+            None if np.isnan(t) else t for t in predicted_times.tolist()
+        ]
+        logger.debug(f'Predicted vs actual activation times: {summarize_report(report)}')
     perf.record_entry(func_name, start_time, datetime.now(), **perf_data)
 
     # Print a summary
@@ -120,6 +163,145 @@ def _save_subtask_perf(
         logger.debug(f'Subtasks:\n{subtask_summary}')
 
 
+class _DispatchResult(NamedTuple):
+    futures: Optional[List[ResponseFuture]]
+    """The future of the copy whose result was used for each item, or None if run locally"""
+    return_vals: List[Optional[Tuple[Any, SubtaskProfiler]]]
+    """(result, subtask_perf) for each item, or None if the item failed"""
+    errors: Dict[int, BaseException]
+    speculation: Counter
+    dispatch_exception: Optional[BaseException] = None
+
+    @property
+    def exception(self) -> Optional[BaseException]:
+        if self.dispatch_exception is not None:
+            return self.dispatch_exception
+        return self.errors[min(self.errors)] if self.errors else None
+
+
+def _pick_stragglers(
+    runtimes: np.ndarray, elapsed: np.ndarray, can_duplicate: np.ndarray, max_stragglers: int
+) -> List[int]:
+    """Picks items that have been running much longer than the finished items took.
+
+    Args
+    -----
+    runtimes: time taken by each finished item, NaN for unfinished items
+    elapsed: time since each item was started
+    can_duplicate: mask of unfinished items that haven't been duplicated yet
+    max_stragglers: the longest-running items are picked first, up to this limit
+    """
+    finished = ~np.isnan(runtimes)
+    if finished.sum() < max(SPECULATION_MIN_FINISHED * len(runtimes), 1) or max_stragglers <= 0:
+        return []
+    threshold = max(
+        np.percentile(runtimes[finished], SPECULATION_PERCENTILE) * SPECULATION_RUNTIME_FACTOR,
+        SPECULATION_MIN_RUNTIME_S,
+    )
+    stragglers = np.flatnonzero(can_duplicate & (elapsed > threshold))
+    stragglers = stragglers[np.argsort(-elapsed[stragglers], kind='stable')]
+    return stragglers[:max_stragglers].tolist()
+
+
+def _is_successful(future: ResponseFuture) -> bool:
+    return not future.error and (future.ready or future.success or future.done)
+
+
+def _future_exception(future: ResponseFuture) -> BaseException:
+    try:
+        future.result(throw_except=True)
+    except BaseException as exc:  # pylint: disable=broad-except
+        return exc
+    return Exception(f'Activation {future.activation_id} failed')
+
+
+def _run_speculatively(
+    executor, wrapper_func, func_args, runtime_memory, lithops_kwargs, speculate: bool
+) -> _DispatchResult:
+    """Runs all items, reporting failures per item instead of raising so that only failed items
+    need to be retried. If `speculate` is set, items that run much longer than their peers are
+    started again, and whichever copy finishes first is used. Lithops can't cancel activations,
+    so the other copy is abandoned and its result is ignored."""
+    n_items = len(func_args)
+    item_futures: List[List[ResponseFuture]] = [[] for _ in range(n_items)]
+    start_times = np.full(n_items, time.monotonic())
+    runtimes = np.full(n_items, np.nan)
+    winners: List[Optional[ResponseFuture]] = [None] * n_items
+    errors: Dict[int, BaseException] = {}
+    speculation: Counter = Counter()
+
+    def submit(idxs):
+        futures = executor.map(
+            wrapper_func,
+            [func_args[i] for i in idxs],
+            runtime_memory=runtime_memory,
+            **lithops_kwargs,
+        )
+        for i, future in zip(idxs, futures):
+            item_futures[i].append(future)
+
+    submit(list(range(n_items)))
+    start_times[:] = time.monotonic()
+
+    while True:
+        unfinished = [i for i in range(n_items) if winners[i] is None and i not in errors]
+        if not unfinished:
+            break
+        executor.wait(
+            [f for i in unfinished for f in item_futures[i] if not f.error],
+            throw_except=False,
+            return_when=ALWAYS if speculate else ALL_COMPLETED,
+        )
+
+        now = time.monotonic()
+        for i in unfinished:
+            winner = next((f for f in item_futures[i] if _is_successful(f)), None)
+            if winner is not None:
+                winners[i] = winner
+                runtimes[i] = now - start_times[i]
+                if winner is not item_futures[i][0]:
+                    speculation['duplicate_wins'] += 1
+            elif all(f.error for f in item_futures[i]):
+                errors[i] = _future_exception(item_futures[i][-1])
+
+        if speculate and len(errors) + np.sum(~np.isnan(runtimes)) < n_items:
+            can_duplicate = np.array(
+                [
+                    winners[i] is None and i not in errors and len(item_futures[i]) == 1
+                    for i in range(n_items)
+                ]
+            )
+            max_duplicates = int(np.ceil(SPECULATION_MAX_DUPLICATES * n_items))
+            stragglers = _pick_stragglers(
+                runtimes,
+                now - start_times,
+                can_duplicate,
+                max_duplicates - speculation['duplicates'],
+            )
+            if stragglers:
+                logger.info(f'Starting duplicates of {len(stragglers)} straggling item(s)')
+                submit(stragglers)
+                speculation['duplicates'] += len(stragglers)
+            time.sleep(SPECULATION_POLL_INTERVAL_S)
+
+    winner_futures = [f for f in winners if f is not None]
+    if winner_futures:
+        executor.wait(winner_futures, throw_except=False, download_results=True)
+    return_vals = []
+    for i, future in enumerate(winners):
+        if future is None:
+            return_vals.append(None)
+            continue
+        try:
+            return_vals.append(future.result(internal_storage=executor.internal_storage))
+        except Exception as exc:
+            return_vals.append(None)
+            errors[i] = exc
+
+    futures = [winners[i] or item_futures[i][-1] for i in range(n_items)]
+    return _DispatchResult(futures, return_vals, errors, speculation)
+
+
 class Executor:
     """
     This class wraps Lithops' FunctionExecutor to provide a platform where we can experiment with
@@ -128,24 +310,50 @@ class Executor:
 
     Current features:
       * Switch to the Standalone executor if >4GB of memory is required
-      * Retry with 2x more memory if an execution fails due to an OOM
+      * Run in a local process pool instead of Lithops if `local_processes` is set, or
+        `mode` is "process_pool" in the "lithops" section of the Lithops config. The number of
+        parallel processes is limited so that each one can use `runtime_memory`.
+      * Retry only the failed items with 2x more memory if an execution fails due to an OOM
+      * Speculatively start duplicates of items that take much longer than their peers, and use
+        whichever copy finishes first. Can be disabled with `speculative_execution: false` in
+        the "lithops" section of the Lithops config.
       * Collect & record per-invocation performance statistics & custom data
         * A named kwarg `perf` of type `SubtaskPerf` will be injected if in the parameter list,
           allowing a function to supply more granular timing data and add custom data.
         * Memory & time usage is recorded for each invocation.
-        * A `cost_factors` DataFrame may be supplied - currently just saved to DB, but planned
-          to be used as a data source for predicting memory & time usage automatically based on
-          previous executions.
+        * If a `CostModel` has a model for the function, predicted times are recorded alongside
+          the actual times, so that the model's accuracy can be tracked.
+        * A `cost_factors` DataFrame may be supplied - it's saved to DB, and together with
+          the subtask data it's used by `CostModel` to predict time usage based on previous
+          executions.
           This DF should have one row per job (in the same order), and each column should be a float
           that represents some factor that could contribute to memory/time usage.
       * Utility functions e.g. `map_unpack` and `map_concat` for applying common transformations
         to the result data.
     """
 
-    def __init__(self, lithops_config: Dict, perf: Profiler = None, debug_run_locally=False):
+    def __init__(
+        self,
+        lithops_config: Dict,
+        perf: Profiler = None,
+        debug_run_locally=False,
+        cost_model: CostModel = None,
+        local_processes: Optional[int] = None,
+    ):
         self.debug_run_locally = debug_run_locally
         self.is_hybrid = False
-        if debug_run_locally:
+        self.local_processes = None
+        if not debug_run_locally and (
+            local_processes or lithops_config['lithops']['mode'] == 'process_pool'
+        ):
+            self.local_processes = (
+                local_processes
+                or lithops_config['lithops'].get('process_pool_workers')
+                or os.cpu_count()
+            )
+        if debug_run_locally or self.local_processes:
+            # Storage still uses the configured Lithops backend, e.g. `localhost` for the
+            # local filesystem
             self.executors = {}
         elif lithops_config['lithops']['mode'] == 'localhost':
             self.executors = {
@@ -171,6 +379,8 @@ class Executor:
         self._include_modules = lithops_config['lithops'].get('include_modules', [])
         self._execution_timeout = lithops_config['lithops'].get('execution_timeout', 3600) + 60
         self._perf = perf or NullProfiler()
+        self.cost_model = cost_model or CostModel()
+        self.speculative_execution = lithops_config['lithops'].get('speculative_execution', True)
 
     def map(
         self,
@@ -198,60 +408,86 @@ class Executor:
         wrapper_func = _build_wrapper_func(func)
         func_name = func.__name__
         attempt = 1
+        results: List[Optional[TRet]] = [None] * len(func_args)
+        # Indexes of the items that still need to be run. Only failed items are retried
+        item_idxs = list(range(len(func_args)))
 
         while True:
             start_time = datetime.now()
 
             logger.info(
-                f'executor.map({func_name}, {len(func_args)} items, {runtime_memory}MB, '
+                f'executor.map({func_name}, {len(item_idxs)} items, {runtime_memory}MB, '
                 f'attempt {attempt})'
             )
-            futures, return_vals, exc = self._dispatch_map(
-                wrapper_func, func_args, runtime_memory, debug_run_locally, lithops_kwargs
+            dispatch = self._dispatch_map(
+                wrapper_func,
+                [func_args[i] for i in item_idxs],
+                runtime_memory,
+                debug_run_locally,
+                lithops_kwargs,
             )
+            exc = dispatch.exception
+
+            succeeded = [i for i, val in enumerate(dispatch.return_vals) if val is not None]
+            for i in succeeded:
+                results[item_idxs[i]] = dispatch.return_vals[i][0]
+            if self._perf and succeeded:
+                _save_subtask_perf(
+                    self._perf,
+                    func_name=func_name,
+                    futures=[dispatch.futures[i] for i in succeeded] if dispatch.futures else None,
+                    subtask_perfs=[dispatch.return_vals[i][1] for i in succeeded],
+                    cost_factors=(
+                        cost_factors.iloc[[item_idxs[i] for i in succeeded]]
+                        if cost_factors is not None
+                        else None
+                    ),
+                    attempt=attempt,
+                    runtime_memory=runtime_memory,
+                    start_time=start_time,
+                    cost_model=self.cost_model,
+                    item_idxs=[item_idxs[i] for i in succeeded] if attempt > 1 else None,
+                    speculation=dict(dispatch.speculation) if dispatch.speculation else None,
+                )
 
             if exc is None:
-                if self._perf:
-                    _save_subtask_perf(
-                        self._perf,
-                        func_name=func_name,
-                        futures=futures,
-                        subtask_perfs=[subtask_perf for result, subtask_perf in return_vals],
-                        cost_factors=cost_factors,
-                        attempt=attempt,
-                        runtime_memory=runtime_memory,
-                        start_time=start_time,
-                    )
-
                 logger.info(
-                    f'executor.map({func_name}, {len(func_args)} items, {runtime_memory}MB, '
+                    f'executor.map({func_name}, {len(item_idxs)} items, {runtime_memory}MB, '
                     f'attempt {attempt}) - {(datetime.now() - start_time).total_seconds():.3f}s'
                 )
+                return results  # type: ignore
 
-                return [result for result, subtask_perf in return_vals]
-
-            failed_idxs = [i for i, f in enumerate(futures or []) if f.error]
-            # pylint: disable=unsubscriptable-object # (because futures is Optional)
-            failed_activation_ids = [futures[i].activation_id for i in failed_idxs]
+            failed_idxs = sorted(dispatch.errors)
+            failed_activation_ids = [
+                getattr(dispatch.futures[i], 'activation_id', None) if dispatch.futures else None
+                for i in failed_idxs
+            ]
 
             self._perf.record_entry(
                 func_name,
                 start_time,
                 datetime.now(),
-                error=traceback.format_exc(),
+                error=''.join(traceback.format_exception(type(exc), exc, exc.__traceback__)),
                 attempt=attempt,
                 runtime_memory=runtime_memory,
+                failed_items=[item_idxs[i] for i in failed_idxs],
                 failed_activation_ids=failed_activation_ids,
             )
 
-            if isinstance(exc, (MemoryError, TimeoutError)) and runtime_memory <= 4096:
+            is_retryable = all(
+                isinstance(item_exc, (MemoryError, TimeoutError))
+                for item_exc in dispatch.errors.values()
+            )
+            if is_retryable and dispatch.errors and runtime_memory <= 4096:
                 old_memory = runtime_memory
                 runtime_memory *= 2
                 attempt += 1
+                item_idxs = [item_idxs[i] for i in failed_idxs]
 
                 logger.warning(
-                    f'{func_name} raised {type(exc)} with {old_memory}MB, retrying with '
-                    f'{runtime_memory}MB. Failed activation(s): {failed_activation_ids}'
+                    f'{func_name} raised {type(exc)} with {old_memory}MB, retrying '
+                    f'{len(item_idxs)} failed item(s) with {runtime_memory}MB. '
+                    f'Failed activation(s): {failed_activation_ids}'
                 )
             elif isinstance(exc, LithopsStalledException):
                 logger.critical(
@@ -264,61 +500,89 @@ class Executor:
                     f'{func_name} raised an exception. '
                     f'Failed activation(s): {failed_idxs} '
                     f'ID(s): {failed_activation_ids}',
-                    exc_info=True,
+                    exc_info=exc,
                 )
                 raise exc
 
     def _dispatch_map(
         self, wrapper_func, func_args, runtime_memory, debug_run_locally, lithops_kwargs
-    ):
-        futures = None
-        return_vals = None
-        exception = None
+    ) -> _DispatchResult:
+        func_kwargs = {}
+        if 'storage' in inspect.signature(wrapper_func).parameters:
+            func_kwargs['storage'] = self.storage
+
         if self.debug_run_locally or debug_run_locally:
-            try:
-                func_kwargs = {}
-                if 'storage' in inspect.signature(wrapper_func).parameters:
-                    func_kwargs['storage'] = self.storage
-                return_vals = [wrapper_func(*funcargs, **func_kwargs) for funcargs in func_args]
-            except Exception as exc:
-                exception = exc
-        else:
-            # Run in another thread so that stalls can be detected & handled
-            def run():
-                nonlocal futures, return_vals, exception
+            return_vals: List[Optional[Tuple[Any, SubtaskProfiler]]] = []
+            errors: Dict[int, BaseException] = {}
+            for i, funcargs in enumerate(func_args):
                 try:
-                    with ExitStack() as stack:
-                        is_standalone = executor.config['lithops']['mode'] == 'standalone'
-                        if is_standalone:
-                            # With the VM in "consume" mode, Lithops shares the VM between parallel
-                            # invocations, which can cause race conditions and OOMs.
-                            # To avoid instability, this prevents parallel invocations with a mutex.
-                            # Import locally to avoid psycopg2 dependency in Lithops-serialized
-                            # functions
-                            # pylint: disable=import-outside-toplevel
-                            from sm.engine.utils.db_mutex import DBMutex
-
-                            stack.enter_context(DBMutex().lock('vm', self._execution_timeout))
-                        futures = executor.map(
-                            wrapper_func, func_args, runtime_memory=runtime_memory, **lithops_kwargs
-                        )
-                        return_vals = executor.get_result(futures)
-                        if is_standalone:
-                            # Dismantle & wait for it to stop while the mutex is still active
-                            # to avoid a race condition, as there's still some instability if a
-                            # second request tries to start the VM while it is still stopping.
-                            executor.compute_handler.backend.master.stop()
+                    return_vals.append(wrapper_func(*funcargs, **func_kwargs))
                 except Exception as exc:
-                    exception = exc
+                    return_vals.append(None)
+                    errors[i] = exc
+            return _DispatchResult(None, return_vals, errors, Counter())
+
+        if self.local_processes:
+            n_processes = max(min(self.local_processes, available_memory_mb() // runtime_memory), 1)
+            return_vals, errors = run_in_process_pool(
+                wrapper_func, func_args, func_kwargs, n_processes
+            )
+            return _DispatchResult(None, return_vals, errors, Counter())
+
+        result = None
+        exception = None
 
-            executor = self._select_executor(runtime_memory)
-            thread = Thread(target=run, name=f'{current_thread().name}-ex', daemon=True)
-            thread.start()
-            thread.join(self._execution_timeout)
-            if thread.is_alive():  # If timed out
-                exception = LithopsStalledException()
+        # Run in another thread so that stalls can be detected & handled
+        def run():
+            nonlocal result, exception
+            try:
+                with ExitStack() as stack:
+                    is_standalone = executor.config['lithops']['mode'] == 'standalone'
+                    if is_standalone:
+                        # With the VM in "consume" mode, Lithops shares the VM between parallel
+                        # invocations, which can cause race conditions and OOMs.
+                        # To avoid instability, this prevents parallel invocations with a mutex.
+                        # Import locally to avoid psycopg2 dependency in Lithops-serialized
+                        # functions
+                        # pylint: disable=import-outside-toplevel
+                        from sm.engine.utils.db_mutex import DBMutex
+
+                        stack.enter_context(DBMutex().lock('vm', self._execution_timeout))
+                    result = _run_speculatively(
+                        executor,
+                        wrapper_func,
+                        func_args,
+                        runtime_memory,
+                        lithops_kwargs,
+                        # Duplicates would compete for the VM's workers with the originals
+                        speculate=self.speculative_execution and not is_standalone,
+                    )
+                    if is_standalone:
+                        # Dismantle & wait for it to stop while the mutex is still active
+                        # to avoid a race condition, as there's still some instability if a
+                        # second request tries to start the VM while it is still stopping.
+                        executor.compute_handler.backend.master.stop()
+            except Exception as exc:
+                exception = exc
 
-        return futures, return_vals, exception
+        executor = self._select_executor(runtime_memory)
+        thread = Thread(target=run, name=f'{current_thread().name}-ex', daemon=True)
+        thread.start()
+        thread.join(self._execution_timeout)
+        if thread.is_alive():  # If timed out
+            exception = LithopsStalledException()
+
+        if exception is not None or result is None:
+            # Failures outside of the activations can't be attributed to specific items
+            exception = exception or Exception('Lithops map returned no results')
+            return _DispatchResult(
+                None,
+                [None] * len(func_args),
+                {i: exception for i in range(len(func_args))},
+                Counter(),
+                exception,
+            )
+        return result
 
     def _select_executor(self, runtime_memory):
         valid_executors = [
@@ -0,0 +1,204 @@
+"""Compact storage format for chunks of ion images produced by the annotation step.
+
+All images of a chunk are stored in flat arrays: each image's pixels as sorted flat
+(row * ncols + col) indexes, delta-encoded as uint32 with the first index of each image stored
+as-is, and their float32 intensities. An index at the start of the chunk maps formulas to images
+and images to pixel ranges, so that the images of a few formulas can be read with range requests
+without downloading the whole chunk.
+
+Layout: header, formula_is (int64), formula image offsets (uint64, n_formulas + 1),
+image pixel offsets (uint64, n_images + 1), pixel deltas (uint32), intensities (float32)
+"""
+from __future__ import annotations
+
+import struct
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+from lithops.storage import Storage
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation_lithops.io import CObj, get_ranges_from_cobject
+
+ImageChunk = Dict[int, List[Optional[coo_matrix]]]
+
+IMAGE_CHUNK_MAGIC = b'SMIMG'
+IMAGE_CHUNK_VERSION = 1
+# magic, version, nrows, ncols, n_formulas, n_images, n_pixels
+_HEADER = struct.Struct('<5sBIIQQQ')
+
+
+class _ChunkIndex(NamedTuple):
+    nrows: int
+    ncols: int
+    formula_is: np.ndarray
+    formula_image_offsets: np.ndarray
+    image_pixel_offsets: np.ndarray
+    deltas_start: int
+    ints_start: int
+
+
+def _parse_header(data):
+    magic, version, nrows, ncols, n_formulas, n_images, n_pixels = _HEADER.unpack_from(data)
+    assert magic == IMAGE_CHUNK_MAGIC, 'Not an image chunk'
+    assert version <= IMAGE_CHUNK_VERSION, f'Unsupported image chunk version: {version}'
+    index_size = n_formulas * 8 + (n_formulas + 1) * 8 + (n_images + 1) * 8
+    deltas_start = _HEADER.size + index_size
+    ints_start = deltas_start + n_pixels * 4
+    return nrows, ncols, n_formulas, n_images, deltas_start, ints_start
+
+
+def _parse_index(header, index_data) -> _ChunkIndex:
+    nrows, ncols, n_formulas, n_images, deltas_start, ints_start = header
+    formula_is = np.frombuffer(index_data, dtype='<i8', count=n_formulas)
+    offset = n_formulas * 8
+    formula_image_offsets = np.frombuffer(
+        index_data, dtype='<u8', count=n_formulas + 1, offset=offset
+    )
+    offset += (n_formulas + 1) * 8
+    image_pixel_offsets = np.frombuffer(index_data, dtype='<u8', count=n_images + 1, offset=offset)
+    return _ChunkIndex(
+        nrows,
+        ncols,
+        formula_is,
+        formula_image_offsets,
+        image_pixel_offsets,
+        deltas_start,
+        ints_start,
+    )
+
+
+def serialize_image_chunk(images: ImageChunk, nrows: int, ncols: int) -> bytes:
+    """Packs lists of per-peak images for each formula into the compact chunk format.
+    Duplicate pixels within an image are summed, as they would be by `coo_matrix.toarray`"""
+    assert nrows * ncols <= 2 ** 32, 'Image too large for uint32 pixel indexes'
+    # Formulas are sorted so that they can be found with a binary search
+    formula_is = np.array(sorted(images.keys()), dtype='<i8')
+    formula_image_offsets = np.zeros(len(formula_is) + 1, dtype='<u8')
+    formula_image_offsets[1:] = np.cumsum([len(images[f_i]) for f_i in formula_is])
+
+    image_n_pixels = []
+    all_deltas = []
+    all_ints = []
+    for formula_i in formula_is:
+        for img in images[formula_i]:
+            if img is None:
+                image_n_pixels.append(0)
+                continue
+            img = coo_matrix(img)
+            img.sum_duplicates()
+            pixels = img.row.astype(np.int64) * ncols + img.col
+            order = np.argsort(pixels)
+            pixels = pixels[order]
+            deltas = np.empty(len(pixels), dtype='<u4')
+            deltas[:1] = pixels[:1]
+            deltas[1:] = np.diff(pixels)
+            image_n_pixels.append(len(pixels))
+            all_deltas.append(deltas)
+            all_ints.append(img.data[order].astype('<f4'))
+
+    image_pixel_offsets = np.zeros(len(image_n_pixels) + 1, dtype='<u8')
+    image_pixel_offsets[1:] = np.cumsum(image_n_pixels)
+    deltas = np.concatenate(all_deltas) if all_deltas else np.zeros(0, dtype='<u4')
+    ints = np.concatenate(all_ints) if all_ints else np.zeros(0, dtype='<f4')
+
+    header = _HEADER.pack(
+        IMAGE_CHUNK_MAGIC,
+        IMAGE_CHUNK_VERSION,
+        nrows,
+        ncols,
+        len(formula_is),
+        len(image_n_pixels),
+        len(deltas),
+    )
+    return b''.join(
+        [
+            header,
+            formula_is.tobytes(),
+            formula_image_offsets.tobytes(),
+            image_pixel_offsets.tobytes(),
+            deltas.tobytes(),
+            ints.tobytes(),
+        ]
+    )
+
+
+def _formula_ranges(index: _ChunkIndex, formula_idx: int):
+    """Returns the [start, end) ranges of the formula's images and of their pixels"""
+    image_start, image_end = index.formula_image_offsets[formula_idx : formula_idx + 2].tolist()
+    pixel_start, pixel_end = index.image_pixel_offsets[[image_start, image_end]].tolist()
+    return image_start, image_end, pixel_start, pixel_end
+
+
+def _decode_images(index: _ChunkIndex, image_start, image_end, deltas, ints):
+    """Decodes images [image_start, image_end) from the deltas and intensities of their pixels"""
+    pixel_offsets = index.image_pixel_offsets[image_start : image_end + 1].astype(np.int64)
+    pixel_offsets -= pixel_offsets[0]
+    f_images = []
+    for start, end in zip(pixel_offsets[:-1], pixel_offsets[1:]):
+        if end > start:
+            pixels = np.cumsum(deltas[start:end], dtype=np.int64)
+            rows, cols = np.divmod(pixels, index.ncols)
+            f_images.append(
+                coo_matrix((ints[start:end], (rows, cols)), shape=(index.nrows, index.ncols))
+            )
+        else:
+            f_images.append(None)
+    return f_images
+
+
+def deserialize_image_chunk(data: bytes) -> ImageChunk:
+    """Reads all images of a chunk"""
+    header = _parse_header(data)
+    deltas_start, ints_start = header[4], header[5]
+    index = _parse_index(header, memoryview(data)[_HEADER.size : deltas_start])
+    n_pixels = (ints_start - deltas_start) // 4
+    deltas = np.frombuffer(data, dtype='<u4', count=n_pixels, offset=deltas_start)
+    ints = np.frombuffer(data, dtype='<f4', count=n_pixels, offset=ints_start)
+
+    images = {}
+    for formula_idx, formula_i in enumerate(index.formula_is.tolist()):
+        image_start, image_end, pixel_start, pixel_end = _formula_ranges(index, formula_idx)
+        images[formula_i] = _decode_images(
+            index,
+            image_start,
+            image_end,
+            deltas[pixel_start:pixel_end],
+            ints[pixel_start:pixel_end],
+        )
+    return images
+
+
+def load_image_chunk_formulas(
+    storage: Storage, cobj: CObj[bytes], formula_is: Iterable[int]
+) -> ImageChunk:
+    """Reads the images of `formula_is` from a chunk, downloading only the chunk's index and
+    the pixel ranges of those formulas"""
+    (header_data,) = get_ranges_from_cobject(storage, cobj, [(0, _HEADER.size)])
+    header = _parse_header(header_data)
+    deltas_start, ints_start = header[4], header[5]
+    (index_data,) = get_ranges_from_cobject(storage, cobj, [(_HEADER.size, deltas_start)])
+    index = _parse_index(header, index_data)
+
+    formula_is = list(formula_is)
+    formula_idxs = np.searchsorted(index.formula_is, formula_is).tolist()
+    ranges = []
+    for formula_i, formula_idx in zip(formula_is, formula_idxs):
+        if formula_idx >= len(index.formula_is) or index.formula_is[formula_idx] != formula_i:
+            raise KeyError(formula_i)
+        _, _, pixel_start, pixel_end = _formula_ranges(index, formula_idx)
+        if pixel_end > pixel_start:
+            ranges.append((deltas_start + pixel_start * 4, deltas_start + pixel_end * 4))
+            ranges.append((ints_start + pixel_start * 4, ints_start + pixel_end * 4))
+    range_data = iter(get_ranges_from_cobject(storage, cobj, ranges) if ranges else [])
+
+    images = {}
+    for formula_i, formula_idx in zip(formula_is, formula_idxs):
+        image_start, image_end, pixel_start, pixel_end = _formula_ranges(index, formula_idx)
+        if pixel_end > pixel_start:
+            deltas = np.frombuffer(next(range_data), dtype='<u4')
+            ints = np.frombuffer(next(range_data), dtype='<f4')
+        else:
+            deltas, ints = np.zeros(0, dtype='<u4'), np.zeros(0, dtype='<f4')
+        images[formula_i] = _decode_images(index, image_start, image_end, deltas, ints)
+    return images
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+import json
 import logging
 import pickle
-from concurrent.futures import Future, ThreadPoolExecutor
-from typing import TypeVar, Generic, List, Iterable, overload, Any, Tuple, Union
+import struct
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TypeVar, Generic, List, Iterable, overload, Any, Tuple, Union, Optional, Dict
 
 import numpy as np
+import pandas as pd
 import pyarrow as pa
 from lithops.storage import Storage
 from lithops.storage.utils import CloudObject
@@ -28,33 +33,158 @@ class CObj(Generic[TItem], CloudObject):
         CloudObject.__init__(self, backend, bucket, key)
 
 
-def serialize_to_file(obj, path):
-    with open(path, 'wb') as file:
-        file.write(pa.serialize(obj).to_buffer())
+# Serialized objects start with a header of:
+# magic bytes, format version, payload type, compression codec, uncompressed payload size.
+# Data without the magic bytes was written by the legacy pa.serialize/pickle format.
+# Only APIs that are available in pyarrow 1.0 are used, as that's the version in the runtime images
+SERIALIZATION_MAGIC = b'SMCOBJ'
+SERIALIZATION_VERSION = 1
+_HEADER = struct.Struct('<6sBBBQ')
+_PAYLOAD_PICKLE = 0
+_PAYLOAD_DATAFRAME = 1
+_PAYLOAD_NDARRAY = 2
+_CODECS = [None, 'lz4', 'zstd']
+_NDARRAY_META = struct.Struct('<I')
+
+
+def _compress(payload, compression):
+    if compression is None:
+        return payload
+    return pa.compress(payload, codec=compression, asbytes=True)
+
+
+def _decompress(payload, compression, size):
+    if compression is None:
+        return payload
+    return pa.decompress(payload, decompressed_size=size, codec=compression)
+
+
+def _write_ipc_stream(stream, table):
+    writer = pa.ipc.new_stream(stream, table.schema)
+    writer.write_table(table)
+    writer.close()
+
+
+def _serialize_dataframe(df: pd.DataFrame, compression):
+    table = pa.Table.from_pandas(df)
+
+    def header(size):
+        codec = _CODECS.index(compression)
+        return _HEADER.pack(
+            SERIALIZATION_MAGIC, SERIALIZATION_VERSION, _PAYLOAD_DATAFRAME, codec, size
+        )
+
+    if compression is not None:
+        sink = pa.BufferOutputStream()
+        _write_ipc_stream(sink, table)
+        stream = sink.getvalue()
+        return b''.join([header(stream.size), _compress(stream, compression)])
+
+    # Measure the stream first, so that it can be written into a single preallocated buffer
+    # instead of a growing one
+    mock_sink = pa.MockOutputStream()
+    _write_ipc_stream(mock_sink, table)
+    data = bytearray(_HEADER.size + mock_sink.size())
+    writer = pa.FixedSizeBufferWriter(pa.py_buffer(data))
+    writer.write(header(mock_sink.size()))
+    _write_ipc_stream(writer, table)
+    # Storage backends require bytes
+    return bytes(data)
+
+
+def _serialize_ndarray(arr: np.ndarray):
+    meta = json.dumps({'dtype': arr.dtype.str, 'shape': arr.shape}).encode()
+    data = bytearray(_NDARRAY_META.size + len(meta) + arr.nbytes)
+    _NDARRAY_META.pack_into(data, 0, len(meta))
+    data[_NDARRAY_META.size : _NDARRAY_META.size + len(meta)] = meta
+    offset = _NDARRAY_META.size + len(meta)
+    np.frombuffer(data, dtype=arr.dtype, offset=offset).reshape(arr.shape)[...] = arr
+    return data
 
 
-def deserialize_from_file(path):
-    with open(path, 'rb') as file:
-        data = pa.deserialize(file.read())
-    return data
+def _deserialize_ndarray(payload):
+    buf = memoryview(payload)
+    (meta_len,) = _NDARRAY_META.unpack_from(buf)
+    meta = json.loads(bytes(buf[_NDARRAY_META.size : _NDARRAY_META.size + meta_len]))
+    offset = _NDARRAY_META.size + meta_len
+    return np.frombuffer(buf[offset:], dtype=np.dtype(meta['dtype'])).reshape(meta['shape'])
 
 
-def serialize(obj):
-    try:
-        return pa.serialize(obj).to_buffer().to_pybytes()
-    except pa.lib.SerializationCallbackError:
-        return pickle.dumps(obj)
+def _deserialize_legacy(data):
+    # pa.serialize is deprecated since pyarrow 2.0 and has been removed from later versions.
+    # Objects written with it can only be read while a version that still has it is installed
+    legacy_deserialize = getattr(pa, 'deserialize', None)
+    if legacy_deserialize is not None:
+        try:
+            return legacy_deserialize(data)
+        except (pa.lib.ArrowInvalid, OSError):
+            pass
+    return pickle.loads(data)
+
+
+def serialize(obj, compression: Optional[str] = None) -> bytes:
+    """Serializes DataFrames as Arrow IPC streams, numpy arrays as raw buffers and everything
+    else with pickle, prefixed with a versioned header.
+
+    Args:
+        compression: None, 'lz4' or 'zstd'
+    """
+    codec = _CODECS.index(compression)
+    if isinstance(obj, pd.DataFrame):
+        try:
+            return _serialize_dataframe(obj, compression)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, ValueError):
+            # e.g. mixed-type object columns, or duplicate column names (ValueError)
+            logger.debug('DataFrame is not supported by Arrow, falling back to pickle')
+
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        payload_type, payload = _PAYLOAD_NDARRAY, _serialize_ndarray(obj)
+    else:
+        payload_type, payload = _PAYLOAD_PICKLE, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    header = _HEADER.pack(
+        SERIALIZATION_MAGIC, SERIALIZATION_VERSION, payload_type, codec, len(payload)
+    )
+    return b''.join([header, _compress(payload, compression)])
 
 
 def deserialize(data):
-    try:
-        return pa.deserialize(data)
-    except (pa.lib.ArrowInvalid, OSError):
-        return pickle.loads(data)
+    """Inverse of `serialize`. Also reads objects written by the legacy format"""
+    if not data[: len(SERIALIZATION_MAGIC)] == SERIALIZATION_MAGIC:
+        return _deserialize_legacy(data)
 
+    _, version, payload_type, codec, size = _HEADER.unpack_from(data)
+    if version > SERIALIZATION_VERSION:
+        raise ValueError(f'Unsupported serialization format version: {version}')
+    payload = _decompress(pa.py_buffer(data)[_HEADER.size :], _CODECS[codec], size)
 
-def save_cobj(storage: Storage, obj: TItem, bucket: str = None, key: str = None) -> CObj[TItem]:
-    return storage.put_cloudobject(serialize(obj), bucket, key)
+    if payload_type == _PAYLOAD_DATAFRAME:
+        # split_blocks avoids copying columns into consolidated blocks, so numeric columns
+        # without nulls are read-only views of the (decompressed) payload
+        return pa.ipc.open_stream(payload).read_all().to_pandas(split_blocks=True)
+    if payload_type == _PAYLOAD_NDARRAY:
+        return _deserialize_ndarray(payload)
+    return pickle.loads(payload)
+
+
+def serialize_to_file(obj, path):
+    with open(path, 'wb') as file:
+        file.write(serialize(obj))
+
+
+def deserialize_from_file(path):
+    with open(path, 'rb') as file:
+        return deserialize(file.read())
+
+
+def save_cobj(
+    storage: Storage,
+    obj: TItem,
+    bucket: str = None,
+    key: str = None,
+    compression: Optional[str] = None,
+) -> CObj[TItem]:
+    return storage.put_cloudobject(serialize(obj, compression), bucket, key)
 
 
 @overload
@@ -101,7 +231,9 @@ def delete_objects_by_prefix(storage: Storage, bucket: str, prefix: str):
     logger.info(f'Removed {len(keys)} objects from {storage.backend}://{bucket}/{prefix}')
 
 
-def _iter_with_prefetch(callback, items, prefetch):
+def iter_with_prefetch(callback, items, prefetch):
+    """Lazily calls `callback` on each item in `items`, running up to `prefetch` calls ahead
+    in a background thread."""
     futures: List[Future] = []
     items_iter = iter(items)
     # Limit to a single background thread for prefetching to avoid competing with the main thread,
@@ -123,7 +255,7 @@ def iter_cobjects_with_prefetch(
 ) -> Iterable[bytes]:
     """Lazily loads the raw content of each item in a list of CloudObjects, prefetching up to
     `prefetch` items ahead."""
-    return _iter_with_prefetch(storage.get_cloudobject, cobjects, prefetch)
+    return iter_with_prefetch(storage.get_cloudobject, cobjects, prefetch)
 
 
 def iter_cobjs_with_prefetch(
@@ -132,7 +264,164 @@ def iter_cobjs_with_prefetch(
     """Lazily loads and deserializes each item in a list of CObjs, prefetching up to
     `prefetch` items ahead."""
 
-    return _iter_with_prefetch(lambda cobj: load_cobj(storage, cobj), cobjs, prefetch)
+    return iter_with_prefetch(lambda cobj: load_cobj(storage, cobj), cobjs, prefetch)
+
+
+# Largest gap between ranges before a new request should be made
+RANGE_REQUEST_MAX_GAP = 2 ** 16
+# Limit requests to avoid large memory allocations, and because SSL fails if requests
+# are >2GB https://bugs.python.org/issue42853 (Fixed in Python 3.9.7, broken in 3.8.*)
+RANGE_REQUEST_MAX_SIZE = 32 * 2 ** 20
+RANGE_REQUEST_MAX_CONCURRENCY = 16
+
+
+def plan_range_requests(
+    ranges: np.ndarray,
+    max_gap: int = RANGE_REQUEST_MAX_GAP,
+    max_request_size: int = RANGE_REQUEST_MAX_SIZE,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Coalesces byte ranges that are less than `max_gap` apart into requests of approximately
+    `max_request_size` at most. A request may exceed it by the size of its last range.
+
+    Returns
+    -----
+        (request_ranges, request_idxs): (n, 2) array of [start, end) request byte ranges, and
+        the index of the request that contains each input range
+    """
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    if len(ranges) == 0:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(ranges[:, 0], kind='stable')
+    starts, ends = ranges[order, 0], ranges[order, 1]
+    max_ends = np.maximum.accumulate(ends)
+
+    # Split into groups of ranges separated by gaps, then split groups by size
+    is_group_start = np.ones(len(starts), dtype=bool)
+    is_group_start[1:] = starts[1:] - max_ends[:-1] > max_gap
+    group_starts = starts[is_group_start][np.cumsum(is_group_start) - 1]
+    size_chunk = (starts - group_starts) // max_request_size
+    is_request_start = is_group_start.copy()
+    is_request_start[1:] |= size_chunk[1:] != size_chunk[:-1]
+
+    sorted_request_idxs = np.cumsum(is_request_start) - 1
+    request_starts = starts[is_request_start]
+    request_ends = np.maximum.reduceat(ends, np.flatnonzero(is_request_start))
+    request_idxs = np.empty(len(ranges), dtype=np.int64)
+    request_idxs[order] = sorted_request_idxs
+    return np.column_stack([request_starts, request_ends]), request_idxs
+
+
+class _AdaptiveConcurrency:
+    """Hill-climbing concurrency limit: doubles concurrency while throughput keeps improving,
+    and halves it when throughput drops. Throughput is measured over windows of requests."""
+
+    def __init__(self, initial: int = 4, max_concurrency: int = RANGE_REQUEST_MAX_CONCURRENCY):
+        self.concurrency = min(initial, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self._best_throughput = 0.0
+        self._window_bytes = 0
+        self._window_n = 0
+        self._window_start = time.monotonic()
+
+    def observe(self, n_bytes: int):
+        self._window_bytes += n_bytes
+        self._window_n += 1
+        if self._window_n < self.concurrency:
+            return
+
+        now = time.monotonic()
+        throughput = self._window_bytes / max(now - self._window_start, 1e-6)
+        if throughput > self._best_throughput * 1.1:
+            self._best_throughput = throughput
+            self.concurrency = min(self.concurrency * 2, self.max_concurrency)
+        elif throughput < self._best_throughput * 0.7:
+            self.concurrency = max(self.concurrency // 2, 1)
+        self._window_bytes, self._window_n, self._window_start = 0, 0, now
+
+
+class CObjRangeReader:
+    """Reads byte ranges of a CloudObject. Nearby ranges are coalesced into larger requests
+    (see `plan_range_requests`), which are run with a concurrency limit that adapts to the
+    observed throughput and is kept between calls to `read`.
+
+    `stats` counts the `bytes_requested` by callers, the `bytes_fetched` including gaps between
+    ranges, the number of `requests` and the wall time spent (`read_ms`)."""
+
+    def __init__(
+        self,
+        storage: Storage,
+        cobj: CloudObject,
+        max_gap: int = RANGE_REQUEST_MAX_GAP,
+        max_request_size: int = RANGE_REQUEST_MAX_SIZE,
+        max_concurrency: int = RANGE_REQUEST_MAX_CONCURRENCY,
+    ):
+        self.storage = storage
+        self.cobj = cobj
+        self.max_gap = max_gap
+        self.max_request_size = max_request_size
+        self.max_concurrency = max_concurrency
+        self.stats: Counter = Counter()
+        self._concurrency = _AdaptiveConcurrency(max_concurrency=max_concurrency)
+
+    def _get_range(self, lo_hi):
+        lo_idx, hi_idx = lo_hi
+        args = {'Range': f'bytes={lo_idx}-{hi_idx-1}'}
+        return self.storage.get_object(self.cobj.bucket, self.cobj.key, extra_get_args=args)
+
+    def _fetch(self, request_ranges: List[Tuple[int, int]]) -> List[bytes]:
+        results: List[bytes] = [b''] * len(request_ranges)
+        pending = iter(enumerate(request_ranges))
+        in_flight: Dict[Future, int] = {}
+        with ThreadPoolExecutor(self._concurrency.max_concurrency) as executor:
+            while True:
+                while len(in_flight) < self._concurrency.concurrency:
+                    request_i, lo_hi = next(pending, (None, None))
+                    if request_i is None:
+                        break
+                    in_flight[executor.submit(self._get_range, lo_hi)] = request_i
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    data = future.result()
+                    results[in_flight.pop(future)] = data
+                    self._concurrency.observe(len(data))
+        return results
+
+    def read(self, ranges: Union[List[Tuple[int, int]], np.ndarray]) -> List[bytes]:
+        """Returns the content of each [start, end) byte range"""
+        start_time = time.monotonic()
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        # Empty ranges can't be requested
+        non_empty = ranges[:, 1] > ranges[:, 0]
+        request_ranges, request_idxs = plan_range_requests(
+            ranges[non_empty], self.max_gap, self.max_request_size
+        )
+        logger.debug(f'Reading {len(ranges)} ranges in {len(request_ranges)} requests')
+        request_results = self._fetch(request_ranges.tolist())
+
+        self.stats['requests'] += len(request_ranges)
+        self.stats['bytes_fetched'] += int(np.sum(request_ranges[:, 1] - request_ranges[:, 0]))
+        self.stats['bytes_requested'] += int(np.sum(ranges[non_empty, 1] - ranges[non_empty, 0]))
+        self.stats['read_ms'] += int((time.monotonic() - start_time) * 1000)
+
+        offsets = ranges[non_empty] - request_ranges[request_idxs, :1]
+        results: List[bytes] = [b''] * len(ranges)
+        for i, request_i, (lo, hi) in zip(
+            np.flatnonzero(non_empty).tolist(), request_idxs.tolist(), offsets.tolist()
+        ):
+            results[i] = request_results[request_i][lo:hi]
+        return results
+
+    def perf_data(self, prefix: str) -> Dict[str, Any]:
+        """Stats formatted for `Profiler.record_entry`, including the achieved MB/s"""
+        mb_fetched = self.stats['bytes_fetched'] / 2 ** 20
+        return {
+            f'{prefix}_mb_fetched': round(mb_fetched, 1),
+            f'{prefix}_mb_requested': round(self.stats['bytes_requested'] / 2 ** 20, 1),
+            f'{prefix}_requests': self.stats['requests'],
+            f'{prefix}_mb_per_s': round(mb_fetched / max(self.stats['read_ms'] / 1000, 1e-3), 1),
+        }
 
 
 def get_ranges_from_cobject(
@@ -141,42 +430,4 @@ def get_ranges_from_cobject(
     """Download partial ranges from a CloudObject. This combines adjacent/overlapping ranges
     to minimize the number of requests without wasting any bandwidth if there are large gaps
     between requested ranges."""
-    max_jump = 2 ** 16  # Largest gap between ranges before a new request should be made
-    # Limit chunks to 256MB to avoid large memory allocations, and because SSL fails if requests
-    # are >2GB https://bugs.python.org/issue42853 (Fixed in Python 3.9.7, broken in 3.8.*)
-    max_chunk_size = 256 * 2 ** 20
-
-    request_ranges: List[Tuple[int, int]] = []
-    tasks = []
-    range_start = None
-    range_end = None
-    for input_i in np.argsort(np.array(ranges)[:, 0]):
-        lo_idx, hi_idx = ranges[input_i]
-        if range_start is None:
-            range_start, range_end = lo_idx, hi_idx
-        elif lo_idx - range_end <= max_jump and range_end - range_start <= max_chunk_size:
-            range_end = max(range_end, hi_idx)
-        else:
-            request_ranges.append((range_start, range_end))
-            range_start, range_end = lo_idx, hi_idx
-
-        tasks.append((input_i, len(request_ranges), lo_idx - range_start, hi_idx - range_start))
-
-    if range_start is not None and range_end is not None:
-        request_ranges.append((range_start, range_end))  # type: ignore
-
-    logger.debug(f'Reading {len(request_ranges)} ranges: {request_ranges}')
-
-    with ThreadPoolExecutor() as executor:
-
-        def get_range(lo_hi):
-            lo_idx, hi_idx = lo_hi
-            args = {'Range': f'bytes={lo_idx}-{hi_idx-1}'}
-            return storage.get_object(cobj.bucket, cobj.key, extra_get_args=args)
-
-        request_results = list(executor.map(get_range, request_ranges))
-
-    return [
-        request_results[request_i][request_lo:request_hi]
-        for input_i, request_i, request_lo, request_hi in sorted(tasks)
-    ]
+    return CObjRangeReader(storage, cobj).read(ranges)
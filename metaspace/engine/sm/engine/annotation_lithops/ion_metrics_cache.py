@@ -0,0 +1,247 @@
+"""Per-dataset store of the metrics and images of every ion formula that has been annotated, so
+that when databases are added to a dataset, only ions that weren't in any of the previously
+annotated databases need to go through centroids calculation & annotation. FDR is then run for
+each database with the stored metrics.
+
+Metrics & images don't depend on which database an ion came from, but `compute_and_filter_metrics`
+treats target, decoy and targeted-database ions differently, so stored results are only reused
+for ions that have the same `target` and `targeted` flags as when they were annotated.
+"""
+from __future__ import annotations
+
+import logging
+from contextlib import ExitStack
+from typing import List, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+from lithops.storage import Storage
+from lithops.storage.utils import CloudObject, StorageNoSuchKeyError
+
+from sm.engine.annotation.imzml_reader import ImzMLReader
+from sm.engine.annotation_lithops.build_moldb import store_formula_segments
+from sm.engine.annotation_lithops.executor import Executor, RUNTIME_DOCKER_IMAGE
+from sm.engine.annotation_lithops.io import (
+    CObj,
+    iter_cobjects_with_prefetch,
+    iter_cobjs_with_prefetch,
+    load_cobj,
+    save_cobj,
+)
+from sm.engine.annotation_lithops.utils import jsonhash
+from sm.engine.ds_config import DSConfig
+from sm.engine.utils.perf_profile import Profiler
+
+logger = logging.getLogger('annotation-pipeline')
+
+# Number of image chunks to copy into the store per activation
+COPY_CHUNKS_PER_JOB = 10
+
+
+class IonMetrics(NamedTuple):
+    ions_df: pd.DataFrame
+    """index: ion_formula, columns: target, targeted. All annotated ions, including ions that
+    didn't get metrics, e.g. because their images had too few pixels"""
+    metrics_df: pd.DataFrame
+    """index: ion_formula, columns: metrics"""
+    images_df: pd.DataFrame
+    """index: ion_formula, columns: n_pixels, cobj, chunk_formula_i. Image chunks are indexed by
+    the formula_i of the run that made them, which is kept in chunk_formula_i"""
+
+
+def empty_ion_metrics() -> IonMetrics:
+    def index():
+        return pd.Index([], name='ion_formula', dtype='O')
+
+    return IonMetrics(
+        pd.DataFrame({'target': pd.Series(dtype=bool), 'targeted': pd.Series(dtype=bool)}, index()),
+        pd.DataFrame(index=index()),
+        pd.DataFrame(
+            {
+                'n_pixels': pd.Series(dtype='l'),
+                'cobj': pd.Series(dtype='O'),
+                'chunk_formula_i': pd.Series(dtype='l'),
+            },
+            index(),
+        ),
+    )
+
+
+def _load_formulas(storage: Storage, formula_cobjs: List[CObj[pd.DataFrame]]) -> pd.DataFrame:
+    formula_dfs = list(iter_cobjs_with_prefetch(storage, formula_cobjs))
+    if not formula_dfs:
+        return pd.DataFrame(
+            {'ion_formula': [], 'target': [], 'targeted': []},
+            index=pd.Index([], name='formula_i', dtype='l'),
+        )
+    return pd.concat(formula_dfs)
+
+
+def _reindex_by_formula_i(df: pd.DataFrame, formula_is: pd.Series) -> pd.DataFrame:
+    """Selects the rows of an ion_formula-indexed `df` that are in `formula_is`
+    (ion_formula -> formula_i), and changes the index to formula_i"""
+    df = df[df.index.isin(formula_is.index)]
+    return df.set_axis(pd.Index(formula_is[df.index].values, name='formula_i'), axis=0)
+
+
+class IonMetricsCacheEntry:
+    def __init__(
+        self,
+        executor: Executor,
+        sm_storage: dict,
+        ds_key: str,
+        ds_config: DSConfig,
+        use_db_mutex=True,
+    ):
+        # Databases and FDR settings don't affect metrics. The runtime image is included so that
+        # metrics are recalculated after changes to the engine
+        self.ds_config = {k: v for k, v in ds_config.items() if k not in ('database_ids', 'fdr')}
+        self.ds_hash = jsonhash(
+            {'ds': ds_key, 'ds_config': self.ds_config, 'runtime': RUNTIME_DOCKER_IMAGE}
+        )
+
+        self.executor = executor
+        self.storage = executor.storage
+        self.use_db_mutex = use_db_mutex
+        self.bucket, raw_prefix = sm_storage['ion_metrics']
+        self.prefix = f'{raw_prefix}/{self.ds_hash}'
+        self.images_prefix = f'{self.prefix}/images'
+        self.data_cobj = CloudObject(self.storage.backend, self.bucket, f'{self.prefix}/data')
+        self.spectra_stats_cobj = CloudObject(
+            self.storage.backend, self.bucket, f'{self.prefix}/spectra_stats'
+        )
+
+    def exists(self):
+        try:
+            self.storage.head_object(self.bucket, self.data_cobj.key)
+            return True
+        except StorageNoSuchKeyError:
+            return False
+
+    def split_formulas(
+        self, formula_cobjs: List[CObj[pd.DataFrame]]
+    ) -> Tuple[List[CObj[pd.DataFrame]], pd.DataFrame, pd.DataFrame]:
+        """Returns formula segments of the ions that need to be annotated, and the stored metrics
+        and images of the other ions, indexed by formula_i"""
+        data_cobj = self.data_cobj if self.exists() else None
+
+        def _split_formulas(*, storage: Storage, perf: Profiler):
+            formulas_df = _load_formulas(storage, formula_cobjs)
+            ion_metrics = load_cobj(storage, data_cobj) if data_cobj else empty_ion_metrics()
+            perf.record_entry(
+                'loaded', n_formulas=len(formulas_df), n_stored_ions=len(ion_metrics.ions_df)
+            )
+
+            stored_flags = ion_metrics.ions_df.reindex(formulas_df.ion_formula.values)
+            is_stored = (stored_flags.target.values == formulas_df.target.values) & (
+                stored_flags.targeted.values == formulas_df.targeted.values
+            )
+            stored_formulas = formulas_df.ion_formula[is_stored]
+            formula_is = pd.Series(stored_formulas.index, index=stored_formulas.values)
+            metrics_df = _reindex_by_formula_i(ion_metrics.metrics_df, formula_is)
+            images_df = _reindex_by_formula_i(ion_metrics.images_df, formula_is)
+
+            missing_formula_cobjs = store_formula_segments(storage, formulas_df[~is_stored])
+            perf.record_entry('split', n_missing=int((~is_stored).sum()))
+            return missing_formula_cobjs, metrics_df, images_df
+
+        return self.executor.call(_split_formulas, (), runtime_memory=4096)
+
+    def save(
+        self,
+        formula_cobjs: List[CObj[pd.DataFrame]],
+        formula_metrics_df: pd.DataFrame,
+        images_df: pd.DataFrame,
+    ):
+        """Adds the results of annotating the ions in `formula_cobjs` to the store, replacing any
+        previous results for those ions. Images are copied into the store because the chunks made
+        by `process_centr_segments` are temporary."""
+        dest_bucket, images_prefix = self.bucket, self.images_prefix
+        data_cobj = self.data_cobj
+
+        def copy_chunks(src_cobjs: List[CloudObject], *, storage: Storage):
+            copied = []
+            for src_cobj, data in zip(src_cobjs, iter_cobjects_with_prefetch(storage, src_cobjs)):
+                dest_key = f'{images_prefix}/{uuid4()}'
+                copied.append((src_cobj.key, storage.put_cloudobject(data, dest_bucket, dest_key)))
+            return copied
+
+        def merge(is_stored: bool, copied_cobjs: dict, *, storage: Storage):
+            ion_metrics = load_cobj(storage, data_cobj) if is_stored else empty_ion_metrics()
+            formulas_df = _load_formulas(storage, formula_cobjs)
+            ions_df = formulas_df.set_index('ion_formula')[['target', 'targeted']]
+
+            def by_ion_formula(df):
+                ion_formulas = formulas_df.ion_formula[df.index].values
+                return df.set_axis(pd.Index(ion_formulas, name='ion_formula'), axis=0)
+
+            def replace(old_df, new_df):
+                return pd.concat([old_df[~old_df.index.isin(ions_df.index)], new_df])
+
+            new_images_df = images_df.assign(
+                cobj=[copied_cobjs[cobj.key] for cobj in images_df.cobj],
+                chunk_formula_i=images_df.index,
+            )
+            ion_metrics = IonMetrics(
+                replace(ion_metrics.ions_df, ions_df),
+                replace(ion_metrics.metrics_df, by_ion_formula(formula_metrics_df)),
+                replace(ion_metrics.images_df, by_ion_formula(new_images_df)),
+            )
+            save_cobj(storage, ion_metrics, data_cobj.bucket, data_cobj.key)
+
+            # Clean up chunks that only had images of replaced ions
+            used_keys = {cobj.key for cobj in ion_metrics.images_df.cobj}
+            unused_keys = [
+                key for key in storage.list_keys(dest_bucket, images_prefix) if key not in used_keys
+            ]
+            if unused_keys:
+                storage.delete_objects(dest_bucket, unused_keys)
+            return len(ion_metrics.ions_df), len(unused_keys)
+
+        with ExitStack() as stack:
+            if self.use_db_mutex:
+                # Import locally to avoid psycopg2 dependency in Lithops-serialized functions
+                # pylint: disable=import-outside-toplevel
+                from sm.engine.utils.db_mutex import DBMutex
+
+                stack.enter_context(DBMutex().lock(f'ion_metrics-{self.ds_hash}', timeout=3600))
+
+            src_cobjs = list({cobj.key: cobj for cobj in images_df.cobj}.values())
+            copied = self.executor.map_concat(
+                copy_chunks,
+                [
+                    (src_cobjs[i : i + COPY_CHUNKS_PER_JOB],)
+                    for i in range(0, len(src_cobjs), COPY_CHUNKS_PER_JOB)
+                ],
+                runtime_memory=1024,
+            )
+            n_ions, n_deleted_chunks = self.executor.call(
+                merge, (self.exists(), dict(copied)), runtime_memory=4096
+            )
+        logger.info(
+            f'Saved {len(formula_metrics_df)} ion metrics, {len(images_df)} ion images. '
+            f'Stored ions: {n_ions}, deleted {n_deleted_chunks} unused image chunks'
+        )
+
+    def save_spectra_stats(self, imzml_reader: ImzMLReader):
+        """Stores the TICs and mz range of the dataset's spectra, so that the dataset diagnostics
+        can be made when no spectra need to be read because all ions have stored metrics"""
+        spectra_stats = imzml_reader.get_spectra_stats(np.arange(imzml_reader.n_spectra))
+        save_cobj(
+            self.storage, spectra_stats, self.spectra_stats_cobj.bucket, self.spectra_stats_cobj.key
+        )
+
+    def load_spectra_stats(self) -> Optional[Tuple]:
+        """Returns the spectra stats for `ImzMLReader.update_spectra_stats`, or None if they
+        weren't stored"""
+        try:
+            return load_cobj(self.storage, self.spectra_stats_cobj)
+        except StorageNoSuchKeyError:
+            return None
+
+    def clear(self):
+        keys = self.storage.list_keys(self.bucket, self.prefix)
+        if keys:
+            logger.info(f'Clearing ion metrics cache {self.prefix}')
+            self.storage.delete_objects(self.bucket, keys)
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import logging
 from concurrent.futures import ThreadPoolExecutor
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Optional
 
 import numpy as np
 import pandas as pd
@@ -10,39 +10,87 @@ from lithops.storage import Storage
 from lithops.storage.utils import CloudObject
 
 from sm.engine.annotation.imzml_reader import LithopsImzMLReader
+from sm.engine.annotation.segment_planner import plan_ds_segments
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import CObj, load_cobj, save_cobj
+from sm.engine.annotation_lithops.io import (
+    CObj,
+    CObjRangeReader,
+    load_cobj,
+    load_cobjs,
+    save_cobj,
+)
 from sm.engine.utils.perf_profile import SubtaskProfiler
 
 logger = logging.getLogger('annotation-pipeline')
 
 
-def _load_spectra(storage, imzml_reader):
-    # Pre-allocate lists of mz & int arrays
-    mz_arrays = [np.array([], dtype=imzml_reader.mz_precision)] * imzml_reader.n_spectra
-    int_arrays = [np.array([], dtype=np.float32)] * imzml_reader.n_spectra
-    sp_lens = np.empty(imzml_reader.n_spectra, np.int64)
+# Peaks sampled from the whole dataset to plan segment bounds in distributed mode
+DISTRIBUTED_SAMPLE_PEAKS = 5_000_000
+# Size of the .ibd byte range read by each activation in distributed mode
+DISTRIBUTED_CHUNK_SIZE_MB = 512
+
+
+def _row_size(imzml_reader):
+    return (4 if imzml_reader.mz_precision == 'f' else 8) + 4 + 4
 
-    def read_spectrum_chunk(start_end):
-        for sp_i, mzs, ints in imzml_reader.iter_spectra(storage, list(range(*start_end))):
-            mz_arrays[sp_i] = mzs
-            int_arrays[sp_i] = ints.astype(np.float32)
-            sp_lens[sp_i] = len(ints)
 
-    # Break into approx. 100MB chunks to read in parallel
-    n_peaks = np.sum(imzml_reader.imzml_reader.mzLengths)
-    n_chunks = min(int(np.ceil(n_peaks / (10 * 2 ** 20))), imzml_reader.n_spectra)
-    chunk_bounds = np.linspace(0, imzml_reader.n_spectra, n_chunks + 1, dtype=np.int64)
-    spectrum_chunks = zip(chunk_bounds, chunk_bounds[1:])
+def _spectra_sizes(imzml_reader):
+    """Bytes of each spectrum in the .ibd file"""
+    portable_reader = imzml_reader.imzml_reader
+    return (
+        np.array(portable_reader.mzLengths, dtype=np.int64)
+        * np.dtype(portable_reader.mzPrecision).itemsize
+        + np.array(portable_reader.intensityLengths, dtype=np.int64)
+        * np.dtype(portable_reader.intensityPrecision).itemsize
+    )
+
 
-    with ThreadPoolExecutor(4) as executor:
-        for _ in executor.map(read_spectrum_chunk, spectrum_chunks):
-            pass
+def _split_by_size(sizes, chunk_size):
+    """Splits items into consecutive [start, end) ranges of approximately `chunk_size` in total"""
+    ends = np.cumsum(sizes)
+    n_chunks = max(int(np.ceil(ends[-1] / chunk_size)), 1) if len(ends) else 0
+    bounds = np.searchsorted(ends, np.arange(1, n_chunks) * chunk_size, side='right').tolist()
+    return list(zip([0, *bounds], [*bounds, len(sizes)]))
 
-    return np.concatenate(mz_arrays), np.concatenate(int_arrays), sp_lens
+
+def _load_spectra(storage, imzml_reader, sp_inds=None):
+    """Reads the spectra `sp_inds` (all spectra by default), returning concatenated mzs & ints
+    in the order of `sp_inds`"""
+    if sp_inds is None:
+        sp_inds = np.arange(imzml_reader.n_spectra)
+    sp_inds = np.asarray(sp_inds)
+    sp_positions = np.empty(imzml_reader.n_spectra, np.int64)
+    sp_positions[sp_inds] = np.arange(len(sp_inds))
+
+    # Pre-allocate lists of mz & int arrays
+    mz_arrays = [np.array([], dtype=imzml_reader.mz_precision)] * len(sp_inds)
+    int_arrays = [np.array([], dtype=np.float32)] * len(sp_inds)
+    sp_lens = np.zeros(len(sp_inds), np.int64)
+
+    # Read chunks large enough for the range reader to run requests at its maximum concurrency.
+    # Requests within a chunk are run in parallel, so chunks are read sequentially.
+    range_reader = CObjRangeReader(storage, imzml_reader.ibd_cobject)
+    chunk_size = range_reader.max_request_size * range_reader.max_concurrency
+    sp_sizes = _spectra_sizes(imzml_reader)[sp_inds]
+
+    for start, end in _split_by_size(sp_sizes, chunk_size):
+        for sp_i, mzs, ints in imzml_reader.iter_spectra(
+            storage, sp_inds[start:end].tolist(), range_reader=range_reader
+        ):
+            pos = sp_positions[sp_i]
+            mz_arrays[pos] = mzs
+            int_arrays[pos] = ints.astype(np.float32)
+            sp_lens[pos] = len(ints)
+
+    return (
+        np.concatenate(mz_arrays),
+        np.concatenate(int_arrays),
+        sp_lens,
+        range_reader.perf_data('ibd'),
+    )
 
 
-def _sort_spectra(imzml_reader, mzs, ints, sp_lens):
+def _sort_spectra(pixel_indexes, mzs, ints, sp_lens):
     # Specify mergesort explicitly because numpy often chooses heapsort which is super slow
     by_mz = np.argsort(mzs, kind='mergesort')
 
@@ -53,20 +101,27 @@ def _sort_spectra(imzml_reader, mzs, ints, sp_lens):
     ints[:] = ints[by_mz]
     # Build sp_idxs after sorting mzs. Sorting mzs uses the most memory, so it's best to keep
     # sp_idxs in a compacted form with sp_lens until the last minute.
-    sp_idxs = np.empty(len(ints), np.uint32)
-    sp_lens = np.insert(np.cumsum(sp_lens), 0, 0)
-    for sp_idx, start, end in zip(imzml_reader.pixel_indexes, sp_lens[:-1], sp_lens[1:]):
-        sp_idxs[start:end] = sp_idx
+    sp_idxs = np.repeat(np.asarray(pixel_indexes).astype(np.uint32), sp_lens)
     sp_idxs = sp_idxs[by_mz]
     return mzs, ints, sp_idxs
 
 
-def _upload_segments(storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs):
+def _upload_segments(
+    storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs, centr_segm_bounds=None
+):
     # Split into segments no larger than ds_segm_size_mb
     total_n_mz = len(sp_idxs)
-    row_size = (4 if imzml_reader.mz_precision == 'f' else 8) + 4 + 4
-    segm_n = int(np.ceil(total_n_mz * row_size / (ds_segm_size_mb * 2 ** 20)))
-    segm_bounds = np.linspace(0, total_n_mz, segm_n + 1, dtype=np.int64)
+    row_size = _row_size(imzml_reader)
+    est_read_amplification = None
+    if centr_segm_bounds is not None and total_n_mz > 0:
+        plan = plan_ds_segments(mzs, centr_segm_bounds, row_size, ds_segm_size_mb)
+        est_read_amplification = plan.est_read_amplification
+        segm_bounds = np.searchsorted(mzs, plan.bounds[:, 0], side='left')
+        # Planned segments that fall between two peaks are empty and can be dropped
+        segm_bounds = np.unique(np.append(segm_bounds, total_n_mz))
+    else:
+        segm_n = int(np.ceil(total_n_mz * row_size / (ds_segm_size_mb * 2 ** 20)))
+        segm_bounds = np.linspace(0, total_n_mz, segm_n + 1, dtype=np.int64)
     segm_ranges = list(zip(segm_bounds[:-1], segm_bounds[1:]))
     ds_segm_lens = np.diff(segm_bounds)
     ds_segments_bounds = np.column_stack([mzs[segm_bounds[:-1]], mzs[segm_bounds[1:] - 1]])
@@ -81,17 +136,18 @@ def _upload_segments(storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs)
 
     with ThreadPoolExecutor(2) as executor:
         ds_segms_cobjs = list(executor.map(upload_segm, segm_ranges))
-    return ds_segms_cobjs, ds_segments_bounds, ds_segm_lens
+    return ds_segms_cobjs, ds_segments_bounds, ds_segm_lens, est_read_amplification
 
 
 def _load_ds(
     imzml_cobject: CloudObject,
     ibd_cobject: CloudObject,
     ds_segm_size_mb: int,
+    centr_segm_bounds: Optional[np.ndarray],
     *,
     storage: Storage,
     perf: SubtaskProfiler,
-) -> Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray,]:
+) -> Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray, Optional[float]]:
     logger.info('Loading .imzML file...')
     imzml_reader = LithopsImzMLReader(storage, imzml_cobject, ibd_cobject)
     perf.record_entry(
@@ -102,25 +158,210 @@ def _load_ds(
     )
 
     logger.info('Reading spectra')
-    mzs, ints, sp_lens = _load_spectra(storage, imzml_reader)
-    perf.record_entry('read spectra', n_peaks=len(mzs))
+    mzs, ints, sp_lens, read_stats = _load_spectra(storage, imzml_reader)
+    perf.record_entry('read spectra', n_peaks=len(mzs), **read_stats)
 
     logger.info('Sorting spectra')
-    mzs, ints, sp_idxs = _sort_spectra(imzml_reader, mzs, ints, sp_lens)
+    mzs, ints, sp_idxs = _sort_spectra(imzml_reader.pixel_indexes, mzs, ints, sp_lens)
     perf.record_entry('sorted spectra')
 
     logger.info('Uploading segments')
-    ds_segms_cobjs, ds_segments_bounds, ds_segm_lens = _upload_segments(
-        storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs
+    ds_segms_cobjs, ds_segments_bounds, ds_segm_lens, est_read_amplification = _upload_segments(
+        storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs, centr_segm_bounds
+    )
+    perf.record_entry(
+        'uploaded segments',
+        n_segms=len(ds_segms_cobjs),
+        est_read_amplification=est_read_amplification,
+    )
+
+    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens, est_read_amplification
+
+
+def _plan_distributed_load_ds(
+    imzml_cobject: CloudObject,
+    ibd_cobject: CloudObject,
+    ds_segm_size_mb: int,
+    centr_segm_bounds: Optional[np.ndarray],
+    *,
+    storage: Storage,
+    perf: SubtaskProfiler,
+) -> Tuple[LithopsImzMLReader, np.ndarray, List[Tuple[int, int]], Optional[float]]:
+    """Plans dataset segment bounds from a sample of evenly spaced spectra, and splits spectra
+    into chunks for `_partition_spectra`"""
+    logger.info('Loading .imzML file...')
+    imzml_reader = LithopsImzMLReader(storage, imzml_cobject, ibd_cobject)
+    n_peaks = np.sum(imzml_reader.imzml_reader.intensityLengths)
+    perf.record_entry('loaded imzml', n_peaks=n_peaks)
+
+    sample_step = max(int(np.ceil(n_peaks / DISTRIBUTED_SAMPLE_PEAKS)), 1)
+    sample_mzs, _, _, read_stats = _load_spectra(
+        storage, imzml_reader, np.arange(0, imzml_reader.n_spectra, sample_step)
+    )
+    sample_mzs.sort()
+    mz_sample_ratio = len(sample_mzs) / n_peaks if n_peaks else 1.0
+    perf.record_entry('read sample', n_sample_peaks=len(sample_mzs), **read_stats)
+
+    row_size = _row_size(imzml_reader)
+    est_read_amplification = None
+    if len(sample_mzs) == 0:
+        segm_lower_bounds = np.zeros(1)
+    elif centr_segm_bounds is not None:
+        plan = plan_ds_segments(
+            sample_mzs, centr_segm_bounds, row_size, ds_segm_size_mb, mz_sample_ratio
+        )
+        segm_lower_bounds = plan.bounds[:, 0]
+        est_read_amplification = plan.est_read_amplification
+    else:
+        segm_n = int(np.ceil(n_peaks * row_size / (ds_segm_size_mb * 2 ** 20)))
+        segm_lower_bounds = np.quantile(sample_mzs, np.arange(segm_n) / segm_n)
+
+    sp_chunks = _split_by_size(_spectra_sizes(imzml_reader), DISTRIBUTED_CHUNK_SIZE_MB * 2 ** 20)
+    perf.record_entry('planned', n_segms=len(segm_lower_bounds), n_chunks=len(sp_chunks))
+    return imzml_reader, segm_lower_bounds, sp_chunks, est_read_amplification
+
+
+def _partition_spectra(
+    imzml_reader: LithopsImzMLReader,
+    sp_start: int,
+    sp_end: int,
+    segm_lower_bounds: np.ndarray,
+    *,
+    storage: Storage,
+    perf: SubtaskProfiler,
+) -> Tuple[Dict[int, CObj[pd.DataFrame]], np.ndarray, Tuple]:
+    """Reads a range of spectra, and uploads their peaks sorted by mz and split into runs by
+    dataset segment. Returns the runs' cobjects by segment index, the number of peaks
+    in each segment, and the spectra stats (TICs, mz range) gathered by the reader"""
+    mzs, ints, sp_lens, read_stats = _load_spectra(
+        storage, imzml_reader, np.arange(sp_start, sp_end)
     )
-    perf.record_entry('uploaded segments', n_segms=len(ds_segms_cobjs))
+    perf.record_entry('read spectra', n_peaks=len(mzs), **read_stats)
+    spectra_stats = imzml_reader.get_spectra_stats(np.arange(sp_start, sp_end))
+
+    mzs, ints, sp_idxs = _sort_spectra(
+        imzml_reader.pixel_indexes[sp_start:sp_end], mzs, ints, sp_lens
+    )
+    perf.record_entry('sorted spectra')
+
+    run_bounds = np.searchsorted(mzs, segm_lower_bounds[1:], side='left')
+    run_bounds = np.concatenate([[0], run_bounds, [len(mzs)]])
+    run_lens = np.diff(run_bounds)
+
+    def upload_run(segm_i):
+        start, end = run_bounds[segm_i], run_bounds[segm_i + 1]
+        df = pd.DataFrame(
+            {'mz': mzs[start:end], 'int': ints[start:end], 'sp_i': sp_idxs[start:end]}
+        )
+        return segm_i, save_cobj(storage, df)
+
+    with ThreadPoolExecutor(8) as executor:
+        runs_cobjs = dict(executor.map(upload_run, np.flatnonzero(run_lens).tolist()))
+    perf.record_entry('uploaded runs', n_runs=len(runs_cobjs))
+
+    return runs_cobjs, run_lens, spectra_stats
+
+
+def _merge_runs(
+    runs_cobjs: List[CObj[pd.DataFrame]],
+    first_row: int,
+    max_segm_rows: int,
+    *,
+    storage: Storage,
+    perf: SubtaskProfiler,
+) -> List[Tuple[CObj[pd.DataFrame], Tuple[float, float], int]]:
+    """Merges the runs of one dataset segment. Runs must be in the order of their spectra so that
+    peaks with equal mzs are ordered the same way as in `_load_ds`. The segment is split further
+    if the sample-based plan underestimated its size."""
+    segm = pd.concat(load_cobjs(storage, runs_cobjs), ignore_index=True)
+    perf.record_entry('loaded runs', n_runs=len(runs_cobjs), n_peaks=len(segm))
+
+    by_mz = np.argsort(segm.mz.values, kind='mergesort')
+    mzs, ints, sp_idxs = segm.mz.values[by_mz], segm.int.values[by_mz], segm.sp_i.values[by_mz]
+    del segm
+    perf.record_entry('sorted runs')
+
+    segm_n = max(int(np.ceil(len(mzs) / max_segm_rows)), 1)
+    sub_segm_bounds = np.linspace(0, len(mzs), segm_n + 1, dtype=np.int64)
+    results = []
+    for start, end in zip(sub_segm_bounds[:-1], sub_segm_bounds[1:]):
+        df = pd.DataFrame(
+            {'mz': mzs[start:end], 'int': ints[start:end], 'sp_i': sp_idxs[start:end]},
+            index=pd.RangeIndex(first_row + start, first_row + end),
+        )
+        results.append((save_cobj(storage, df), (mzs[start], mzs[end - 1]), end - start))
+    perf.record_entry('uploaded segments', n_segms=len(results))
+    return results
 
-    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens
+
+def _load_ds_distributed(
+    executor: Executor,
+    imzml_cobject: CloudObject,
+    ibd_cobject: CloudObject,
+    ds_segm_size_mb: int,
+    centr_segm_bounds: Optional[np.ndarray],
+) -> Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray, Optional[float]]:
+    """Loads the dataset without ever holding all of it in one activation: each activation of
+    the first stage partitions the peaks of a range of spectra into runs by the planned segment
+    bounds, and each activation of the second stage merges the runs of one segment."""
+    imzml_reader, segm_lower_bounds, sp_chunks, est_read_amplification = executor.call(
+        _plan_distributed_load_ds,
+        (imzml_cobject, ibd_cobject, ds_segm_size_mb, centr_segm_bounds),
+        runtime_memory=4096,
+    )
+
+    # Reading, sorting & uploading needs approximately 3x the chunk size
+    runs_cobjs, runs_lens, spectra_stats = executor.map_unpack(
+        _partition_spectra,
+        [(imzml_reader, start, end, segm_lower_bounds) for start, end in sp_chunks],
+        runtime_memory=DISTRIBUTED_CHUNK_SIZE_MB * 3 + 512,
+    )
+    # The reader was only used to read a sample of the spectra, so it needs the TICs and mz range
+    # of all spectra for the dataset diagnostics
+    for (start, end), chunk_spectra_stats in zip(sp_chunks, spectra_stats):
+        imzml_reader.update_spectra_stats(np.arange(start, end), chunk_spectra_stats)
+
+    segm_lens = np.sum(runs_lens, axis=0)
+    segm_first_rows = np.cumsum(segm_lens) - segm_lens
+    max_segm_rows = int(ds_segm_size_mb * 2 ** 20 / _row_size(imzml_reader))
+    merge_args = [
+        (
+            [chunk_runs[segm_i] for chunk_runs in runs_cobjs if segm_i in chunk_runs],
+            int(segm_first_rows[segm_i]),
+            max_segm_rows,
+        )
+        for segm_i in np.flatnonzero(segm_lens).tolist()
+    ]
+    # The loaded runs, their concatenation, the sorted copy and the argsort indexes are all held
+    # at once while merging. Segments can be larger than planned, as the plan is based on a sample.
+    row_size = _row_size(imzml_reader)
+    max_segm_size_mb = np.max(segm_lens, initial=0) * (3 * row_size + 8) / 2 ** 20
+    segms = executor.map_concat(_merge_runs, merge_args, runtime_memory=512 + int(max_segm_size_mb))
+    executor.storage.delete_cloudobjects(
+        [cobj for chunk_runs in runs_cobjs for cobj in chunk_runs.values()]
+    )
+
+    ds_segms_cobjs = [cobj for cobj, _, _ in segms]
+    ds_segments_bounds = np.array([bounds for _, bounds, _ in segms]).reshape(-1, 2)
+    ds_segm_lens = np.array([n_rows for _, _, n_rows in segms], dtype=np.int64)
+    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens, est_read_amplification
 
 
 def load_ds(
-    executor: Executor, imzml_cobject: CloudObject, ibd_cobject: CloudObject, ds_segm_size_mb: int
-) -> Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray,]:
+    executor: Executor,
+    imzml_cobject: CloudObject,
+    ibd_cobject: CloudObject,
+    ds_segm_size_mb: int,
+    centr_segm_bounds: Optional[np.ndarray] = None,
+    distributed: Optional[bool] = None,
+) -> Tuple[LithopsImzMLReader, np.ndarray, List[CObj[pd.DataFrame]], np.ndarray, Optional[float]]:
+    """If `centr_segm_bounds` is provided, dataset segment bounds are planned to minimize the
+    data read by centroid segments reading these mz ranges, and the estimated read amplification
+    is returned. Otherwise, the dataset is split into equally sized segments.
+
+    If `distributed` is True, the dataset is loaded by many activations that each hold only part
+    of it, with segment bounds planned from a sample of the spectra. By default this is only done
+    for datasets that are too large to be loaded by a single serverless activation."""
     try:
         ibd_head = executor.storage.head_object(ibd_cobject.bucket, ibd_cobject.key)
         ibd_size_mb = int(ibd_head['content-length']) / 1024 // 1024
@@ -131,22 +372,44 @@ def load_ds(
     # Guess the amount of memory needed. For the majority of datasets (no zero-intensity peaks,
     # separate m/z arrays per spectrum) approximately 3x the ibd file size is used during the
     # most memory-intense part (sorting the m/z array).
-    if ibd_size_mb * 3 + 512 < 4096:
-        logger.debug(f'Found {ibd_size_mb}MB .ibd file. Trying serverless load_ds')
-        runtime_memory = 4096
+    is_small_dataset = ibd_size_mb * 3 + 512 < 4096
+    if distributed is None:
+        distributed = not is_small_dataset
+
+    if distributed:
+        logger.debug(f'Found {ibd_size_mb}MB .ibd file. Using distributed load_ds')
+        (
+            imzml_reader,
+            ds_segments_bounds,
+            ds_segms_cobjs,
+            ds_segm_lens,
+            est_read_amplification,
+        ) = _load_ds_distributed(
+            executor, imzml_cobject, ibd_cobject, ds_segm_size_mb, centr_segm_bounds
+        )
     else:
-        logger.debug(f'Found {ibd_size_mb}MB .ibd file. Using VM-based load_ds')
-        runtime_memory = 32768
-
-    imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = executor.call(
-        _load_ds,
-        (imzml_cobject, ibd_cobject, ds_segm_size_mb),
-        runtime_memory=runtime_memory,
-    )
+        if is_small_dataset:
+            logger.debug(f'Found {ibd_size_mb}MB .ibd file. Trying serverless load_ds')
+            runtime_memory = 4096
+        else:
+            logger.debug(f'Found {ibd_size_mb}MB .ibd file. Using VM-based load_ds')
+            runtime_memory = 32768
+
+        (
+            imzml_reader,
+            ds_segments_bounds,
+            ds_segms_cobjs,
+            ds_segm_lens,
+            est_read_amplification,
+        ) = executor.call(
+            _load_ds,
+            (imzml_cobject, ibd_cobject, ds_segm_size_mb, centr_segm_bounds),
+            runtime_memory=runtime_memory,
+        )
 
     logger.info(f'Segmented dataset chunks into {len(ds_segms_cobjs)} segments')
 
-    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens
+    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens, est_read_amplification
 
 
 def validate_ds_segments(fexec, imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens):
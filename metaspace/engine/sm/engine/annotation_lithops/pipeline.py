@@ -5,20 +5,27 @@ from typing import List, Tuple, Optional, Dict
 
 import numpy as np
 import pandas as pd
+from lithops.storage import Storage
 from lithops.storage.utils import CloudObject
 
 from sm.engine.annotation.imzml_reader import LithopsImzMLReader
 from sm.engine.annotation_lithops.annotate import process_centr_segments
-from sm.engine.annotation_lithops.build_moldb import InputMolDb, DbFDRData
-from sm.engine.annotation_lithops.cache import PipelineCacher, use_pipeline_cache
+from sm.engine.annotation_lithops.build_moldb import InputMolDb, DbFDRData, build_moldb
+from sm.engine.annotation_lithops.cache import (
+    DSSegmentsCache,
+    PipelineCacher,
+    use_pipeline_cache,
+)
 from sm.engine.annotation_lithops.calculate_centroids import calculate_centroids, validate_centroids
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import CObj, iter_cobjs_with_prefetch
+from sm.engine.annotation_lithops.ion_metrics_cache import IonMetricsCacheEntry
 from sm.engine.annotation_lithops.load_ds import load_ds, validate_ds_segments
 from sm.engine.annotation_lithops.moldb_pipeline import get_moldb_centroids
 from sm.engine.annotation_lithops.prepare_results import filter_results_and_make_pngs
 from sm.engine.annotation_lithops.run_fdr import run_fdr
 from sm.engine.annotation_lithops.segment_centroids import (
+    estimate_centr_segments_mz_bounds,
     segment_centroids,
     validate_centroid_segments,
 )
@@ -42,6 +49,11 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
     db_segms_cobjs: List[CObj[pd.DataFrame]]
     formula_metrics_df: pd.DataFrame
     images_df: pd.DataFrame
+    stored_metrics_df: pd.DataFrame
+    stored_images_df: pd.DataFrame
+    metrics_skipped_n: int
+    ds_read_amplification_est: Optional[float]
+    ds_read_amplification: float
     fdrs: Dict[int, pd.DataFrame]
     results_dfs: Dict[int, pd.DataFrame]
     png_cobjs: List[CObj[List[Tuple[int, bytes]]]]
@@ -57,7 +69,21 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
         cache_key=None,
         use_db_cache=True,
         use_db_mutex=True,
+        ion_metrics_key: Optional[str] = None,
+        use_ds_segments_cache: Optional[bool] = None,
     ):
+        """
+        Args
+        -----
+        ion_metrics_key: If set, metrics & images of annotated ions are stored under this key
+            (combined with the DS config), and ions that already have stored results aren't
+            annotated again. This makes reprocessing after adding databases much faster.
+            Use a key that changes if the dataset's input files change.
+        use_ds_segments_cache: Reuse dataset segments from previous jobs with the same input files
+            and segment size, e.g. when a dataset is reprocessed after its metadata changed.
+            The segments of every newly loaded dataset are copied into the cache, so this is off
+            unless enabled here or with `use_ds_segments_cache` in the Lithops config
+        """
         lithops_config = lithops_config or SMConfig.get_conf()['lithops']
         self.lithops_config = lithops_config
         self._db = DB()
@@ -77,25 +103,57 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
         else:
             self.cacher = None
 
+        if ion_metrics_key is not None:
+            self.ion_metrics_cache: Optional[IonMetricsCacheEntry] = IonMetricsCacheEntry(
+                self.executor,
+                lithops_config['sm_storage'],
+                ion_metrics_key,
+                ds_config,
+                use_db_mutex=use_db_mutex,
+            )
+        else:
+            self.ion_metrics_cache = None
+
+        if use_ds_segments_cache is None:
+            use_ds_segments_cache = lithops_config.get('use_ds_segments_cache', False)
+        if use_ds_segments_cache:
+            self.ds_segments_cache: Optional[DSSegmentsCache] = DSSegmentsCache(
+                self.storage, lithops_config
+            )
+        else:
+            self.ds_segments_cache = None
+
         self.use_db_cache = use_db_cache
         self.use_db_mutex = use_db_mutex
         self.ds_segm_size_mb = 128
 
     def __call__(
-        self, debug_validate=False, use_cache=True
+        self, debug_validate=False, use_cache=True, use_ion_metrics_cache=True
     ) -> Tuple[Dict[int, pd.DataFrame], List[CObj[List[Tuple[int, bytes]]]]]:
         # pylint: disable=unexpected-keyword-arg
-        self.prepare_moldb(debug_validate=debug_validate)
+        if self.ion_metrics_cache is not None:
+            self.prepare_moldb_incremental(
+                debug_validate=debug_validate, use_ion_metrics_cache=use_ion_metrics_cache
+            )
+        else:
+            self.prepare_moldb(debug_validate=debug_validate)
 
-        self.load_ds(use_cache=use_cache)
-        if debug_validate:
-            self.validate_load_ds()
+        if self.peaks_cobjs:
+            self.load_ds(use_cache=use_cache)
+            if debug_validate:
+                self.validate_load_ds()
 
-        self.segment_centroids(use_cache=use_cache)
-        if debug_validate:
-            self.validate_segment_centroids()
+            self.segment_centroids(use_cache=use_cache)
+            if debug_validate:
+                self.validate_segment_centroids()
 
-        self.annotate(use_cache=use_cache)
+            self.annotate(use_cache=use_cache)
+        else:
+            logger.info('All ions have stored metrics, skipping annotation')
+            self.load_imzml_reader(use_cache=use_cache)
+
+        if self.ion_metrics_cache is not None:
+            self.merge_stored_ion_metrics()
         self.run_fdr(use_cache=use_cache)
         self.prepare_results(use_cache=use_cache)
 
@@ -112,6 +170,31 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             use_db_mutex=self.use_db_mutex,
         )
 
+    def prepare_moldb_incremental(self, debug_validate=False, use_ion_metrics_cache=True):
+        """Builds the databases, but only calculates centroids for ions that don't have
+        stored metrics"""
+        assert self.ion_metrics_cache is not None
+        if not use_ion_metrics_cache:
+            self.ion_metrics_cache.clear()
+
+        formula_cobjs, self.db_data_cobjs = build_moldb(self.executor, self.ds_config, self.moldbs)
+        (
+            self.formula_cobjs,
+            self.stored_metrics_df,
+            self.stored_images_df,
+        ) = self.ion_metrics_cache.split_formulas(formula_cobjs)
+        logger.info(
+            f'Reusing stored metrics of {len(self.stored_metrics_df)} ions, '
+            f'annotating {len(self.formula_cobjs)} formula segments'
+        )
+
+        if self.formula_cobjs:
+            self.calculate_centroids()
+            if debug_validate:
+                self.validate_calculate_centroids()
+        else:
+            self.peaks_cobjs = []
+
     @use_pipeline_cache
     def calculate_centroids(self):
         self.peaks_cobjs = calculate_centroids(
@@ -123,12 +206,55 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
 
     @use_pipeline_cache
     def load_ds(self):
-        (
-            self.imzml_reader,
-            self.ds_segments_bounds,
-            self.ds_segms_cobjs,
-            self.ds_segm_lens,
-        ) = load_ds(self.executor, self.imzml_cobject, self.ibd_cobject, self.ds_segm_size_mb)
+        cached = None
+        segments_key = None
+        if self.ds_segments_cache is not None:
+            segments_key = self.ds_segments_cache.entry_key(
+                self.imzml_cobject, self.ibd_cobject, self.ds_segm_size_mb
+            )
+            if segments_key is None:
+                logger.info('Not caching dataset segments as the input files have no ETags')
+            else:
+                cached = self.ds_segments_cache.load(segments_key, self.ibd_cobject)
+
+        if cached is not None:
+            logger.info(f'Loaded dataset segments from cache entry {segments_key}')
+            (
+                self.imzml_reader,
+                self.ds_segments_bounds,
+                self.ds_segms_cobjs,
+                self.ds_segm_lens,
+            ) = cached
+            # The segments were planned for the centroids of the job that cached them
+            self.ds_read_amplification_est = None
+        else:
+            centr_segm_bounds = estimate_centr_segments_mz_bounds(
+                self.executor, self.peaks_cobjs, self.isocalc_wrapper
+            )
+            (
+                self.imzml_reader,
+                self.ds_segments_bounds,
+                self.ds_segms_cobjs,
+                self.ds_segm_lens,
+                self.ds_read_amplification_est,
+            ) = load_ds(
+                self.executor,
+                self.imzml_cobject,
+                self.ibd_cobject,
+                self.ds_segm_size_mb,
+                centr_segm_bounds,
+            )
+            if self.ds_segments_cache is not None and segments_key is not None:
+                self.ds_segments_cache.save(
+                    self.executor,
+                    segments_key,
+                    (
+                        self.imzml_reader,
+                        self.ds_segments_bounds,
+                        self.ds_segms_cobjs,
+                        self.ds_segm_lens,
+                    ),
+                )
 
         self.is_intensive_dataset = len(self.ds_segms_cobjs) * self.ds_segm_size_mb > 5000
 
@@ -148,9 +274,11 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.peaks_cobjs,
             self.ds_segms_cobjs,
             self.ds_segments_bounds,
+            self.ds_segm_lens,
             self.ds_segm_size_mb,
             self.is_intensive_dataset,
             self.isocalc_wrapper,
+            self.ds_read_amplification_est,
         )
         logger.info(f'Segmented centroids chunks into {len(self.db_segms_cobjs)} segments')
 
@@ -164,7 +292,7 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
 
     @use_pipeline_cache
     def annotate(self):
-        self.formula_metrics_df, self.images_df = process_centr_segments(
+        self.formula_metrics_df, self.images_df, annotate_stats = process_centr_segments(
             self.executor,
             self.ds_segms_cobjs,
             self.ds_segments_bounds,
@@ -175,7 +303,48 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.ds_segm_size_mb,
             self.is_intensive_dataset,
         )
+        self.metrics_skipped_n = annotate_stats['metrics_skipped']
+        self.ds_read_amplification = annotate_stats['ds_rows_read'] / max(
+            annotate_stats['ds_rows_needed'], 1
+        )
         logger.info(f'Metrics calculated: {self.formula_metrics_df.shape[0]}')
+        logger.info(
+            f'Dataset segments read amplification: estimated {self.ds_read_amplification_est}, '
+            f'actual {self.ds_read_amplification:.2f}'
+        )
+
+    @use_pipeline_cache
+    def load_imzml_reader(self):
+        """Loads the dataset's metadata without loading the spectra, for when no ions need
+        to be annotated"""
+        imzml_cobject, ibd_cobject = self.imzml_cobject, self.ibd_cobject
+
+        def _load_imzml_reader(*, storage: Storage):
+            return LithopsImzMLReader(storage, imzml_cobject, ibd_cobject)
+
+        self.imzml_reader = self.executor.call(_load_imzml_reader, (), runtime_memory=4096)
+        spectra_stats = self.ion_metrics_cache.load_spectra_stats()
+        if spectra_stats is not None:
+            self.imzml_reader.update_spectra_stats(
+                np.arange(self.imzml_reader.n_spectra), spectra_stats
+            )
+        self.formula_metrics_df = self.stored_metrics_df.iloc[:0]
+        self.images_df = self.stored_images_df.iloc[:0]
+        self.metrics_skipped_n = 0
+        self.ds_read_amplification_est = None
+        self.ds_read_amplification = 1.0
+
+    def merge_stored_ion_metrics(self):
+        """Stores the results of newly annotated ions, and adds the stored results of the other
+        ions to `formula_metrics_df` and `images_df`"""
+        assert self.ion_metrics_cache is not None
+        if self.formula_cobjs:
+            self.ion_metrics_cache.save(self.formula_cobjs, self.formula_metrics_df, self.images_df)
+            self.ion_metrics_cache.save_spectra_stats(self.imzml_reader)
+        self.formula_metrics_df = pd.concat([self.formula_metrics_df, self.stored_metrics_df])
+        self.images_df = pd.concat(
+            [self.images_df.assign(chunk_formula_i=self.images_df.index), self.stored_images_df]
+        )
 
     @use_pipeline_cache
     def run_fdr(self):
@@ -1,6 +1,6 @@
 import logging
 from collections import defaultdict
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import numpy as np
 import pandas as pd
@@ -8,44 +8,79 @@ from lithops.storage import Storage
 
 from sm.engine.annotation.imzml_reader import LithopsImzMLReader
 from sm.engine.annotation_lithops.build_moldb import InputMolDb
+from sm.engine.annotation_lithops.cost_model import CostModel
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import save_cobj, iter_cobjs_with_prefetch
+from sm.engine.annotation_lithops.image_chunks import load_image_chunk_formulas
+from sm.engine.annotation_lithops.io import save_cobj, iter_with_prefetch
 from sm.engine.annotation.png_generator import PngGenerator
 
 logger = logging.getLogger('annotation-pipeline')
 
 
-def _split_png_jobs(image_tasks_df, w, h):
-    # Guess the cost per imageset, and split into relatively even chunks.
-    # This is a quick attempt and needs review
-    # This assumes they're already sorted by cobj, and factors in:
-    # * Number of populated pixels (because very sparse images should be much faster to encode)
-    # * Total image size (because even empty pixels have some cost)
-    # * Cost of loading a new cobj
-    # * Constant overhead per image
+MAX_PNG_JOBS = 100
+# PNG generation time per activation that the cost model should aim for, if available
+TARGET_PNG_JOB_TIME_S = 60
+
+
+def _split_png_jobs(image_tasks_df, w, h, cost_model: Optional[CostModel] = None):
+    """Splits formulas into jobs of approximately equal cost, keeping them sorted by cobj.
+    Returns the jobs and their cost factors.
+
+    If the cost model has a model for `save_png_chunk`, it's used to predict the cost of each
+    formula and the number of jobs. Otherwise the cost is guessed from:
+    * Number of populated pixels (because very sparse images should be much faster to encode)
+    * Total image size (because even empty pixels have some cost)
+    * Cost of loading a new cobj
+    * Constant overhead per image"""
     cobj_keys = [cobj.key for cobj in image_tasks_df.cobj]
     cobj_changed = np.array(
-        [(i == 0 or key == cobj_keys[i - 1]) for i, key in enumerate(cobj_keys)]
+        [(i == 0 or key != cobj_keys[i - 1]) for i, key in enumerate(cobj_keys)], dtype=bool
+    )
+    factors = pd.DataFrame(
+        {
+            'n_formulas': 1,
+            'n_pixels': image_tasks_df.n_pixels.values,
+            'image_area': w * h,
+            'n_cobjs': cobj_changed.astype(np.int64),
+        },
+        index=image_tasks_df.index,
+    )
+
+    model = cost_model.stage_models.get('save_png_chunk') if cost_model else None
+    if model is not None:
+        costs = model.variable_cost(factors)
+        total_cost = costs.sum()
+        n_jobs = cost_model.n_jobs_for_target_time(
+            'save_png_chunk', factors.sum().to_dict(), TARGET_PNG_JOB_TIME_S
+        )
+    else:
+        costs = factors.n_pixels.values + (w * h) / 5 + cobj_changed * 100000 + 1000
+        total_cost = costs.sum()
+        n_jobs = int(np.ceil(total_cost / 1e8))
+    n_jobs = int(np.clip(n_jobs, 1, MAX_PNG_JOBS))
+
+    job_bound_vals = np.linspace(0, total_cost * (1 + 1e-9) + 1e-9, n_jobs + 1)
+    job_bound_idxs = np.searchsorted(np.cumsum(costs), job_bound_vals)
+    job_ranges = [
+        (start, end) for start, end in zip(job_bound_idxs[:-1], job_bound_idxs[1:]) if start != end
+    ]
+    jobs = [(image_tasks_df.iloc[start:end],) for start, end in job_ranges]
+    job_factors = pd.DataFrame(
+        [factors.iloc[start:end].sum() for start, end in job_ranges], columns=factors.columns
     )
-    image_tasks_df['cost'] = image_tasks_df.n_pixels + (w * h) / 5 + cobj_changed * 100000 + 1000
-    total_cost = image_tasks_df.cost.sum()
-    n_jobs = int(np.ceil(np.clip(total_cost / 1e8, 1, 100)))
-    job_bound_vals = np.linspace(0, total_cost + 1, n_jobs + 1)
-    job_bound_idxs = np.searchsorted(np.cumsum(image_tasks_df.cost), job_bound_vals)
-    jobs = [
-        (image_tasks_df.iloc[start:end],)
-        for start, end in zip(job_bound_idxs[:-1], job_bound_idxs[1:])
-        if start != end
+    # Every job loads its first cobj, even if the previous job already loaded it
+    job_factors['n_cobjs'] = [
+        factors.n_cobjs.iloc[start + 1 : end].sum() + 1 for start, end in job_ranges
     ]
     if jobs:
-        job_costs = [df.cost.sum() for df, in jobs]
+        job_costs = [costs[start:end].sum() for start, end in job_ranges]
         logger.debug(
             f'Generated {len(jobs)} PNG jobs, min cost: {np.min(job_costs)}, '
             f'max cost: {np.max(job_costs)}, total cost: {total_cost}'
         )
     else:
         logger.debug('No PNG jobs generated - probably no annotations')
-    return jobs
+    return jobs, job_factors
 
 
 def filter_results_and_make_pngs(
@@ -69,25 +104,37 @@ def filter_results_and_make_pngs(
         all_formula_is.update(results_dfs[moldb_id].index)
 
     image_tasks_df = images_df[images_df.index.isin(all_formula_is)].copy()
-    jobs = _split_png_jobs(image_tasks_df, imzml_reader.w, imzml_reader.h)
+    jobs, job_factors = _split_png_jobs(
+        image_tasks_df, imzml_reader.w, imzml_reader.h, fexec.cost_model
+    )
     png_generator = PngGenerator(imzml_reader.mask)
 
     def save_png_chunk(df: pd.DataFrame, *, storage: Storage):
         pngs = []
         groups = defaultdict(lambda: [])
-        for formula_i, cobj in df.cobj.items():
-            groups[cobj].append(formula_i)
+        # Images reused from the ion metrics cache are stored under the formula_i of the run
+        # that made their chunk
+        chunk_formula_is = df.chunk_formula_i if 'chunk_formula_i' in df.columns else df.index
+        for formula_i, cobj, chunk_formula_i in zip(df.index, df.cobj, chunk_formula_is):
+            groups[cobj].append((formula_i, chunk_formula_i))
 
-        image_dict_iter = iter_cobjs_with_prefetch(storage, list(groups.keys()))
+        # Only the images of this job's formulas are downloaded from each chunk
+        image_dict_iter = iter_with_prefetch(
+            lambda group: load_image_chunk_formulas(
+                storage, group[0], [chunk_formula_i for _, chunk_formula_i in group[1]]
+            ),
+            groups.items(),
+            prefetch=1,
+        )
         for image_dict, formula_is in zip(image_dict_iter, groups.values()):
-            for formula_i in formula_is:
+            for formula_i, chunk_formula_i in formula_is:
                 formula_pngs = [
                     png_generator.generate_png(img.toarray()) if img is not None else None
-                    for img in image_dict[formula_i]
+                    for img in image_dict[chunk_formula_i]
                 ]
                 pngs.append((formula_i, formula_pngs))
         return save_cobj(storage, pngs)
 
-    png_cobjs = fexec.map(save_png_chunk, jobs, include_modules=['png'])
+    png_cobjs = fexec.map(save_png_chunk, jobs, cost_factors=job_factors, include_modules=['png'])
 
     return results_dfs, png_cobjs
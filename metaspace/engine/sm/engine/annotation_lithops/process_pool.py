@@ -0,0 +1,115 @@
+"""Process pool backend for `Executor`, for running the Lithops pipeline on a single large machine
+without Docker or Lithops' localhost executor.
+
+Workers are forked from the driver, so the function and its arguments are inherited rather than
+serialized, which also allows closures that can't be pickled. Results are pickled back to the
+driver, with large numpy arrays (including the columns of DataFrames) passed through shared memory
+instead of the result pipe.
+"""
+import io
+import os
+import pickle
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# Smaller arrays are cheaper to send through the result pipe
+SHARED_MEMORY_MIN_BYTES = 2 ** 20
+
+# Job inherited by forked workers: (func, func_args, func_kwargs)
+_forked_job: Optional[Tuple[Callable, Sequence, Dict]] = None
+
+
+def _attach_shared_array(name: str, shape: Tuple[int, ...], dtype: str) -> np.ndarray:
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class _SharedArrayPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.nbytes < SHARED_MEMORY_MIN_BYTES:
+            return NotImplemented
+        if obj.dtype.hasobject or not obj.flags.c_contiguous and not obj.flags.f_contiguous:
+            return NotImplemented
+
+        shm = SharedMemory(create=True, size=obj.nbytes)
+        # The driver unlinks the block after reading it, so this process's resource tracker
+        # shouldn't clean it up when the worker exits
+        resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=protected-access
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+        shm.close()
+        return _attach_shared_array, (shm.name, obj.shape, obj.dtype.str)
+
+
+def dumps_with_shared_arrays(obj: Any) -> bytes:
+    buf = io.BytesIO()
+    _SharedArrayPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buf.getvalue()
+
+
+def _init_forked_worker():
+    # Storage.put_cloudobject names temporary objects with a counter that each worker inherits
+    # from the driver, so workers would overwrite each other's objects without a unique prefix
+    session_id = os.environ.get('__LITHOPS_SESSION_ID')
+    worker_id = f'pool-{uuid.uuid4().hex}'
+    os.environ['__LITHOPS_SESSION_ID'] = f'{session_id}/{worker_id}' if session_id else worker_id
+
+
+def _run_forked_item(i: int) -> bytes:
+    assert _forked_job is not None, 'Process pool workers must be forked from the driver'
+    func, func_args, func_kwargs = _forked_job
+    return dumps_with_shared_arrays(func(*func_args[i], **func_kwargs))
+
+
+def available_memory_mb() -> int:
+    """Memory that can be used by new processes without swapping, including reclaimable caches"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 2 ** 10
+    except OSError:
+        pass
+    # Free memory only, which underestimates what's available as it excludes the page cache
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2 ** 20
+
+
+def run_in_process_pool(
+    func: Callable, func_args: Sequence, func_kwargs: Dict, n_workers: int
+) -> Tuple[List[Any], Dict[int, BaseException]]:
+    """Runs `func(*args, **func_kwargs)` for each item of `func_args` in forked processes.
+    Returns the result of each item (None if it failed) and the exceptions of failed items."""
+    # pylint: disable=global-statement
+    global _forked_job
+    results: List[Any] = [None] * len(func_args)
+    errors: Dict[int, BaseException] = {}
+    _forked_job = (func, func_args, func_kwargs)
+    try:
+        n_workers = max(min(n_workers, len(func_args)), 1)
+        with ProcessPoolExecutor(
+            n_workers, mp_context=get_context('fork'), initializer=_init_forked_worker
+        ) as pool:
+            futures = {pool.submit(_run_forked_item, i): i for i in range(len(func_args))}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = pickle.loads(future.result())
+                except BrokenProcessPool:
+                    # Usually caused by the OOM killer, so treat it as a MemoryError so that
+                    # the item is retried with fewer workers
+                    errors[i] = MemoryError('A worker process terminated abruptly')
+                except Exception as exc:
+                    errors[i] = exc
+    finally:
+        _forked_job = None
+    return results, errors
@@ -4,7 +4,7 @@ import logging
 import math
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -20,8 +20,11 @@ from sm.engine.annotation_lithops.io import (
     load_cobjs,
 )
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from sm.engine.annotation.segment_planner import centr_segments_mz_bounds
 
 MIN_CENTR_SEGMS = 32
+# Annotation time per centroid segment that the cost model should aim for, if available
+TARGET_CENTR_SEGM_TIME_S = 120
 
 logger = logging.getLogger('annotation-pipeline')
 MAX_MZ_VALUE = 10 ** 5
@@ -63,7 +66,17 @@ def define_centr_segments(
     clip_centr_chunks_cobjs: List[CloudObject],
     centr_n: int,
     ds_size_mb: int,
+    ds_segm_lens: np.ndarray,
+    ds_read_amplification_est: Optional[float] = None,
 ):
+    """Chooses the first peak mz lower bounds of centroid segments
+
+    Args
+    -----
+    ds_segm_lens: number of rows in each dataset segment
+    ds_read_amplification_est: estimated ratio of dataset rows read by centroid segments to the
+        rows within their mz ranges, if the dataset segments were planned for these centroids
+    """
     logger.info('Defining centroids segments bounds')
 
     def get_first_peak_mz(idx, cobject, *, storage):
@@ -76,11 +89,28 @@ def define_centr_segments(
         fexec.map(get_first_peak_mz, list(enumerate(clip_centr_chunks_cobjs)), runtime_memory=512)
     )
 
-    data_per_centr_segm_mb = 50
-    peaks_per_centr_segm = 10000
-    centr_segm_n = int(
-        max(ds_size_mb // data_per_centr_segm_mb, centr_n // peaks_per_centr_segm, MIN_CENTR_SEGMS)
+    # Each centroid segment reads every dataset segment it touches in full, so it reads its share
+    # of the dataset inflated by the read amplification, but never less than one dataset segment
+    ds_n_rows = int(np.sum(ds_segm_lens))
+    predicted_centr_segm_n = fexec.cost_model.n_jobs_for_target_time(
+        'process_centr_segment',
+        {'db_segm_len': centr_n, 'ds_segm_len': ds_n_rows * (ds_read_amplification_est or 1)},
+        TARGET_CENTR_SEGM_TIME_S,
+        min_job_factors={'ds_segm_len': ds_n_rows / max(len(ds_segm_lens), 1)},
     )
+    if predicted_centr_segm_n is not None:
+        logger.debug(f'Cost model predicted {predicted_centr_segm_n} centroids segments')
+        centr_segm_n = max(predicted_centr_segm_n, MIN_CENTR_SEGMS)
+    else:
+        data_per_centr_segm_mb = 50
+        peaks_per_centr_segm = 10000
+        centr_segm_n = int(
+            max(
+                ds_size_mb // data_per_centr_segm_mb,
+                centr_n // peaks_per_centr_segm,
+                MIN_CENTR_SEGMS,
+            )
+        )
 
     segm_bounds_q = [i * 1 / centr_segm_n for i in range(0, centr_segm_n)]
     centr_segm_lower_bounds = np.quantile(first_peak_df_mz, segm_bounds_q)
@@ -92,14 +122,44 @@ def define_centr_segments(
     return centr_segm_lower_bounds
 
 
+def estimate_centr_segments_mz_bounds(
+    fexec: Executor, peaks_cobjs: List[CObj[pd.DataFrame]], isocalc_wrapper: IsocalcWrapper
+) -> np.ndarray:
+    """Estimates the mz ranges that centroid segments will read, so that dataset segments can be
+    planned before centroids are segmented. Assumes first-level segmentation by first peak mz
+    quantiles, ignoring the further splitting done by `segment_centroids`."""
+
+    def get_formula_mz_ranges(idx, cobject, *, storage):
+        print(f'Extracting formula mz ranges from centroids dataframe {idx}')
+        centr_df = load_cobj(storage, cobject)
+        centr_df = centr_df[centr_df.mz > 0]
+        first_peak_mzs = centr_df[centr_df.peak_i == 0].mz
+        mz_ranges = centr_df.groupby(level=0).mz.agg(['min', 'max']).loc[first_peak_mzs.index]
+        formula_mz_ranges = np.column_stack(
+            [first_peak_mzs.values, mz_ranges['min'].values, mz_ranges['max'].values]
+        )
+        return formula_mz_ranges, len(centr_df)
+
+    formula_mz_ranges, centr_n = fexec.map_unpack(
+        get_formula_mz_ranges, list(enumerate(peaks_cobjs)), runtime_memory=512
+    )
+    formula_mz_ranges = np.concatenate(formula_mz_ranges)
+    # Same as define_centr_segments, without the dataset size, which isn't known yet
+    peaks_per_centr_segm = 10000
+    centr_segm_n = max(sum(centr_n) // peaks_per_centr_segm, MIN_CENTR_SEGMS)
+    return centr_segments_mz_bounds(*formula_mz_ranges.T, centr_segm_n, isocalc_wrapper)
+
+
 def segment_centroids(
     fexec: Executor,
     peaks_cobjs: List[CObj[pd.DataFrame]],
     ds_segms_cobjs: List[CObj[pd.DataFrame]],
     ds_segms_bounds: np.ndarray,
+    ds_segm_lens: np.ndarray,
     ds_segm_size_mb: int,
     is_intensive_dataset: bool,
     isocalc_wrapper: IsocalcWrapper,
+    ds_read_amplification_est: Optional[float] = None,
 ) -> List[CObj[pd.DataFrame]]:
     # pylint: disable=too-many-locals,too-many-statements
     max_ds_segms_size_per_db_segm_mb = 2560 if is_intensive_dataset else 1536
@@ -114,6 +174,8 @@ def segment_centroids(
         clip_centr_chunks_cobjs,
         centr_n,
         len(ds_segms_cobjs) * ds_segm_size_mb,
+        ds_segm_lens,
+        ds_read_amplification_est,
     )
     first_level_centr_segm_n = min(32, len(centr_segm_lower_bounds))
     centr_segm_lower_bounds = np.array_split(centr_segm_lower_bounds, first_level_centr_segm_n)
@@ -9,7 +9,7 @@ from pyspark import SparkContext, SparkConf
 
 from sm.engine.annotation.acq_geometry import make_acq_geometry
 from sm.engine.annotation.diagnostics import add_diagnostics, extract_dataset_diagnostics
-from sm.engine.annotation.imzml_reader import FSImzMLReader
+from sm.engine.annotation.imzml_reader import FSImzMLReader, MmapImzMLReader
 from sm.engine.annotation.job import (
     del_jobs,
     insert_running_job,
@@ -72,7 +72,7 @@ class AnnotationJob:
 
     def create_imzml_reader(self):
         logger.info('Parsing imzml')
-        return FSImzMLReader(self._ds_data_path)
+        return MmapImzMLReader(self._ds_data_path)
 
     def _run_annotation_jobs(self, imzml_reader, moldbs):
         if moldbs:
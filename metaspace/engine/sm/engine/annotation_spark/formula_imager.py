@@ -1,17 +1,21 @@
 import logging
 import pickle
+from collections import Counter
 from pathlib import Path
-from typing import List, Set
+from typing import List, Optional, Set
 
 import numpy as np
 import pandas as pd
+from pyspark.accumulators import Accumulator
 from pyspark.files import SparkFiles
 from scipy.sparse import coo_matrix
 
 from sm.engine.annotation.formula_validator import (
     make_compute_image_metrics,
+    make_compute_image_metrics_batch,
     formula_image_metrics,
 )
+from sm.engine.annotation_spark.segmenter import load_ds_segment
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 
@@ -21,9 +25,9 @@ logger = logging.getLogger('engine')
 # pylint: disable=too-many-locals
 # this function is compute performance optimized
 def gen_iso_images(ds_segm_it, centr_df, nrows, ncols, isocalc):
-    for ds_segm_df in ds_segm_it:
-        ds_segm_mz_min, _ = isocalc.mass_accuracy_bounds(ds_segm_df.mz.values[0])
-        _, ds_segm_mz_max = isocalc.mass_accuracy_bounds(ds_segm_df.mz.values[-1])
+    for ds_segm in ds_segm_it:
+        ds_segm_mz_min, _ = isocalc.mass_accuracy_bounds(ds_segm.mz[0])
+        _, ds_segm_mz_max = isocalc.mass_accuracy_bounds(ds_segm.mz[-1])
 
         centr_df_slice = centr_df[(centr_df.mz >= ds_segm_mz_min) & (centr_df.mz <= ds_segm_mz_max)]
 
@@ -33,16 +37,16 @@ def gen_iso_images(ds_segm_it, centr_df, nrows, ncols, isocalc):
         centr_ints = centr_df_slice.int.values
 
         lower, upper = isocalc.mass_accuracy_bounds(centr_mzs)
-        lower_inds = np.searchsorted(ds_segm_df.mz.values, lower, 'l')
-        upper_inds = np.searchsorted(ds_segm_df.mz.values, upper, 'r')
+        lower_inds = np.searchsorted(ds_segm.mz, lower, 'l')
+        upper_inds = np.searchsorted(ds_segm.mz, upper, 'r')
 
         # Note: consider going in the opposite direction so that
         # formula_image_metrics can check for the first peak images instead of the last
         for i, (lo_i, up_i) in enumerate(zip(lower_inds, upper_inds)):
             m = None
             if up_i - lo_i > 0:
-                data = ds_segm_df.int.values[lo_i:up_i]
-                inds = ds_segm_df.sp_idx.values[lo_i:up_i]
+                data = ds_segm.int[lo_i:up_i]
+                inds = ds_segm.sp_idx[lo_i:up_i]
                 row_inds = inds / ncols
                 col_inds = inds % ncols
                 m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols), copy=True)
@@ -63,18 +67,6 @@ def choose_ds_segments(ds_segments, centr_df, ppm):
     return first_ds_segm_i, last_ds_segm_i
 
 
-def read_ds_segment(segm_path):
-    sp_chunk_list = []
-    try:
-        with open(segm_path, 'rb') as f:
-            while True:
-                sp_chunk_list.append(pickle.load(f))
-    except EOFError:
-        pass
-
-    return pd.concat(sp_chunk_list) if sp_chunk_list else None
-
-
 def read_centroids_segment(segm_path):
     with open(segm_path, 'rb') as f:
         return pickle.load(f)
@@ -82,10 +74,12 @@ def read_centroids_segment(segm_path):
 
 def read_ds_segments(first_segm_i, last_segm_i):
     for ds_segm_i in range(first_segm_i, last_segm_i + 1):
-        segm_path = get_file_path(f'ds_segm_{ds_segm_i:04}.pickle')
-        ds_segm_df = read_ds_segment(segm_path)
-        if ds_segm_df is not None:
-            yield ds_segm_df.sort_values(by='mz')
+        segm_path = get_file_path(f'ds_segm_{ds_segm_i:04}.bin')
+        # Segments are stored sorted by mz and memory-mapped, so centroid segments that overlap
+        # the same dataset segment share its pages instead of each loading and sorting it
+        ds_segm = load_ds_segment(segm_path)
+        if ds_segm is not None:
+            yield ds_segm
 
 
 def get_file_path(name):
@@ -100,10 +94,17 @@ def create_process_segment(
     ds_config: DSConfig,
     target_formula_inds: Set[int],
     targeted_database_formula_inds: Set[int],
+    metrics_skipped_acc: Optional[Accumulator] = None,
 ):
-    compute_metrics = make_compute_image_metrics(
-        sample_area_mask, nrows, ncols, ds_config['image_generation']
-    )
+    metrics_batch_size = ds_config['image_generation'].get('metrics_batch_size')
+    if metrics_batch_size:
+        compute_metrics = make_compute_image_metrics_batch(
+            sample_area_mask, nrows, ncols, ds_config['image_generation']
+        )
+    else:
+        compute_metrics = make_compute_image_metrics(
+            sample_area_mask, nrows, ncols, ds_config['image_generation']
+        )
     isocalc = IsocalcWrapper(ds_config)
     ppm = ds_config['image_generation']['ppm']
     min_px = ds_config['image_generation']['min_px']
@@ -117,6 +118,7 @@ def create_process_segment(
             logger.info(f'Reading centroids segment {segm_i} from {centr_segm_path}')
 
             centr_df = read_centroids_segment(centr_segm_path)
+            metrics_stats: Counter = Counter()
             first_ds_segm_i, last_ds_segm_i = choose_ds_segments(ds_segments, centr_df, ppm)
 
             logger.info(f'Reading dataset segments {first_ds_segm_i}-{last_ds_segm_i}')
@@ -132,7 +134,11 @@ def create_process_segment(
                 targeted_database_formula_inds=targeted_database_formula_inds,
                 n_peaks=n_peaks,
                 min_px=min_px,
+                metrics_batch_size=metrics_batch_size,
+                metrics_stats=metrics_stats,
             )
+            if metrics_skipped_acc is not None:
+                metrics_skipped_acc.add(metrics_stats['skipped'])
             logger.info(f'Segment {segm_i} finished')
         else:
             logger.warning(f'Centroids segment path not found {centr_segm_path}')
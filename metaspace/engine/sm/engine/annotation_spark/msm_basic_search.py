@@ -12,6 +12,7 @@ from pyspark.storagelevel import StorageLevel
 from sm.engine import molecular_db
 from sm.engine.annotation.formula_centroids import CentroidsGenerator
 from sm.engine.annotation.imzml_reader import ImzMLReader
+from sm.engine.annotation.segment_planner import estimate_read_amplification
 from sm.engine.annotation_spark.formula_imager import create_process_segment
 from sm.engine.annotation_spark.segmenter import (
     calculate_centroids_segments_n,
@@ -19,6 +20,8 @@ from sm.engine.annotation_spark.segmenter import (
     check_spectra_quality,
     clip_centroids_df,
     define_ds_segments,
+    estimate_centr_segments_mz_bounds,
+    measure_read_amplification,
     segment_centroids,
     segment_ds,
     spectra_sample_gen,
@@ -38,17 +41,30 @@ def init_fdr(ds_config: DSConfig, moldbs: List[MolecularDB]) -> List[Tuple[Molec
     """Randomly select decoy adducts for each moldb and target adduct."""
 
     isotope_gen_config = ds_config['isotope_generation']
-    logger.info('Selecting decoy adducts')
-    moldb_fdr_list = []
-    for moldb in moldbs:
-        fdr = FDR(
+
+    def make_fdr():
+        return FDR(
             fdr_config=ds_config['fdr'],
             chem_mods=isotope_gen_config['chem_mods'],
             neutral_losses=isotope_gen_config['neutral_losses'],
             target_adducts=isotope_gen_config['adducts'],
             analysis_version=ds_config.get('analysis_version', 1),
         )
-        fdr.decoy_adducts_selection(molecular_db.fetch_formulas(moldb.id))
+
+    logger.info('Selecting decoy adducts')
+    moldb_formulas = [(moldb, molecular_db.fetch_formulas(moldb.id)) for moldb in moldbs]
+    shared_td_table = None
+    if ds_config['fdr'].get('share_decoys'):
+        shared_fdr = make_fdr()
+        shared_fdr.decoy_adducts_selection(
+            list(dict.fromkeys(f for _, formulas in moldb_formulas for f in formulas))
+        )
+        shared_td_table = shared_fdr.td_table
+
+    moldb_fdr_list = []
+    for moldb, formulas in moldb_formulas:
+        fdr = make_fdr()
+        fdr.decoy_adducts_selection(formulas, shared_td_table)
         moldb_fdr_list.append((moldb, fdr))
     return moldb_fdr_list
 
@@ -194,7 +210,14 @@ class MSMSearch:
         logger.debug(f'Cleaning spark workers temp dirs: {set(temp_dir_rdd.collect())}')
         (temp_dir_rdd.map(lambda path: rmtree(path, ignore_errors=True)).collect())
 
-    def define_segments_and_segment_ds(self, sample_ratio=0.05, ds_segm_size_mb=5):
+    def define_segments_and_segment_ds(
+        self, centroids_df=None, sample_ratio=0.05, ds_segm_size_mb=5
+    ):
+        """Reads a sample of spectra, defines dataset segments and segments the dataset.
+
+        If `centroids_df` is provided, segment bounds are planned around the mz ranges of the
+        centroid segments that `clip_and_segment_centroids` will produce.
+        """
         logger.info('Reading spectra sample')
         spectra_n = self._imzml_reader.n_spectra
         sample_size = int(spectra_n * sample_ratio)
@@ -204,16 +227,64 @@ class MSMSearch:
         sample_ints = np.concatenate([ints for sp_id, mzs, ints in spectra_sample])
         check_spectra_quality(sample_mzs, sample_ints)
 
+        centr_segm_bounds = None
+        if centroids_df is not None:
+            centr_df = clip_centroids_df(
+                centroids_df, mz_min=sample_mzs.min(), mz_max=sample_mzs.max()
+            )
+            centr_segm_n = calculate_centroids_segments_n(
+                centr_df, (self._imzml_reader.h, self._imzml_reader.w)
+            )
+            centr_segm_bounds = estimate_centr_segments_mz_bounds(
+                centr_df, centr_segm_n, IsocalcWrapper(self._ds_config)
+            )
+
         actual_sample_ratio = sample_size / spectra_n
         ds_segments = define_ds_segments(
-            sample_mzs, actual_sample_ratio, self._imzml_reader, ds_segm_size_mb=ds_segm_size_mb
+            sample_mzs,
+            actual_sample_ratio,
+            self._imzml_reader,
+            ds_segm_size_mb=ds_segm_size_mb,
+            centr_segm_bounds=centr_segm_bounds,
         )
 
         ds_segments_path = self._ds_data_path / 'ds_segments'
+        segm_config = self._sm_config.get('ds_segmentation', {})
         spectra_per_chunk_n = calculate_chunk_sp_n(
-            sample_mzs.nbytes, sample_size, max_chunk_size_mb=500
+            sample_mzs.nbytes,
+            sample_size,
+            max_chunk_size_mb=segm_config.get('max_chunk_size_mb', 500),
+        )
+        # Segment run files are written to the driver's local disk, so they can only be merged
+        # on executors when running in local mode. Otherwise they're merged in `n_workers`
+        # processes on the driver
+        merge_spark_context = (
+            self._spark_context if self._spark_context.master.startswith('local') else None
+        )
+        segment_ds(
+            self._imzml_reader,
+            spectra_per_chunk_n,
+            ds_segments,
+            ds_segments_path,
+            spark_context=merge_spark_context,
+            n_workers=segm_config.get('n_workers', 1),
         )
-        segment_ds(self._imzml_reader, spectra_per_chunk_n, ds_segments, ds_segments_path)
+
+        if centr_segm_bounds is not None:
+            est_read_amplification = estimate_read_amplification(
+                ds_segments, np.sort(sample_mzs), centr_segm_bounds
+            )
+            read_amplification = measure_read_amplification(
+                ds_segments_path, ds_segments, centr_segm_bounds
+            )
+            logger.info(
+                f'Dataset segments read amplification: estimated {est_read_amplification:.2f}, '
+                f'actual {read_amplification:.2f}'
+            )
+            self._perf.add_extra_data(
+                ds_read_amplification_est=est_read_amplification,
+                ds_read_amplification=read_amplification,
+            )
 
         logger.info('Putting dataset segments to workers')
         self.put_segments_to_workers(ds_segments_path)
@@ -268,17 +339,20 @@ class MSMSearch:
         """
         logger.info('Running molecule search')
 
-        ds_segments = self.define_segments_and_segment_ds(ds_segm_size_mb=20)
-        self._perf.record_entry('segmented ds')
-
         moldb_fdr_list = init_fdr(self._ds_config, self._moldbs)
         ion_formula_map_df = collect_ion_formulas(self._spark_context, moldb_fdr_list)
         self._perf.record_entry('collected ion formulas')
 
         formula_centroids = self._fetch_formula_centroids(ion_formula_map_df)
+        centroids_df = formula_centroids.centroids_df()
         self._perf.record_entry('loaded centroids')
+
+        # Centroids are loaded first, so that dataset segments can be planned around them
+        ds_segments = self.define_segments_and_segment_ds(centroids_df, ds_segm_size_mb=20)
+        self._perf.record_entry('segmented ds')
+
         centr_segm_n = self.clip_and_segment_centroids(
-            centroids_df=formula_centroids.centroids_df(),
+            centroids_df=centroids_df,
             ds_segments=ds_segments,
             ds_dims=(self._imzml_reader.h, self._imzml_reader.w),
         )
@@ -296,6 +370,7 @@ class MSMSearch:
             target_formulas=len(target_formula_inds),
         )
 
+        metrics_skipped_acc = self._spark_context.accumulator(0)
         process_centr_segment = create_process_segment(
             ds_segments,
             self._imzml_reader.mask,
@@ -304,11 +379,13 @@ class MSMSearch:
             self._ds_config,
             target_formula_inds,
             targeted_database_formula_inds,
+            metrics_skipped_acc,
         )
         results_rdd = self.process_segments(centr_segm_n, process_centr_segment)
         formula_metrics_df, formula_images_rdd = merge_results(
             results_rdd, formula_centroids.formulas_df
         )
+        self._perf.add_extra_data(metrics_skipped_n=metrics_skipped_acc.value)
         self.remove_spark_temp_files()
 
         for moldb, fdr in moldb_fdr_list:
@@ -1,12 +1,18 @@
 import logging
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil
+from multiprocessing import get_context
+from pathlib import Path
 from shutil import rmtree
+from typing import List, NamedTuple, Optional
 
 import numpy as np
 import pandas as pd
 
-from sm.engine.annotation.imzml_reader import FSImzMLReader
+from sm.engine.annotation.imzml_reader import FSImzMLReader, MmapImzMLReader
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from sm.engine.annotation.segment_planner import centr_segments_mz_bounds, plan_ds_segments
 from sm.engine.errors import SMError
 
 MAX_MZ_VALUE = 10 ** 5
@@ -16,9 +22,83 @@ ABS_MZ_TOLERANCE_DA = 0.002
 SpIdxDType = np.uint32
 IntensityDType = np.float32
 
+# Dataset segment files consist of a fixed-size header followed by the mz, sp_idx and int columns,
+# each stored contiguously and sorted by mz, so that they can be memory-mapped by readers
+DS_SEGM_MAGIC = b'SMDSSEGM'
+DS_SEGM_VERSION = 1
+DS_SEGM_HEADER_SIZE = 64
+DS_SEGM_HEADER_DTYPE = np.dtype(
+    [('magic', 'S8'), ('version', '<u4'), ('mz_itemsize', '<u4'), ('n_rows', '<u8')]
+)
+DS_SEGM_COLUMNS = ('mz', 'sp_idx', 'int')
+# Max number of rows held in memory per segment while merging sorted runs
+DS_SEGM_MERGE_BUFFER_ROWS = 2 ** 22
+
 logger = logging.getLogger('engine')
 
 
+class DSSegment(NamedTuple):
+    """Columns of a dataset segment, sorted by mz"""
+
+    sp_idx: np.ndarray
+    mz: np.ndarray
+    int: np.ndarray
+
+
+def ds_segment_path(ds_segments_path: Path, segm_i: int) -> Path:
+    return ds_segments_path / f'ds_segm_{segm_i:04}.bin'
+
+
+def _ds_segment_column_dtypes(mz_dtype):
+    return {
+        'mz': np.dtype(mz_dtype),
+        'sp_idx': np.dtype(SpIdxDType),
+        'int': np.dtype(IntensityDType),
+    }
+
+
+def _ds_segment_header(mz_dtype, n_rows):
+    header = np.zeros(1, dtype=DS_SEGM_HEADER_DTYPE)
+    header['magic'] = DS_SEGM_MAGIC
+    header['version'] = DS_SEGM_VERSION
+    header['mz_itemsize'] = np.dtype(mz_dtype).itemsize
+    header['n_rows'] = n_rows
+    return header.tobytes().ljust(DS_SEGM_HEADER_SIZE, b'\0')
+
+
+def _map_ds_segment_columns(path, mz_dtype, n_rows, mode='r'):
+    columns = {}
+    offset = DS_SEGM_HEADER_SIZE
+    for col, dtype in _ds_segment_column_dtypes(mz_dtype).items():
+        columns[col] = np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(n_rows,))
+        offset += n_rows * dtype.itemsize
+    return DSSegment(**columns)
+
+
+def save_ds_segment(path: Path, ds_segm: DSSegment):
+    """Writes dataset segment columns to a file. The columns must already be sorted by mz"""
+    dtypes = _ds_segment_column_dtypes(ds_segm.mz.dtype)
+    with open(path, 'wb') as f:
+        f.write(_ds_segment_header(ds_segm.mz.dtype, len(ds_segm.mz)))
+        for col in DS_SEGM_COLUMNS:
+            np.ascontiguousarray(getattr(ds_segm, col), dtype=dtypes[col]).tofile(f)
+
+
+def load_ds_segment(path: Path) -> Optional[DSSegment]:
+    """Memory-maps dataset segment columns from a file written by `save_ds_segment`.
+    Returns None for empty segments."""
+    header = np.fromfile(path, dtype=DS_SEGM_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != DS_SEGM_MAGIC or header['version'] != DS_SEGM_VERSION:
+        raise SMError(f'Unsupported dataset segment file format: {path}')
+
+    n_rows = int(header['n_rows'])
+    if n_rows == 0:
+        return None
+
+    mz_dtype = {4: np.float32, 8: np.float64}[int(header['mz_itemsize'])]
+    return _map_ds_segment_columns(path, mz_dtype, n_rows)
+
+
 def check_spectra_quality(mz_arr, int_arr):
     err_msgs = []
 
@@ -48,13 +128,28 @@ def spectra_sample_gen(imzml_reader, sample_size):
         yield sp_idx, mzs, ints
 
 
-def define_ds_segments(sample_mzs, sample_ratio, imzml_reader, ds_segm_size_mb=5):
+def define_ds_segments(
+    sample_mzs, sample_ratio, imzml_reader, ds_segm_size_mb=5, centr_segm_bounds=None
+):
+    """Defines dataset segment bounds. If the mz ranges read by centroid segments are known,
+    the bounds are planned to minimize the data read by them, with `ds_segm_size_mb` as the
+    maximum segment size. Otherwise, the bounds are quantiles of the sample mzs."""
     logger.info('Defining dataset segment bounds')
     sp_arr_row_size_b = (
         np.dtype(SpIdxDType).itemsize
         + np.dtype(imzml_reader.mz_precision).itemsize
         + np.dtype(IntensityDType).itemsize
     )
+    if centr_segm_bounds is not None:
+        ds_segments, _ = plan_ds_segments(
+            np.sort(sample_mzs),
+            centr_segm_bounds,
+            sp_arr_row_size_b,
+            max_segm_size_mb=ds_segm_size_mb,
+            mz_sample_ratio=sample_ratio,
+        )
+        return ds_segments
+
     total_mz_n = sample_mzs.shape[0] / sample_ratio  # pylint: disable=unsubscriptable-object
     sp_arr_total_size_mb = sp_arr_row_size_b * total_mz_n / 2 ** 20
 
@@ -71,15 +166,143 @@ def define_ds_segments(sample_mzs, sample_ratio, imzml_reader, ds_segm_size_mb=5
     return ds_segments
 
 
+def _ds_segment_part_path(ds_segments_path, segm_i, part):
+    return ds_segments_path / f'ds_segm_{segm_i:04}.{part}.part'
+
+
 def segment_spectra_chunk(sp_chunk_df, mz_segments, ds_segments_path):
+    """Appends each segment's slice of the mz-sorted chunk as a sorted run to the segment's
+    column part files, and the run length to its runs part file.
+    The runs are merged into the final segment files by `merge_ds_segment_runs`"""
     segm_left_bounds, segm_right_bounds = zip(*mz_segments)
     segm_starts = np.searchsorted(sp_chunk_df.mz.values, segm_left_bounds)
     segm_ends = np.searchsorted(sp_chunk_df.mz.values, segm_right_bounds)
 
     for segm_i, (start, end) in enumerate(zip(segm_starts, segm_ends)):
-        segment_path = ds_segments_path / f'ds_segm_{segm_i:04}.pickle'
-        with open(segment_path, 'ab') as f:
-            pickle.dump(sp_chunk_df.iloc[start:end], f)
+        if end > start:
+            for col in DS_SEGM_COLUMNS:
+                with open(_ds_segment_part_path(ds_segments_path, segm_i, col), 'ab') as f:
+                    sp_chunk_df[col].values[start:end].tofile(f)
+            with open(_ds_segment_part_path(ds_segments_path, segm_i, 'runs'), 'ab') as f:
+                np.array([end - start], dtype=np.uint64).tofile(f)
+
+
+def merge_ds_segment_runs(
+    ds_segments_path: Path,
+    segm_i: int,
+    mz_dtype,
+    runs_paths: Optional[List[Path]] = None,
+    buffer_rows=DS_SEGM_MERGE_BUFFER_ROWS,
+):
+    """Streaming k-way merge of the sorted runs of a segment into the final segment file.
+
+    Runs are read from memory-mapped part files in blocks, and merged rows are written straight
+    into the memory-mapped output file, so at most about `buffer_rows` rows are held in memory
+    regardless of the segment size. In every step, all rows up to the smallest of the blocks'
+    last mz values can be emitted, as no row that comes later in any run can be smaller.
+    Rows are ordered by (mz, run, position in run), so the result is the same as a stable sort of
+    all runs in order.
+
+    Args
+    -----
+    runs_paths: directories with the part files of the runs, by default `ds_segments_path`.
+        Runs with equal mz values are ordered by directory, then by the order of writing
+    """
+    runs_paths = runs_paths or [ds_segments_path]
+    dtypes = _ds_segment_column_dtypes(mz_dtype)
+    run_columns, run_starts, run_ends = [], [], []
+    for runs_path in runs_paths:
+        run_lens_path = _ds_segment_part_path(runs_path, segm_i, 'runs')
+        if run_lens_path.exists():
+            run_lens = np.fromfile(run_lens_path, dtype=np.uint64).astype(np.int64)
+            columns = {
+                col: np.memmap(
+                    _ds_segment_part_path(runs_path, segm_i, col), dtype=dtypes[col], mode='r'
+                )
+                for col in DS_SEGM_COLUMNS
+            }
+            run_columns.extend([columns] * len(run_lens))
+            run_ends.append(np.cumsum(run_lens))
+            run_starts.append(run_ends[-1] - run_lens)
+    cursors = np.concatenate(run_starts or [np.zeros(0, dtype=np.int64)])
+    run_ends = np.concatenate(run_ends or [np.zeros(0, dtype=np.int64)])
+    n_rows = int((run_ends - cursors).sum())
+
+    path = ds_segment_path(ds_segments_path, segm_i)
+    row_size = sum(dtype.itemsize for dtype in dtypes.values())
+    with open(path, 'wb') as f:
+        f.write(_ds_segment_header(mz_dtype, n_rows))
+        f.truncate(DS_SEGM_HEADER_SIZE + n_rows * row_size)
+
+    if n_rows > 0:
+        merged = _map_ds_segment_columns(path, mz_dtype, n_rows, mode='r+')
+        block_rows = max(1, buffer_rows // len(run_columns))
+        merged_n = 0
+        while merged_n < n_rows:
+            active = np.flatnonzero(cursors < run_ends)
+            block_ends = np.minimum(cursors[active] + block_rows, run_ends[active])
+            last_mzs = np.array(
+                [
+                    run_columns[run_i]['mz'][block_end - 1]
+                    for run_i, block_end in zip(active, block_ends)
+                ]
+            )
+            max_mz = last_mzs.min()
+            # The first run whose block ends at max_mz and may have more rows with max_mz after
+            # the block. Rows with max_mz are only emitted from runs up to this one, so that
+            # equal mzs stay in order of run
+            tie_run_i = active[
+                np.flatnonzero((last_mzs == max_mz) & (block_ends < run_ends[active]))[:1]
+            ]
+            tie_run_i = tie_run_i[0] if len(tie_run_i) else len(run_columns)
+
+            blocks = []
+            for run_i, block_end in zip(active, block_ends):
+                columns, start = run_columns[run_i], cursors[run_i]
+                side = 'right' if run_i <= tie_run_i else 'left'
+                end = start + np.searchsorted(columns['mz'][start:block_end], max_mz, side=side)
+                blocks.append([columns[col][start:end] for col in DS_SEGM_COLUMNS])
+                cursors[run_i] = end
+
+            block = [np.concatenate(col_blocks) for col_blocks in zip(*blocks)]
+            order = np.argsort(block[0], kind='stable')
+            for col, values in zip(DS_SEGM_COLUMNS, block):
+                getattr(merged, col)[merged_n : merged_n + len(order)] = values[order]
+            merged_n += len(order)
+
+        for col in DS_SEGM_COLUMNS:
+            getattr(merged, col).flush()
+        del merged, run_columns
+
+    for runs_path in runs_paths:
+        for part in [*DS_SEGM_COLUMNS, 'runs']:
+            _ds_segment_part_path(runs_path, segm_i, part).unlink(missing_ok=True)
+
+
+def merge_ds_segments(
+    segm_n, mz_dtype, ds_segments_path, spark_context=None, runs_paths=None, n_workers=1
+):
+    """Merges the sorted runs of all segments. If `spark_context` is provided, segments are
+    merged in parallel on the Spark executors, which must have access to `ds_segments_path`.
+    Otherwise, they're merged in `n_workers` local processes."""
+    if spark_context is not None:
+        logger.info(f'Merging sorted runs of {segm_n} dataset segments on Spark executors')
+        spark_context.parallelize(range(segm_n), numSlices=segm_n).foreach(
+            lambda segm_i: merge_ds_segment_runs(ds_segments_path, segm_i, mz_dtype, runs_paths)
+        )
+    elif n_workers > 1 and segm_n > 1:
+        logger.info(f'Merging sorted runs of {segm_n} dataset segments in worker processes')
+        with ProcessPoolExecutor(min(n_workers, segm_n), mp_context=get_context('fork')) as pool:
+            futures = [
+                pool.submit(merge_ds_segment_runs, ds_segments_path, segm_i, mz_dtype, runs_paths)
+                for segm_i in range(segm_n)
+            ]
+            for future in futures:
+                future.result()
+    else:
+        logger.info(f'Merging sorted runs of {segm_n} dataset segments')
+        for segm_i in range(segm_n):
+            merge_ds_segment_runs(ds_segments_path, segm_i, mz_dtype, runs_paths)
 
 
 def calculate_chunk_sp_n(sample_mzs_bytes, sample_sp_n, max_chunk_size_mb=500):
@@ -93,20 +316,24 @@ def calculate_chunk_sp_n(sample_mzs_bytes, sample_sp_n, max_chunk_size_mb=500):
 
 
 def fetch_chunk_spectra_data(sp_ids, imzml_reader):
-    sp_idxs_list, mzs_list, ints_list = [], [], []
-    for sp_id, mzs_, ints_ in imzml_reader.iter_spectra(sp_ids):
-        sp_idx = imzml_reader.pixel_indexes[sp_id]
-        sp_idxs_list.append(np.ones_like(mzs_) * sp_idx)
-        mzs_list.append(mzs_)
-        ints_list.append(ints_)
-
-    mzs = np.concatenate(mzs_list)
+    if isinstance(imzml_reader, MmapImzMLReader):
+        peak_sp_ids, mzs, ints = imzml_reader.read_spectra_block(sp_ids)
+        sp_idxs = imzml_reader.pixel_indexes[peak_sp_ids]
+    else:
+        sp_idxs_list, mzs_list, ints_list = [], [], []
+        for sp_id, mzs_, ints_ in imzml_reader.iter_spectra(sp_ids):
+            sp_idx = imzml_reader.pixel_indexes[sp_id]
+            sp_idxs_list.append(np.ones_like(mzs_) * sp_idx)
+            mzs_list.append(mzs_)
+            ints_list.append(ints_)
+        sp_idxs, mzs, ints = map(np.concatenate, [sp_idxs_list, mzs_list, ints_list])
+
     by_mz = np.argsort(mzs)
     sp_chunk_df = pd.DataFrame(
         {
-            'sp_idx': np.concatenate(sp_idxs_list)[by_mz].astype(SpIdxDType),
+            'sp_idx': sp_idxs[by_mz].astype(SpIdxDType),
             'mz': mzs[by_mz].astype(imzml_reader.mz_precision),
-            'int': np.concatenate(ints_list)[by_mz].astype(IntensityDType),
+            'int': ints[by_mz].astype(IntensityDType),
         }
     )
     return sp_chunk_df
@@ -127,18 +354,86 @@ def extend_ds_segment_bounds(ds_segments):
     return mz_segments
 
 
-def segment_ds(imzml_reader: FSImzMLReader, spectra_per_chunk_n, ds_segments, ds_segments_path):
+# Reader of the parent process, inherited by forked segmentation worker processes
+_segm_worker_imzml_reader: Optional[FSImzMLReader] = None
+
+
+def _init_segm_worker(imzml_reader: FSImzMLReader):
+    global _segm_worker_imzml_reader  # pylint: disable=global-statement
+    imzml_reader.reopen()
+    _segm_worker_imzml_reader = imzml_reader
+
+
+def _segment_spectra_range(sp_ids, spectra_per_chunk_n, mz_segments, runs_path):
+    imzml_reader = _segm_worker_imzml_reader
+    runs_path.mkdir()
+    for chunk_sp_ids in chunk_list(xs=sp_ids, size=spectra_per_chunk_n):
+        sp_chunk_df = fetch_chunk_spectra_data(chunk_sp_ids, imzml_reader)
+        segment_spectra_chunk(sp_chunk_df, mz_segments, runs_path)
+    return imzml_reader.get_spectra_stats(sp_ids)
+
+
+def segment_ds(
+    imzml_reader: FSImzMLReader,
+    spectra_per_chunk_n,
+    ds_segments,
+    ds_segments_path,
+    spark_context=None,
+    n_workers=1,
+):
+    """Splits the dataset into mz segments.
+
+    With `n_workers` > 1, the spectra are split into contiguous ranges that are segmented by
+    forked worker processes, each holding at most `spectra_per_chunk_n` spectra in memory
+    and writing its own sorted runs, which are then merged into the segment files on the Spark
+    executors if `spark_context` is provided, or in `n_workers` processes otherwise.
+    """
     logger.info(f'Segmenting dataset into {len(ds_segments)} segments')
 
     rmtree(ds_segments_path, ignore_errors=True)
     ds_segments_path.mkdir(parents=True)
 
     mz_segments = extend_ds_segment_bounds(ds_segments)
-    sp_id_chunks = chunk_list(xs=range(imzml_reader.n_spectra), size=spectra_per_chunk_n)
-    for chunk_i, sp_ids in enumerate(sp_id_chunks, 1):
-        logger.debug(f'Segmenting spectra chunk {chunk_i}')
-        sp_chunk_df = fetch_chunk_spectra_data(sp_ids, imzml_reader)
-        segment_spectra_chunk(sp_chunk_df, mz_segments, ds_segments_path)
+    if n_workers > 1:
+        sp_id_ranges = [
+            sp_ids
+            for sp_ids in np.array_split(np.arange(imzml_reader.n_spectra), n_workers)
+            if len(sp_ids)
+        ]
+        runs_paths = [ds_segments_path / f'runs_{i:03}' for i in range(len(sp_id_ranges))]
+        logger.debug(f'Segmenting spectra in {len(sp_id_ranges)} worker processes')
+        with ProcessPoolExecutor(
+            len(sp_id_ranges),
+            mp_context=get_context('fork'),
+            initializer=_init_segm_worker,
+            initargs=(imzml_reader,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _segment_spectra_range, sp_ids, spectra_per_chunk_n, mz_segments, runs_path
+                )
+                for sp_ids, runs_path in zip(sp_id_ranges, runs_paths)
+            ]
+            for sp_ids, future in zip(sp_id_ranges, futures):
+                imzml_reader.update_spectra_stats(sp_ids, future.result())
+    else:
+        runs_paths = None
+        sp_id_chunks = chunk_list(xs=range(imzml_reader.n_spectra), size=spectra_per_chunk_n)
+        for chunk_i, sp_ids in enumerate(sp_id_chunks, 1):
+            logger.debug(f'Segmenting spectra chunk {chunk_i}')
+            sp_chunk_df = fetch_chunk_spectra_data(sp_ids, imzml_reader)
+            segment_spectra_chunk(sp_chunk_df, mz_segments, ds_segments_path)
+
+    merge_ds_segments(
+        len(mz_segments),
+        imzml_reader.mz_precision,
+        ds_segments_path,
+        spark_context,
+        runs_paths,
+        n_workers,
+    )
+    for runs_path in runs_paths or []:
+        runs_path.rmdir()
 
 
 def clip_centroids_df(centroids_df, mz_min, mz_max):
@@ -159,6 +454,46 @@ def calculate_centroids_segments_n(centr_df, image_dims):
     return centr_segm_n
 
 
+def estimate_centr_segments_mz_bounds(centr_df, centr_segm_n, isocalc_wrapper: IsocalcWrapper):
+    """Returns the mz ranges that the segments made by `segment_centroids` will read"""
+    first_peak_mzs = centr_df[centr_df.peak_i == 0].set_index('formula_i').mz
+    formula_mz_ranges = centr_df.groupby('formula_i').mz.agg(['min', 'max'])
+    formula_mz_ranges = formula_mz_ranges.loc[first_peak_mzs.index]
+    return centr_segments_mz_bounds(
+        first_peak_mzs.values,
+        formula_mz_ranges['min'].values,
+        formula_mz_ranges['max'].values,
+        centr_segm_n,
+        isocalc_wrapper,
+    )
+
+
+def measure_read_amplification(ds_segments_path, ds_segments, centr_segm_bounds):
+    """Returns the total number of rows in the dataset segments read by centroid segments, divided
+    by the number of rows within the centroid segments' mz ranges"""
+    lowers, uppers = centr_segm_bounds[:, 0], centr_segm_bounds[:, 1]
+    segm_rows, rows_needed = [], 0
+    for segm_i in range(len(ds_segments)):
+        ds_segm = load_ds_segment(ds_segment_path(ds_segments_path, segm_i))
+        if ds_segm is None:
+            segm_rows.append(0)
+            continue
+        segm_rows.append(len(ds_segm.mz))
+        rows_needed += np.sum(
+            np.searchsorted(ds_segm.mz, uppers, side='right')
+            - np.searchsorted(ds_segm.mz, lowers, side='left')
+        )
+
+    # Same segment choice as formula_imager.choose_ds_segments
+    first_segm_idxs = np.searchsorted(ds_segments[:, 0], lowers, side='right') - 1
+    first_segm_idxs = np.maximum(first_segm_idxs, 0)
+    last_segm_idxs = np.searchsorted(ds_segments[:, 1], uppers, side='left')
+    last_segm_idxs = np.minimum(last_segm_idxs, len(ds_segments) - 1)
+    cum_segm_rows = np.insert(np.cumsum(segm_rows), 0, 0)
+    rows_read = np.sum(cum_segm_rows[last_segm_idxs + 1] - cum_segm_rows[first_segm_idxs])
+    return float(rows_read / rows_needed) if rows_needed else 1.0
+
+
 def segment_centroids(centr_df, centr_segm_n, centr_segm_path):
     logger.info(f'Segmenting centroids into {centr_segm_n} segments')
 
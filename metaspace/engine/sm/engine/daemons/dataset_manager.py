@@ -10,6 +10,7 @@ from sm.engine import molecular_db
 from sm.engine.annotation.diagnostics import del_diagnostics
 from sm.engine.annotation.job import del_jobs
 from sm.engine.annotation_lithops.annotation_job import ServerAnnotationJob
+from sm.engine.annotation_lithops.cost_model import CostModel
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_spark.annotation_job import AnnotationJob
 from sm.engine.postprocessing.colocalization import Colocalization
@@ -109,9 +110,15 @@ class DatasetManager:
             del_jobs(ds)
         ds.save(self._db, self._es)
         with perf_profile(self._db, 'annotate_lithops', ds.id) as perf:
-            executor = Executor(self._sm_config['lithops'], perf=perf)
+            executor = Executor(
+                self._sm_config['lithops'], perf=perf, cost_model=CostModel.from_db(self._db)
+            )
 
-            ServerAnnotationJob(executor, ds, perf).run()
+            incremental = self._sm_config['services'].get('incremental_annotation', False)
+            ServerAnnotationJob(executor, ds, perf, incremental=incremental).run(
+                # Reprocessing from scratch shouldn't trust previously stored ion metrics
+                use_ion_metrics_cache=not del_first
+            )
 
             if self._sm_config['services'].get('colocalization', True):
                 Colocalization(self._db).run_coloc_job_lithops(executor, ds, reprocess=del_first)
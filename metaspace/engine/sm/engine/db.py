@@ -2,7 +2,8 @@ import functools
 import logging
 import threading
 from contextlib import contextmanager
-from typing import Optional
+from typing import Iterator, Optional
+from uuid import uuid4
 
 from psycopg2.extras import execute_values
 import psycopg2.extensions
@@ -136,6 +137,34 @@ class DB:
     def select_with_fields(self, sql, params=None):
         return self._select(sql, params, fields=True)
 
+    def iter_select_with_fields(self, sql, params=None, batch_size=1000) -> Iterator[dict]:
+        """Execute select query with a server-side cursor, so that the rows don't all need to be
+        held in memory at once
+
+        Args
+        ------------
+        sql : string
+            sql select query with %s placeholders
+        params :
+            query parameters for placeholders
+        batch_size : int
+            number of rows to fetch from the server at a time
+        Returns
+        ------------
+        : iterator
+            rows as dicts
+        """
+        logger.debug(sql[:1000])
+        with transaction_context() as conn:
+            with conn.cursor(name=f'cursor_{uuid4().hex}') as curs:
+                curs.itersize = batch_size
+                curs.execute(sql, params)
+                fields = None
+                for row in curs:
+                    if fields is None:
+                        fields = [desc[0] for desc in curs.description]
+                    yield dict(zip(fields, row))
+
     @db_call
     def select_one(self, sql, params=None):
         """Execute select query and take the first row
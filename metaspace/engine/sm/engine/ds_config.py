@@ -11,11 +11,27 @@ class DSConfigIsotopeGeneration(TypedDict):
     chem_mods: List[str]
 
 
-class DSConfigFDR(TypedDict):
+class _DSConfigFDROptional(TypedDict, total=False):
+    # If set, decoys are chosen once per formula and shared by all databases in a job, so that
+    # formulas that are in several databases only have one set of decoy ions to annotate
+    share_decoys: bool
+
+
+class DSConfigFDR(_DSConfigFDROptional):
     decoy_sample_size: int
 
 
-class DSConfigImageGeneration(TypedDict):
+class _DSConfigImageGenerationOptional(TypedDict, total=False):
+    # If set, ion image metrics are computed in batches of this many formulas
+    # (see formula_validator.make_compute_image_metrics_batch)
+    metrics_batch_size: int
+    # If set, the spatial and chaos metrics are skipped for decoy ions whose MSM provably can't
+    # reach this value. They're counted in FDR estimation with an upper bound of their MSM, so
+    # FDRs of annotations with MSM below the floor may be overestimated, but never underestimated
+    decoy_msm_floor: float
+
+
+class DSConfigImageGeneration(_DSConfigImageGenerationOptional):
     ppm: int
     n_levels: int
     min_px: int
@@ -18,6 +18,7 @@ from sm.engine.utils.db_mutex import DBMutex
 from sm.engine.db import DB
 from sm.engine.annotation.fdr import FDR
 from sm.engine.formula_parser import format_ion_formula
+from sm.engine.annotation import centroids_cache
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine import molecular_db
 from sm.engine.molecular_db import MolecularDB
@@ -54,6 +55,23 @@ LEFT JOIN graphql.ion ON m.ion_id = ion.id
 WHERE ds.id = %s AND j.moldb_id = %s
 ORDER BY COALESCE(m.msm, 0::real) DESC'''
 
+# The fields of ANNOTATIONS_SEL that are needed for dataset-wide fields such as isomers & isobars
+ANNOTATION_IONS_SEL = '''SELECT
+    m.id as annotation_id,
+    m.formula AS formula,
+    COALESCE(m.msm, 0::real) AS msm,
+    m.adduct AS adduct,
+    m.neutral_loss as neutral_loss,
+    m.chem_mod as chem_mod,
+    ion.ion_formula,
+    m.iso_image_ids AS iso_image_ids,
+    (CASE ds.config->'isotope_generation'->>'charge' WHEN '-1' THEN '-' WHEN '1' THEN '+' END) AS polarity
+FROM annotation m
+JOIN job j ON j.id = m.job_id
+JOIN dataset ds ON ds.id = j.ds_id
+LEFT JOIN graphql.ion ON m.ion_id = ion.id
+WHERE ds.id = %s AND j.moldb_id = %s'''
+
 DATASET_SEL = '''SELECT
     d.*,
     gu.id as ds_submitter_id,
@@ -100,6 +118,10 @@ WHERE d.ds_id = %s'''
 
 DS_COLUMNS_TO_SKIP_IN_ANN = ('ds_acq_geometry',)
 
+# Defaults for the elasticsearch.bulk_chunk_size and elasticsearch.bulk_thread_count config options
+BULK_CHUNK_SIZE = 500
+BULK_THREAD_COUNT = 4
+
 
 def init_es_conn(es_config):
     hosts = [{"host": es_config['host'], "port": int(es_config['port'])}]
@@ -276,6 +298,12 @@ class ESExporter:
         self._db = db
         self._ds_locker = DBMutex(self.sm_config['db'])
         self.index = self.sm_config['elasticsearch']['index']
+        self._bulk_chunk_size = self.sm_config['elasticsearch'].get(
+            'bulk_chunk_size', BULK_CHUNK_SIZE
+        )
+        self._bulk_thread_count = self.sm_config['elasticsearch'].get(
+            'bulk_thread_count', BULK_THREAD_COUNT
+        )
         self._get_mol_by_formula_dict_cache = dict()
 
     def _remove_mol_db_from_dataset(self, ds_id, moldb):
@@ -340,79 +368,163 @@ class ESExporter:
                 ann_doc[field] = ds_doc[field]
 
     @staticmethod
-    def _add_isomer_fields_to_anns(ann_docs):
+    def _get_isomer_fields(ions, ion_formulas, comp_ids):
+        """Returns the isomer_ions and comps_count_with_isomers fields of each annotation"""
         isomer_groups = defaultdict(list)
         isomer_comps = defaultdict(set)
         missing_ion_formulas = []
 
-        for doc in ann_docs:
-            if doc['ion_formula']:
-                isomer_groups[doc['ion_formula']].append(doc['ion'])
-                isomer_comps[doc['ion_formula']].update(doc['comp_ids'])
+        for ion, ion_formula, ann_comp_ids in zip(ions, ion_formulas, comp_ids):
+            if ion_formula:
+                isomer_groups[ion_formula].append(ion)
+                isomer_comps[ion_formula].update(ann_comp_ids)
             else:
-                missing_ion_formulas.append(doc['ion'])
-
-        for doc in ann_docs:
-            doc['isomer_ions'] = [
-                ion for ion in isomer_groups[doc['ion_formula']] if ion != doc['ion']
-            ]
-            doc['comps_count_with_isomers'] = len(isomer_comps[doc['ion_formula']])
+                missing_ion_formulas.append(ion)
 
         if missing_ion_formulas:
             logger.warning(
                 f'Missing ion formulas {len(missing_ion_formulas)}: {missing_ion_formulas[:20]}'
             )
 
+        return [
+            (
+                [isomer for isomer in isomer_groups[ion_formula] if isomer != ion],
+                len(isomer_comps[ion_formula]),
+            )
+            for ion, ion_formula in zip(ions, ion_formulas)
+        ]
+
+    @classmethod
+    def _add_isomer_fields_to_anns(cls, ann_docs):
+        isomer_fields = cls._get_isomer_fields(
+            [doc['ion'] for doc in ann_docs],
+            [doc['ion_formula'] for doc in ann_docs],
+            [doc['comp_ids'] for doc in ann_docs],
+        )
+        for doc, (isomer_ions, comps_count) in zip(ann_docs, isomer_fields):
+            doc['isomer_ions'] = isomer_ions
+            doc['comps_count_with_isomers'] = comps_count
+
+    @staticmethod
+    def _get_ion_fields(ann, isocalc):
+        """Returns the ion and centroid_mzs fields of an annotation"""
+        ion_without_pol = format_ion_formula(
+            ann['formula'], ann['chem_mod'], ann['neutral_loss'], ann['adduct']
+        )
+        mzs, _ = isocalc.centroids(ion_without_pol)
+        return ion_without_pol + ann['polarity'], list(mzs) if mzs is not None else []
+
+    def _get_ds_wide_fields(self, ds_id, moldb, isocalc):
+        """Computes the fields that depend on other annotations of the dataset (isomers and
+        isobars) in a first pass over the annotations, which only keeps the few fields that are
+        needed for them. Returns a dict of annotation_id => dict of fields"""
+        mol_by_formula = self._get_mol_by_formula_dict(moldb)
+        ann_ids, ions, ion_formulas, msms, comp_ids, centroid_mzs = [], [], [], [], [], []
+        peak_ann_ids, peak_ns, peak_mzs = [], [], []
+
+        for ann in self._db.iter_select_with_fields(
+            ANNOTATION_IONS_SEL, params=(ds_id, moldb.id), batch_size=self._bulk_chunk_size
+        ):
+            ion, mzs = self._get_ion_fields(ann, isocalc)
+            ann_ids.append(ann['annotation_id'])
+            ions.append(ion)
+            ion_formulas.append(ann['ion_formula'])
+            msms.append(ann['msm'])
+            comp_ids.append(mol_by_formula[ann['formula']][0])
+            centroid_mzs.append(mzs)
+            for peak_i, mz in enumerate(mzs):
+                if mz != 0 and peak_i < len(ann['iso_image_ids']) and ann['iso_image_ids'][peak_i]:
+                    peak_ann_ids.append(ann['annotation_id'])
+                    peak_ns.append(peak_i + 1)
+                    peak_mzs.append(mz)
+
+        isomer_fields = self._get_isomer_fields(ions, ion_formulas, comp_ids)
+        isobars = ESExporterIsobars.get_isobars(
+            ann_ids,
+            ions,
+            ion_formulas,
+            msms,
+            (np.array(peak_ann_ids, dtype='O'), np.array(peak_ns), np.array(peak_mzs)),
+            isocalc,
+        )
+        return {
+            ann_id: {
+                'ion': ion,
+                'centroid_mzs': mzs,
+                'isomer_ions': isomer_ions,
+                'comps_count_with_isomers': comps_count,
+                'isobars': isobars[ann_id],
+            }
+            for ann_id, ion, mzs, (isomer_ions, comps_count) in zip(
+                ann_ids, ions, centroid_mzs, isomer_fields
+            )
+        }
+
     def _index_ds_annotations(self, ds_id, moldb, ds_doc, isocalc):
-        annotation_docs = self._db.select_with_fields(ANNOTATIONS_SEL, params=(ds_id, moldb.id))
-        logger.info(f'Indexing {len(annotation_docs)} documents: {ds_id}, {moldb}')
+        ds_wide_fields = self._get_ds_wide_fields(ds_id, moldb, isocalc)
+        logger.info(f'Indexing {len(ds_wide_fields)} documents: {ds_id}, {moldb}')
 
         annotation_counts = defaultdict(int)
         mol_by_formula = self._get_mol_by_formula_dict(moldb)
-        for doc in annotation_docs:
-            self._add_ds_fields_to_ann(doc, ds_doc)
-            doc['db_id'] = moldb.id
-            doc['db_name'] = moldb.name
-            doc['db_version'] = moldb.version
-            formula = doc['formula']
-            ion_without_pol = format_ion_formula(
-                formula, doc['chem_mod'], doc['neutral_loss'], doc['adduct']
-            )
-            doc['ion'] = ion_without_pol + doc['polarity']
-            doc['comp_ids'], doc['comp_names'] = mol_by_formula[formula]
-            mzs, _ = isocalc.centroids(ion_without_pol)
-            doc['centroid_mzs'] = list(mzs) if mzs is not None else []
-            doc['mz'] = mzs[0] if mzs is not None else 0
-            doc['iso_image_urls'] = [
-                image_storage.get_image_url(image_storage.ISO, ds_id, image_id)
-                if image_id
-                else None
-                for image_id in doc['iso_image_ids']
-            ]
-
-            if moldb.targeted:
-                fdr_level = doc['fdr'] = -1
-            else:
-                fdr_level = FDR.nearest_fdr_level(doc['fdr'])
-            annotation_counts[round(fdr_level * 100, 2)] += 1
-
-        self._add_isomer_fields_to_anns(annotation_docs)
-        ESExporterIsobars.add_isobar_fields_to_anns(annotation_docs, isocalc)
-        to_index = []
-        for doc in annotation_docs:
-            to_index.append(
-                {
+
+        def iter_actions():
+            # Annotations are streamed from the DB, so only the chunks of documents that are
+            # waiting to be sent to ES need to be held in memory
+            for doc in self._db.iter_select_with_fields(
+                ANNOTATIONS_SEL, params=(ds_id, moldb.id), batch_size=self._bulk_chunk_size
+            ):
+                self._add_ds_fields_to_ann(doc, ds_doc)
+                doc['db_id'] = moldb.id
+                doc['db_name'] = moldb.name
+                doc['db_version'] = moldb.version
+                doc['comp_ids'], doc['comp_names'] = mol_by_formula[doc['formula']]
+                fields = ds_wide_fields.get(doc['annotation_id'])
+                if fields is None:
+                    # Annotation was added after the first pass
+                    ion, mzs = self._get_ion_fields(doc, isocalc)
+                    fields = {
+                        'ion': ion,
+                        'centroid_mzs': mzs,
+                        'isomer_ions': [],
+                        'comps_count_with_isomers': len(doc['comp_ids']),
+                        'isobars': [],
+                    }
+                doc.update(fields)
+                doc['mz'] = doc['centroid_mzs'][0] if doc['centroid_mzs'] else 0
+                doc['iso_image_urls'] = [
+                    image_storage.get_image_url(image_storage.ISO, ds_id, image_id)
+                    if image_id
+                    else None
+                    for image_id in doc['iso_image_ids']
+                ]
+
+                if moldb.targeted:
+                    fdr_level = doc['fdr'] = -1
+                else:
+                    fdr_level = FDR.nearest_fdr_level(doc['fdr'])
+                annotation_counts[round(fdr_level * 100, 2)] += 1
+
+                yield {
                     '_index': self.index,
                     '_type': 'annotation',
                     '_id': f"{doc['ds_id']}_{doc['annotation_id']}",
                     '_source': doc,
                 }
-            )
 
-        for success, info in parallel_bulk(self._es, actions=to_index, timeout='60s'):
+        for success, info in parallel_bulk(
+            self._es,
+            actions=iter_actions(),
+            thread_count=self._bulk_thread_count,
+            chunk_size=self._bulk_chunk_size,
+            timeout='60s',
+        ):
             if not success:
                 logger.error(f'Document failed: {info}')
 
+        cache = centroids_cache.get_instance()
+        if cache is not None:
+            logger.debug(f'Centroids cache stats: {cache.stats()}')
+
         return annotation_counts
 
     @retry_on_exception(TransportError)
@@ -562,98 +674,153 @@ class ESExporter:
 class ESExporterIsobars:
     """
     A helper function for ESExport that grew too big to remain a single function.
-    `ESExporterIsobars.add_isobar_fields_to_anns` computes the "isobars" field and adds it to
-    every annotation in a list of annotation documents.
+    `ESExporterIsobars.get_isobars` computes the "isobars" field of every annotation of a dataset.
+    It only needs the annotations' ions and the m/zs of their peaks that have images, so that
+    the full annotation documents don't need to be held in memory.
     """
 
     @classmethod
     def add_isobar_fields_to_anns(cls, ann_docs, isocalc):
-        mzs_df = cls._build_mzs_df(ann_docs, isocalc)
-
-        for _, peak_rows in mzs_df.groupby('id'):
-            overlaps = cls._find_overlaps(mzs_df, peak_rows)
-            cls._apply_overlap_group(peak_rows, overlaps)
-
-    @staticmethod
-    def _build_mzs_df(ann_docs, isocalc):
-        peaks = []
-
+        peaks = [
+            (doc['annotation_id'], peak_i + 1, mz)
+            for doc in ann_docs
+            for peak_i, mz in enumerate(doc['centroid_mzs'])
+            if mz != 0
+            and peak_i < len(doc['iso_image_urls'])
+            and doc['iso_image_urls'][peak_i] is not None
+        ]
+        peak_ann_ids, peak_ns, peak_mzs = zip(*peaks) if peaks else ((), (), ())
+        isobars = cls.get_isobars(
+            [doc['annotation_id'] for doc in ann_docs],
+            [doc['ion'] for doc in ann_docs],
+            [doc['ion_formula'] for doc in ann_docs],
+            [doc['msm'] for doc in ann_docs],
+            (np.array(peak_ann_ids, dtype='O'), np.array(peak_ns), np.array(peak_mzs)),
+            isocalc,
+        )
         for doc in ann_docs:
-            doc['isobars'] = []
-            for peak_i, mz in enumerate(doc['centroid_mzs']):
-                if (
-                    mz != 0
-                    and peak_i < len(doc['iso_image_urls'])
-                    and doc['iso_image_urls'][peak_i] is not None
-                ):
-                    peaks.append(
-                        (
-                            doc['annotation_id'],
-                            doc,
-                            peak_i + 1,
-                            mz,
-                            doc['msm'],
-                            doc['ion'],
-                            doc['ion_formula'] or '',
-                        )
-                    )
+            doc['isobars'] = isobars[doc['annotation_id']]
 
-        peaks_df = pd.DataFrame(
-            peaks, columns=['id', 'doc', 'peak_n', 'mz', 'msm', 'ion', 'ion_formula']
+    @classmethod
+    def get_isobars(cls, ann_ids, ions, ion_formulas, msms, peaks, isocalc):
+        """
+        Args
+        -----
+        ann_ids, ions, ion_formulas, msms: Fields of each annotation
+        peaks: Arrays of the annotation ID, peak number (starting from 1) and m/z of every peak
+            that has an image
+        Returns
+        -----
+        dict of annotation ID => list of isobar entries
+        """
+        ann_infos = [
+            {'ion_formula': ion_formula, 'ion': ion, 'msm': msm}
+            for ion, ion_formula, msm in zip(ions, ion_formulas, msms)
+        ]
+        isobars = {ann_id: [] for ann_id in ann_ids}
+        peak_ann_ids, peak_ns, peak_mzs = peaks
+        if len(peak_ann_ids) == 0:
+            return isobars
+
+        peak_ann_is = pd.Index(ann_ids).get_indexer(peak_ann_ids)
+        ann_ids = np.array(ann_ids, dtype='O')
+        # Codes that sort in the same order as the ion formulas
+        _, formula_codes = np.unique(
+            np.array([f or '' for f in ion_formulas], dtype='O'), return_inverse=True
         )
-        mzs_df = peaks_df.sort_values('mz')
 
-        mzs_df['lower_mz'], mzs_df['upper_mz'] = isocalc.mass_accuracy_bounds(mzs_df['mz'])
-        mzs_df['lower_idx'] = np.searchsorted(mzs_df.upper_mz.values, mzs_df.lower_mz.values, 'l')
-        mzs_df['upper_idx'] = np.searchsorted(mzs_df.lower_mz.values, mzs_df.upper_mz.values, 'r')
-        return mzs_df
+        order = np.argsort(np.asarray(peak_mzs, dtype=np.float64), kind='quicksort')
+        peak_ann_is = peak_ann_is[order]
+        peak_ns = np.asarray(peak_ns)[order]
+        lower_mzs, upper_mzs = isocalc.mass_accuracy_bounds(
+            np.asarray(peak_mzs, dtype=np.float64)[order]
+        )
+        peak_is, overlap_is = cls._find_overlaps(lower_mzs, upper_mzs, formula_codes[peak_ann_is])
+
+        # Annotations are processed in order of their IDs, and each annotation's overlaps are
+        # added in the order that they're first found in
+        ann_ranks = np.empty(len(ann_ids), dtype=np.int64)
+        ann_ranks[np.argsort(ann_ids, kind='stable')] = np.arange(len(ann_ids))
+        for ann_i, overlap_ann_i, peak_n_pairs in cls._group_overlaps(
+            ann_ranks[peak_ann_is[peak_is]],
+            peak_ann_is[peak_is],
+            peak_ann_is[overlap_is],
+            peak_ns[peak_is],
+            peak_ns[overlap_is],
+        ):
+            # Add other annotations where either both first peaks overlap,
+            # or there are multiple overlaps.
+            isobars[ann_ids[ann_i]].append({**ann_infos[overlap_ann_i], 'peak_ns': peak_n_pairs})
+            isobars[ann_ids[overlap_ann_i]].append(
+                {**ann_infos[ann_i], 'peak_ns': [(b, a) for a, b in peak_n_pairs]}
+            )
+        return isobars
 
     @staticmethod
-    def _find_overlaps(mzs_df, peak_rows):
-        overlaps = defaultdict(list)
-        # Use numpy arrays directly to minimize access times during the core loop
-        _ids = mzs_df.id.values
-        _ion_formulas = mzs_df.ion_formula.values
-        _peak_ns = mzs_df.peak_n.values
-        _docs = mzs_df.doc.values
-        # Collect all other annotations that have any overlap with this annotation
-        for lower_idx, upper_idx, ion_formula, peak_n in peak_rows[
-            ['lower_idx', 'upper_idx', 'ion_formula', 'peak_n']
-        ].itertuples(False, None):
-            # Ignore annotations with "greater" ion_formula values as an optimization.
-            # The backwards link from "greater" to "lesser" is populated below, and doing this
-            # helps to ensure that the relationship is always reflexive.
-            peak_overlap_is = (
-                np.nonzero(_ion_formulas[lower_idx:upper_idx] < ion_formula)[0] + lower_idx
-            )
-            for peak_overlap_i in peak_overlap_is:
-                overlaps[_ids[peak_overlap_i]].append(
-                    (int(peak_n), int(_peak_ns[peak_overlap_i]), _docs[peak_overlap_i])
-                )
-        return overlaps
+    def _find_overlaps(lower_mzs, upper_mzs, formula_codes, batch_size=2 ** 20):
+        """Sweeps over the peaks' m/z intervals (sorted by m/z) and returns every pair of
+        overlapping peaks where the second peak has a "lesser" ion formula. Only reporting pairs in
+        one direction halves the work, and the reverse link is added when the results are applied.
+
+        Returns
+        -----
+        Arrays of the indexes of the first and second peak of each pair, sorted by both indexes
+        """
+        # The peaks that overlap peak i are in the range [starts[i], ends[i]), as the bounds are
+        # monotonic in m/z
+        starts = np.searchsorted(upper_mzs, lower_mzs, 'left')
+        ends = np.searchsorted(lower_mzs, upper_mzs, 'right')
+        n_candidates = np.cumsum(ends - starts)
+
+        peak_is, overlap_is = [], []
+        # Split into batches of candidate pairs to limit memory usage in crowded m/z ranges
+        batch_bounds = np.searchsorted(
+            n_candidates, np.arange(0, n_candidates[-1], batch_size), 'right'
+        )
+        for batch_start, batch_end in zip(batch_bounds, [*batch_bounds[1:], len(starts)]):
+            counts = (ends - starts)[batch_start:batch_end]
+            batch_peak_is = np.repeat(np.arange(batch_start, batch_end), counts)
+            offsets = np.arange(len(batch_peak_is)) - np.repeat(np.cumsum(counts) - counts, counts)
+            batch_overlap_is = np.repeat(starts[batch_start:batch_end], counts) + offsets
+            is_lesser = formula_codes[batch_overlap_is] < formula_codes[batch_peak_is]
+            peak_is.append(batch_peak_is[is_lesser])
+            overlap_is.append(batch_overlap_is[is_lesser])
+
+        return np.concatenate(peak_is), np.concatenate(overlap_is)
 
     @staticmethod
-    def _apply_overlap_group(peak_rows, overlaps):
-        doc = peak_rows.doc.iloc[0]
-        # Add a list of other annotations where either both first peaks overlap,
-        # or there are multiple overlaps.
-        for overlap_rows in overlaps.values():
-            peak_ns = sorted(row[:2] for row in overlap_rows)
-            if len(peak_ns) > 1 or (1, 1) in peak_ns:
-                overlap_doc = overlap_rows[0][2]
-                doc['isobars'].append(
-                    {
-                        'ion_formula': overlap_doc['ion_formula'],
-                        'ion': overlap_doc['ion'],
-                        'msm': overlap_doc['msm'],
-                        'peak_ns': peak_ns,
-                    }
-                )
-                overlap_doc['isobars'].append(
-                    {
-                        'ion_formula': doc['ion_formula'],
-                        'ion': doc['ion'],
-                        'msm': doc['msm'],
-                        'peak_ns': [(b, a) for a, b in peak_ns],
-                    }
+    def _group_overlaps(ann_ranks, ann_is, overlap_ann_is, peak_ns, overlap_peak_ns):
+        """Groups overlapping peak pairs by pair of annotations. Yields
+        (annotation, overlapping annotation, sorted list of overlapping peak number pairs) for
+        pairs of annotations where either both first peaks overlap, or there are multiple overlaps,
+        ordered by annotation rank and then by when the overlapping annotation was first found"""
+        pair_is = np.lexsort((overlap_peak_ns, peak_ns, overlap_ann_is, ann_ranks))
+        ann_ranks, ann_is, overlap_ann_is = (
+            ann_ranks[pair_is],
+            ann_is[pair_is],
+            overlap_ann_is[pair_is],
+        )
+        peak_ns, overlap_peak_ns = peak_ns[pair_is], overlap_peak_ns[pair_is]
+        if len(pair_is) == 0:
+            return
+
+        group_starts = np.flatnonzero(
+            np.concatenate(
+                [
+                    [True],
+                    (ann_ranks[1:] != ann_ranks[:-1]) | (overlap_ann_is[1:] != overlap_ann_is[:-1]),
+                ]
+            )
+        )
+        group_ends = np.append(group_starts[1:], len(pair_is))
+        first_found = np.minimum.reduceat(pair_is, group_starts)
+        has_first_peaks = np.maximum.reduceat((peak_ns == 1) & (overlap_peak_ns == 1), group_starts)
+        is_isobar = (group_ends - group_starts > 1) | has_first_peaks
+
+        for group_i in np.lexsort((first_found, ann_ranks[group_starts])):
+            if is_isobar[group_i]:
+                start, end = group_starts[group_i], group_ends[group_i]
+                peak_n_pairs = list(
+                    zip(peak_ns[start:end].tolist(), overlap_peak_ns[start:end].tolist())
                 )
+                yield int(ann_is[start]), int(overlap_ann_is[start]), peak_n_pairs
@@ -1,7 +1,12 @@
+import numpy as np
 import pandas as pd
+import pytest
 from pytest import raises
 
-from sm.engine.annotation.formula_centroids import FormulaCentroids
+from sm.engine.annotation import formula_centroids
+from sm.engine.annotation.formula_centroids import CentroidsGenerator, FormulaCentroids
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from tests.conftest import sm_config, ds_config
 
 
 def create_formula_centroids(rows1, rows2):
@@ -46,3 +51,22 @@ def test_add_overlap_exception():
 
     with raises(AssertionError):
         formula_centroids += formula_centroids_other
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_generate_if_not_exist_without_spark(
+    sm_config, ds_config, tmp_path, monkeypatch, n_workers
+):
+    # One formula per chunk, so that multiple workers are actually used
+    monkeypatch.setattr(formula_centroids, 'LOCAL_GENERATION_CHUNK_SIZE', 1)
+    centr_gen = CentroidsGenerator(sc=None, isocalc=IsocalcWrapper(ds_config), n_workers=n_workers)
+    centr_gen._ion_centroids_path = str(tmp_path)
+    centr_gen._local_ion_centroids_path = tmp_path
+
+    centr_gen.generate_if_not_exist(['C2H4O8Na', 'fake_mfNa'])
+    ion_centroids = centr_gen.generate_if_not_exist(['C2H4O8Na', 'C3H6O7Na', 'fake_mfNa'])
+
+    assert ion_centroids.formulas_df.formula.tolist() == ['C2H4O8Na', 'C3H6O7Na']
+    assert ion_centroids.centroids_df(True).shape == (2 * 4, 3)
+    assert np.all(np.diff(ion_centroids.centroids_df().mz.values) >= 0)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['centroids.parquet', 'formulas.parquet']
@@ -1,4 +1,4 @@
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from unittest.mock import patch
 import numpy as np
 import pandas as pd
@@ -6,9 +6,14 @@ import pytest
 from pandas.util.testing import assert_frame_equal
 from scipy.sparse import coo_matrix
 
+from sm.engine.annotation import formula_validator
 from sm.engine.annotation.formula_validator import (
+    _use_sparse_chaos,
+    compute_and_filter_metrics,
     formula_image_metrics,
     make_compute_image_metrics,
+    make_compute_image_metrics_batch,
+    PrunedMetrics,
     replace_nan,
 )
 
@@ -44,6 +49,102 @@ def test_get_compute_img_measures_pass(chaos_mock, image_corr_mock, pattern_matc
     assert metrics == exp_metrics
 
 
+# Images this small use the dense measure of chaos unless the sparse one is forced
+@pytest.mark.parametrize('sparse_chaos_min_pixels', [0, formula_validator.CHAOS_SPARSE_MIN_PIXELS])
+def test_compute_img_metrics_batch_matches_single(monkeypatch, sparse_chaos_min_pixels):
+    monkeypatch.setattr(formula_validator, 'CHAOS_SPARSE_MIN_PIXELS', sparse_chaos_min_pixels)
+    img_gen_config = {'n_levels': 30}
+    nrows, ncols = 10, 12
+    rng = np.random.RandomState(42)
+    sample_area_mask = rng.rand(nrows, ncols) > 0.1
+    compute_metrics = make_compute_image_metrics(sample_area_mask, nrows, ncols, img_gen_config)
+    compute_metrics_batch = make_compute_image_metrics_batch(
+        sample_area_mask, nrows, ncols, img_gen_config
+    )
+
+    def random_image(n_px):
+        # Duplicate pixels are possible, the same as with real spectra
+        pixels = rng.choice(np.flatnonzero(sample_area_mask), n_px)
+        data = (rng.rand(n_px) * 100).astype(np.float32)
+        return coo_matrix((data, np.divmod(pixels, ncols)), shape=(nrows, ncols))
+
+    image_sets = []
+    for _ in range(20):
+        first_image = random_image(rng.randint(1, 60))
+        correlated_image = coo_matrix(
+            (first_image.data * 0.5, (first_image.row, first_image.col)), shape=(nrows, ncols)
+        )
+        formula_images = [first_image, correlated_image, random_image(rng.randint(1, 30)), None]
+        image_sets.append((formula_images, [100.0, 50.0, 10.0, 1.0]))
+
+    exp_metrics = [compute_metrics(*image_set) for image_set in image_sets]
+    metrics = compute_metrics_batch(image_sets)
+
+    assert any(m['msm'] > 0 for m in exp_metrics)
+    for m, exp_m in zip(metrics, exp_metrics):
+        assert list(m.keys()) == list(exp_m.keys())
+        for key in ['chaos', 'spatial', 'spectral', 'msm', 'min_iso_ints', 'max_iso_ints']:
+            assert m[key] == exp_m[key]
+        assert np.allclose(m['total_iso_ints'], exp_m['total_iso_ints'])
+
+
+def test_use_sparse_chaos():
+    # Sparse only pays off for low density images that are large enough
+    assert _use_sparse_chaos(100, 1000 * 1000)
+    assert not _use_sparse_chaos(200 * 1000, 1000 * 1000)
+    assert not _use_sparse_chaos(25, 50 * 50)
+
+
+def test_compute_img_metrics_prunes_decoys_below_msm_floor():
+    msm_floor = 0.3
+    img_gen_config = {'n_levels': 30, 'decoy_msm_floor': msm_floor}
+    nrows, ncols = 10, 12
+    rng = np.random.RandomState(42)
+    sample_area_mask = np.ones((nrows, ncols), dtype=bool)
+    args = (sample_area_mask, nrows, ncols, img_gen_config)
+    compute_metrics = make_compute_image_metrics(*args)
+    compute_metrics_batch = make_compute_image_metrics_batch(*args)
+
+    def random_image(pixels):
+        data = rng.rand(len(pixels)) * 100
+        return coo_matrix((data, np.divmod(pixels, ncols)), shape=(nrows, ncols))
+
+    image_sets = []
+    for _ in range(30):
+        pixels = rng.permutation(nrows * ncols)
+        first_pixels = pixels[: rng.randint(2, 60)]
+        # Other peaks either share the pixels of the first peak or don't overlap with it at all
+        other_pixels = first_pixels if rng.rand() > 0.5 else pixels[60:80]
+        formula_images = [random_image(first_pixels), random_image(other_pixels), None]
+        image_sets.append((formula_images, [100.0, 50.0, 10.0]))
+
+    exp_metrics = [compute_metrics(*image_set) for image_set in image_sets]
+    pruned_metrics = [compute_metrics(*image_set, True) for image_set in image_sets]
+    pruned_metrics_batch = compute_metrics_batch(image_sets, [True] * len(image_sets))
+
+    is_pruned = [isinstance(m, PrunedMetrics) for m in pruned_metrics]
+    assert any(is_pruned)
+    assert [isinstance(m, PrunedMetrics) for m in pruned_metrics_batch] == is_pruned
+    for m, batch_m, exp_m in zip(pruned_metrics, pruned_metrics_batch, exp_metrics):
+        if isinstance(m, PrunedMetrics):
+            # Pruned decoys keep an upper bound of their MSM, so they still count in FDR
+            assert exp_m['msm'] <= m['msm'] < msm_floor
+            assert m['spectral'] == exp_m['spectral']
+            assert np.isclose(batch_m['msm'], m['msm'])
+        else:
+            assert m == exp_m
+
+    metrics_stats = Counter()
+    image_set_it = ((i, f_ints, f_images) for i, (f_images, f_ints) in enumerate(image_sets))
+    metrics = list(
+        compute_and_filter_metrics(image_set_it, compute_metrics, set(), set(), 1, metrics_stats)
+    )
+    assert metrics_stats['skipped'] == sum(is_pruned)
+    assert {f_i for f_i, _, _ in metrics} == {
+        i for i, m in enumerate(pruned_metrics) if m['msm'] > 0
+    }
+
+
 def test_formula_image_metrics():
     exp_metrics = OrderedDict(
         [
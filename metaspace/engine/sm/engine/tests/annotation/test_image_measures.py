@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from cpyImagingMSpec import measure_of_chaos
+
+from sm.engine.annotation.image_measures import measure_of_chaos_sparse
+
+
+def _sparse_moc(img, n_levels):
+    pixels = np.flatnonzero(img)
+    return measure_of_chaos_sparse(pixels, img.flat[pixels], *img.shape, n_levels)
+
+
+@pytest.mark.parametrize('n_levels', [3, 10, 30])
+def test_measure_of_chaos_sparse_matches_dense(n_levels):
+    rng = np.random.default_rng(42)
+    for _ in range(100):
+        nrows, ncols = rng.integers(1, 30, 2)
+        density = rng.choice([0.01, 0.1, 0.5, 1])
+        img = np.where(rng.random((nrows, ncols)) < density, rng.random((nrows, ncols)), 0)
+        # Blobs of equal values, some of them exactly at intensity thresholds
+        img[: nrows // 2, : ncols // 2] = rng.integers(1, n_levels + 1) / n_levels
+        img = img.astype(np.float32)
+
+        np.testing.assert_equal(_sparse_moc(img, n_levels), measure_of_chaos(img, n_levels))
+
+
+def test_measure_of_chaos_sparse_empty_image():
+    assert np.isnan(_sparse_moc(np.zeros((5, 5), dtype=np.float32), 30))
@@ -1,11 +1,12 @@
 import pickle
+from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import numpy as np
 from lithops import Storage
 from pyimzml.ImzMLWriter import ImzMLWriter
 
-from sm.engine.annotation.imzml_reader import LithopsImzMLReader
+from sm.engine.annotation.imzml_reader import LithopsImzMLReader, MmapImzMLReader
 from tests.conftest import make_imzml_reader_mock, sm_config, executor
 
 
@@ -94,3 +95,28 @@ def test_imzml_reader_lithops(executor):
 
     # Ensure imzml_reader is pickleable, as Lithops will pickle it
     p = pickle.dumps(imzml_reader)
+
+
+def test_imzml_reader_mmap():
+    spectra = [(mzs, np.where(mzs == 2, 0, ints)) for mzs, ints in MOCK_SPECTRA]
+    with TemporaryDirectory() as tmpdir:
+        with ImzMLWriter(f'{tmpdir}/test.imzML', mz_dtype=np.float64) as writer:
+            for coords, (mzs, ints) in zip(MOCK_COORDINATES, spectra):
+                writer.addSpectrum(mzs, ints, coords)
+
+        imzml_reader = MmapImzMLReader(Path(tmpdir))
+        for sp_idx, _mzs, _ints in imzml_reader.iter_spectra([2, 0]):
+            mzs, ints = spectra[sp_idx]
+            assert np.array_equal(mzs[ints > 0], _mzs)
+            assert np.array_equal(ints[ints > 0], _ints)
+
+        imzml_reader = MmapImzMLReader(Path(tmpdir))
+        sp_idxs, mzs, ints = imzml_reader.read_spectra_block([3, 1, 0, 2])
+
+        assert np.array_equal(sp_idxs, [3, 3, 3, 1, 0, 2, 2])
+        assert np.array_equal(mzs, [1, 3, 4, 1, 1, 1, 3])
+        assert np.array_equal(ints, [4, 4, 4, 2, 1, 3, 3])
+        assert imzml_reader.min_mz == 1.0
+        assert imzml_reader.max_mz == 4.0
+        expected_tic = [[1, np.nan, 2], [np.nan, np.nan, np.nan], [6, np.nan, 12]]
+        assert np.array_equal(imzml_reader.tic_image(), expected_tic, equal_nan=True)
@@ -0,0 +1,74 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from sm.engine.annotation.segment_planner import (
+    centr_segments_mz_bounds,
+    estimate_read_amplification,
+    plan_ds_segments,
+)
+
+
+class PpmIsocalcWrapperMock:
+    def mass_accuracy_bounds(self, mzs):
+        return mzs - mzs * 3e-6, mzs + mzs * 3e-6
+
+
+def make_dense_region_mzs(rng):
+    # MALDI-like dataset where most peaks are matrix peaks at low m/z
+    return np.sort(np.concatenate([rng.uniform(100, 400, 80000), rng.uniform(100, 1000, 20000)]))
+
+
+def test_centr_segments_mz_bounds():
+    first_peak_mzs = np.array([100.0, 200, 300, 400])
+    bounds = centr_segments_mz_bounds(
+        first_peak_mzs, first_peak_mzs, first_peak_mzs + 3, 2, PpmIsocalcWrapperMock()
+    )
+
+    assert_array_equal(bounds, [[100 - 3e-4, 203 + 203 * 3e-6], [300 - 9e-4, 403 + 403 * 3e-6]])
+
+
+def test_plan_ds_segments_bounds():
+    rng = np.random.default_rng(42)
+    mzs = make_dense_region_mzs(rng)
+    first_peak_mzs = rng.uniform(150, 1000, 5000)
+    centr_segm_bounds = centr_segments_mz_bounds(
+        first_peak_mzs, first_peak_mzs, first_peak_mzs + 3, 50, PpmIsocalcWrapperMock()
+    )
+
+    bounds, _ = plan_ds_segments(mzs, centr_segm_bounds, row_size=16, max_segm_size_mb=0.1)
+
+    assert bounds[0, 0] == mzs[0] and bounds[-1, 1] == mzs[-1]
+    assert_array_equal(bounds[1:, 0], bounds[:-1, 1])
+    segm_rows = np.diff(np.searchsorted(mzs, np.append(bounds[:, 0], np.inf)))
+    assert np.all(segm_rows * 16 <= 0.1 * 2 ** 20)
+
+
+def test_plan_ds_segments_reads_less_than_quantile_segments():
+    rng = np.random.default_rng(42)
+    mzs = make_dense_region_mzs(rng)
+    first_peak_mzs = rng.uniform(150, 1000, 5000)
+    centr_segm_bounds = centr_segments_mz_bounds(
+        first_peak_mzs, first_peak_mzs, first_peak_mzs + 3, 50, PpmIsocalcWrapperMock()
+    )
+
+    bounds, est_read_amplification = plan_ds_segments(
+        mzs, centr_segm_bounds, row_size=16, max_segm_size_mb=0.5, segm_overhead_mb=0.01
+    )
+
+    quantile_bounds = np.quantile(mzs, np.linspace(0, 1, len(bounds) + 1))
+    quantile_bounds = np.column_stack([quantile_bounds[:-1], quantile_bounds[1:]])
+    assert est_read_amplification == estimate_read_amplification(bounds, mzs, centr_segm_bounds)
+    assert est_read_amplification < estimate_read_amplification(
+        quantile_bounds, mzs, centr_segm_bounds
+    )
+
+
+def test_plan_ds_segments_without_centroids():
+    mzs = np.linspace(100, 1000, 1000)
+
+    bounds, est_read_amplification = plan_ds_segments(
+        mzs, np.zeros((0, 2)), row_size=16, max_segm_size_mb=1
+    )
+
+    assert_array_equal(bounds, [[100, 1000]])
+    assert est_read_amplification == 1
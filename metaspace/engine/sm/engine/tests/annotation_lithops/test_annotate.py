@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation_lithops.annotate import gen_iso_image_sets
+
+
+class PpmIsocalcWrapperMock:
+    def mass_accuracy_bounds(self, mzs):
+        return mzs - mzs * 3e-6, mzs + mzs * 3e-6
+
+
+def expected_iso_image_sets(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, n_peaks):
+    isocalc_wrapper = PpmIsocalcWrapperMock()
+    for formula_i, f_centr_df in centr_df.sort_values(['formula_i', 'peak_i']).groupby('formula_i'):
+        f_ints, f_images = [0.0] * n_peaks, [None] * n_peaks
+        for i, (mz, intensity) in enumerate(zip(f_centr_df.mz, f_centr_df.int)):
+            lower, upper = isocalc_wrapper.mass_accuracy_bounds(mz)
+            mask = (sp_mzs >= lower) & (sp_mzs <= upper)
+            f_ints[i] = intensity
+            if mask.any():
+                rows, cols = np.divmod(sp_inds[mask], ncols)
+                f_images[i] = coo_matrix((sp_ints[mask], (rows, cols)), shape=(nrows, ncols))
+        yield formula_i, f_ints, f_images
+
+
+def test_gen_iso_image_sets():
+    rng = np.random.default_rng(42)
+    nrows, ncols, n_peaks = 5, 7, 4
+    sp_mzs = np.sort(rng.uniform(100, 110, 2000))
+    sp_inds = rng.integers(0, nrows * ncols, len(sp_mzs)).astype(np.uint32)
+    sp_ints = rng.uniform(1, 100, len(sp_mzs)).astype(np.float32)
+    centr_df = pd.DataFrame(
+        {
+            'formula_i': np.repeat(np.arange(50), n_peaks),
+            'peak_i': np.tile(np.arange(n_peaks), 50),
+            'mz': rng.uniform(99, 111, 50 * n_peaks),
+            'int': rng.uniform(0, 100, 50 * n_peaks),
+        }
+    )
+    # Formulas with fewer peaks than n_peaks are padded
+    centr_df = centr_df[~((centr_df.formula_i % 3 == 0) & (centr_df.peak_i == n_peaks - 1))]
+    centr_df = centr_df.sample(frac=1, random_state=42)
+
+    image_sets = list(
+        gen_iso_image_sets(
+            sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, PpmIsocalcWrapperMock(), n_peaks
+        )
+    )
+    expected = list(
+        expected_iso_image_sets(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, n_peaks)
+    )
+
+    assert len(image_sets) == len(expected)
+    for (f_i, f_ints, f_images), (exp_f_i, exp_f_ints, exp_f_images) in zip(image_sets, expected):
+        assert f_i == exp_f_i
+        np.testing.assert_array_equal(f_ints, exp_f_ints)
+        assert len(f_images) == len(exp_f_images) == n_peaks
+        for img, exp_img in zip(f_images, exp_f_images):
+            assert (img is None) == (exp_img is None)
+            if img is not None:
+                np.testing.assert_array_equal(img.toarray(), exp_img.toarray())
+
+
+def test_gen_iso_image_sets_empty_spectra():
+    centr_df = pd.DataFrame({'formula_i': [0], 'peak_i': [0], 'mz': [100.0], 'int': [100.0]})
+    empty = np.zeros(0)
+
+    assert not list(gen_iso_image_sets(empty, empty, empty, centr_df, 1, 1, None, 4))
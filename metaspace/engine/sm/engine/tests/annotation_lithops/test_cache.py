@@ -0,0 +1,112 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation.imzml_reader import LithopsImzMLReader
+from sm.engine.annotation_lithops.cache import DSSegmentsCache, PipelineCacher
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import load_cobjs, save_cobj
+from sm.engine.config import proj_root
+from tests.conftest import executor, sm_config
+
+
+def upload_example_ds(storage):
+    ds_path = Path(proj_root()) / 'tests/data/imzml_example_ds'
+    imzml_cobj = storage.put_cloudobject((ds_path / 'Example_Continuous.imzML').read_bytes())
+    ibd_cobj = storage.put_cloudobject((ds_path / 'Example_Continuous.ibd').read_bytes())
+    return imzml_cobj, ibd_cobj
+
+
+def make_ds_segments(storage, n_segments, n_rows=10):
+    imzml_reader = LithopsImzMLReader(storage, *upload_example_ds(storage))
+    segm_dfs = [pd.DataFrame({'mz': np.arange(n_rows) + i * n_rows}) for i in range(n_segments)]
+    segms_cobjs = [save_cobj(storage, df) for df in segm_dfs]
+    bounds = np.array([[i * n_rows, (i + 1) * n_rows - 1] for i in range(n_segments)])
+    return (imzml_reader, bounds, segms_cobjs, np.full(n_segments, n_rows)), segm_dfs
+
+
+def test_ds_segments_cache_entry_key_uses_etags(executor: Executor, sm_config):
+    storage = executor.storage
+    cache = DSSegmentsCache(storage, sm_config['lithops'])
+    imzml_cobj, ibd_cobj, other_cobj = [save_cobj(storage, data) for data in [b'a', b'b', b'c']]
+    etags = {imzml_cobj.key: '"imzml"', ibd_cobj.key: '"ibd"', other_cobj.key: '"ibd"'}
+
+    with patch.object(storage, 'head_object', lambda bucket, key: {'ETag': etags[key]}):
+        key = cache.entry_key(imzml_cobj, ibd_cobj, 128)
+        # Another copy of the same file
+        assert key == cache.entry_key(imzml_cobj, other_cobj, 128)
+        assert key != cache.entry_key(ibd_cobj, other_cobj, 128)
+        assert key != cache.entry_key(imzml_cobj, ibd_cobj, 64)
+
+    # The localhost backend doesn't provide ETags
+    assert cache.entry_key(imzml_cobj, ibd_cobj, 128) is None
+
+
+def test_ds_segments_cache_round_trip(executor: Executor, sm_config):
+    storage = executor.storage
+    cache = DSSegmentsCache(storage, sm_config['lithops'])
+    _, other_ibd_cobj = upload_example_ds(storage)
+    try:
+        assert cache.load('a', other_ibd_cobj) is None
+
+        ds_segments, segm_dfs = make_ds_segments(storage, 12)
+        imzml_reader = ds_segments[0]
+        cache.save(executor, 'a', ds_segments)
+        # Cached segments must survive the job that made them being cleaned up
+        storage.delete_cloudobjects([*ds_segments[2], imzml_reader.ibd_cobject])
+
+        cached_reader, bounds, segms_cobjs, segm_lens = cache.load('a', other_ibd_cobj)
+        assert np.array_equal(bounds, ds_segments[1])
+        assert np.array_equal(segm_lens, ds_segments[3])
+        for df, cached_df in zip(segm_dfs, load_cobjs(storage, segms_cobjs)):
+            pd.testing.assert_frame_equal(df, cached_df)
+        # The reader reads from the loading job's copy of the .ibd file
+        assert cached_reader.ibd_cobject == other_ibd_cobj
+        assert imzml_reader.ibd_cobject != other_ibd_cobj
+        _, mzs, ints = next(cached_reader.iter_spectra(storage, [0]))
+        assert len(mzs) == len(ints) > 0
+    finally:
+        cache.clean()
+
+
+def test_ds_segments_cache_evicts_least_recently_used(executor: Executor, sm_config):
+    storage = executor.storage
+    cache = DSSegmentsCache(storage, sm_config['lithops'])
+    try:
+        ds_segments, _ = make_ds_segments(storage, 2, n_rows=2 ** 16)
+        for key in ['a', 'b', 'c']:
+            cache.save(executor, key, ds_segments)
+        cache.load('a', None)
+        entry_size_mb = (
+            sum(o['Size'] for o in storage.list_objects(cache.bucket, f'{cache.prefix}/a/'))
+            / 2 ** 20
+        )
+
+        cache.max_size_mb = 2.5 * entry_size_mb
+        cache.save(executor, 'd', ds_segments)
+
+        assert cache.load('b', None) is None
+        assert cache.load('c', None) is None
+        assert cache.load('a', None) is not None
+        assert cache.load('d', None) is not None
+    finally:
+        cache.clean()
+
+
+def test_pipeline_cacher_clean_keeps_cached_ds_segments(executor: Executor, sm_config):
+    storage = executor.storage
+    cache = DSSegmentsCache(storage, sm_config['lithops'])
+    cacher = PipelineCacher(storage, 'test_cache', sm_config['lithops'])
+    try:
+        ds_segments, _ = make_ds_segments(storage, 2)
+        segms_cobjs = cache.save(executor, 'a', ds_segments)
+        cacher.save(({'ds_segms_cobjs': segms_cobjs}, None), 'load_ds')
+
+        cacher.clean()
+
+        assert not cacher.exists('load_ds')
+        assert len(load_cobjs(storage, cache.load('a', None)[2])) == 2
+    finally:
+        cache.clean()
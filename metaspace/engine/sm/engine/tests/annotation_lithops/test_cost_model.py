@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation_lithops.cost_model import CostModel, prediction_report
+from sm.engine.annotation_lithops.prepare_results import _split_png_jobs
+from sm.engine.annotation_lithops.segment_centroids import define_centr_segments
+
+
+def make_centr_segm_entry(rng, n_activations=30):
+    db_segm_lens = rng.integers(1000, 50000, n_activations)
+    ds_segm_lens = rng.integers(10 ** 5, 10 ** 7, n_activations)
+    exec_times = 2 + db_segm_lens * 1e-3 + ds_segm_lens * 1e-6
+    return {
+        'cost_factors': None,
+        'exec_times': exec_times.tolist(),
+        'subtask_data': {
+            'db_segm_len': db_segm_lens.tolist(),
+            'ds_segm_len': ds_segm_lens.tolist(),
+            'metrics_n': [None] * n_activations,
+        },
+    }
+
+
+def test_cost_model_fits_history():
+    rng = np.random.default_rng(42)
+    history = [('process_centr_segment', make_centr_segm_entry(rng)) for _ in range(3)]
+    history.append(('unmodelled_stage', make_centr_segm_entry(rng)))
+
+    cost_model = CostModel.from_history(history)
+
+    assert set(cost_model.stage_models) == {'process_centr_segment'}
+    model = cost_model.stage_models['process_centr_segment']
+    assert np.isclose(model.overhead_s, 2)
+    assert np.allclose(model.coefs, [1e-3, 1e-6])
+    # 2s overhead + 100s of work per activation
+    n_jobs = cost_model.n_jobs_for_target_time(
+        'process_centr_segment', {'db_segm_len': 10 ** 6, 'ds_segm_len': 10 ** 8}, 52
+    )
+    assert n_jobs == 22
+    assert cost_model.n_jobs_for_target_time('save_png_chunk', {}, 60) is None
+
+    report = prediction_report(cost_model, 'process_centr_segment', make_centr_segm_entry(rng))
+    assert np.allclose(report.predicted, report.actual)
+
+
+def test_define_centr_segments_with_cost_model():
+    rng = np.random.default_rng(42)
+    cost_model = CostModel.from_history(
+        [('process_centr_segment', make_centr_segm_entry(rng)) for _ in range(3)]
+    )
+    first_peak_mzs = np.sort(rng.uniform(100, 1000, 10000))
+    fexec = SimpleNamespace(cost_model=cost_model, map=lambda *args, **kwargs: [first_peak_mzs])
+
+    # 4000s of centroids work, plus 2000s of dataset reading that can't be split any finer than
+    # one 100s dataset segment per activation. The target is then twice the 102s that each
+    # activation takes regardless, which needs 4000s / (204s - 2s - 100s) activations
+    centr_segm_lower_bounds = define_centr_segments(
+        fexec,
+        [],
+        centr_n=4 * 10 ** 6,
+        ds_size_mb=10 * 1024,
+        ds_segm_lens=np.full(10, 10 ** 8),
+        ds_read_amplification_est=2.0,
+    )
+
+    assert len(centr_segm_lower_bounds) == 40
+
+
+def test_cost_model_ignores_failed_activations():
+    rng = np.random.default_rng(42)
+    entry = make_centr_segm_entry(rng, 25)
+    entry['exec_times'][:10] = [-1] * 10
+
+    assert CostModel.from_history([('process_centr_segment', entry)]).stage_models == {}
+
+
+def make_image_tasks_df(rng, n_formulas=1000):
+    n_cobjs = 10
+    return pd.DataFrame(
+        {
+            'cobj': [
+                SimpleNamespace(key=f'cobj{i * n_cobjs // n_formulas}') for i in range(n_formulas)
+            ],
+            'n_pixels': rng.integers(0, 10000, n_formulas),
+        },
+        index=pd.RangeIndex(n_formulas, name='formula_i'),
+    )
+
+
+def test_split_png_jobs_without_cost_model():
+    image_tasks_df = make_image_tasks_df(np.random.default_rng(42))
+
+    jobs, job_factors = _split_png_jobs(image_tasks_df, 100, 100)
+
+    assert len(jobs) == 1
+    assert job_factors.to_dict('records') == [
+        {
+            'n_formulas': 1000,
+            'n_pixels': image_tasks_df.n_pixels.sum(),
+            'image_area': 1000 * 100 * 100,
+            'n_cobjs': 10,
+        }
+    ]
+
+
+def test_split_png_jobs_balances_predicted_time():
+    rng = np.random.default_rng(42)
+    image_tasks_df = make_image_tasks_df(rng)
+    n_activations = 30
+    factors = pd.DataFrame(
+        {
+            'n_formulas': rng.integers(1, 1000, n_activations),
+            'n_pixels': rng.integers(0, 10 ** 6, n_activations),
+            'image_area': rng.integers(0, 10 ** 7, n_activations),
+            'n_cobjs': rng.integers(1, 10, n_activations),
+        }
+    )
+    exec_times = 1 + factors.n_formulas * 0.01 + factors.n_pixels * 1e-5 + factors.n_cobjs * 0.5
+    cost_model = CostModel.from_history(
+        [
+            (
+                'save_png_chunk',
+                {'cost_factors': factors.to_dict('list'), 'exec_times': exec_times.tolist()},
+            )
+        ]
+    )
+
+    jobs, job_factors = _split_png_jobs(image_tasks_df, 100, 100, cost_model)
+
+    assert len(jobs) > 1
+    assert sum(len(df) for df, in jobs) == len(image_tasks_df)
+    predicted = cost_model.predict('save_png_chunk', job_factors)
+    assert predicted.max() < 60 * 1.2
+    assert predicted.max() / predicted.min() < 1.5
@@ -0,0 +1,160 @@
+import os
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from sm.engine.annotation_lithops.executor import Executor, _pick_stragglers, _run_speculatively
+from sm.engine.annotation_lithops.io import load_cobjs, save_cobj
+from sm.engine.annotation_lithops.process_pool import available_memory_mb
+from sm.engine.utils.perf_profile import NullProfiler
+from tests.conftest import sm_config
+
+
+class RecordingProfiler(NullProfiler):
+    def __init__(self):
+        self.entries = []
+
+    def record_entry(self, name, start=None, finish=None, **extra_data):
+        self.entries.append((name, extra_data))
+
+
+def test_map_retries_only_failed_items(sm_config):
+    perf = RecordingProfiler()
+    executor = Executor(sm_config['lithops'], perf=perf, debug_run_locally=True)
+    calls = []
+
+    def double(i):
+        calls.append(i)
+        if i == 2 and calls.count(2) == 1:
+            raise MemoryError()
+        return i * 2
+
+    results = executor.map(double, [(i,) for i in range(4)])
+
+    assert results == [0, 2, 4, 6]
+    assert calls == [0, 1, 2, 3, 2]
+    assert [extra_data.get('attempts') for _, extra_data in perf.entries] == [1, None, 2]
+    assert perf.entries[1][1]['failed_items'] == [2]
+    assert perf.entries[2][1]['item_idxs'] == [2]
+    assert perf.entries[2][1]['runtime_memory'] == 1024
+
+
+def test_map_in_process_pool(sm_config):
+    perf = RecordingProfiler()
+    executor = Executor(sm_config['lithops'], perf=perf, local_processes=2)
+    offset = 10  # Closures can't be pickled, so this also checks that workers are forked
+
+    def make_df(i, storage):
+        if i == 2 and storage.get_object(bucket, key) == b'first':
+            storage.put_object(bucket, key, b'second')
+            raise MemoryError()
+        # Large enough to be passed through shared memory
+        return pd.DataFrame({'i': np.full(2 ** 18, i + offset), 'x': np.arange(2 ** 18) / 2})
+
+    bucket = sm_config['lithops']['lithops']['storage_bucket']
+    key = 'test_executor/attempt'
+    executor.storage.put_object(bucket, key, b'first')
+    try:
+        results = executor.map(make_df, [(i,) for i in range(4)])
+    finally:
+        executor.storage.delete_object(bucket, key)
+
+    for i, df in enumerate(results):
+        assert_frame_equal(
+            df, pd.DataFrame({'i': np.full(2 ** 18, i + offset), 'x': np.arange(2 ** 18) / 2})
+        )
+    assert [extra_data.get('attempts') for _, extra_data in perf.entries] == [1, None, 2]
+    assert perf.entries[1][1]['failed_items'] == [2]
+
+
+def test_map_in_process_pool_saves_distinct_cobjects(sm_config):
+    executor = Executor(sm_config['lithops'], local_processes=2)
+
+    def save_item(i, storage):
+        time.sleep(0.1)  # Make sure both workers are used
+        return save_cobj(storage, i)
+
+    cobjs = executor.map(save_item, [(i,) for i in range(4)])
+    try:
+        assert len({cobj.key for cobj in cobjs}) == 4
+        assert load_cobjs(executor.storage, cobjs) == [0, 1, 2, 3]
+    finally:
+        executor.storage.delete_cloudobjects(cobjs)
+
+
+def test_available_memory_mb_is_less_than_physical_memory():
+    physical_memory_mb = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2 ** 20
+
+    assert 0 < available_memory_mb() < physical_memory_mb
+
+
+def test_pick_stragglers():
+    runtimes = np.array([10, 12, 11, 9, np.nan, np.nan, np.nan, np.nan])
+    elapsed = np.array([10, 12, 11, 9, 100, 200, 15, 300])
+    can_duplicate = np.array([False] * 4 + [True, True, True, False])
+
+    with patch('sm.engine.annotation_lithops.executor.SPECULATION_MIN_RUNTIME_S', 0):
+        assert _pick_stragglers(runtimes, elapsed, can_duplicate, 10) == [5, 4]
+        assert _pick_stragglers(runtimes, elapsed, can_duplicate, 1) == [5]
+        # Too few items have finished to know what's slow
+        assert _pick_stragglers(runtimes[2:], elapsed[2:], can_duplicate[2:], 10) == []
+
+
+class FakeFuture:
+    def __init__(self, value, duration):
+        self.value = value
+        self.finish_time = time.monotonic() + duration
+        self.activation_id = f'activation-{value}'
+        self.error = False
+        self.ready = False
+        self.success = False
+        self.done = False
+
+    def result(self, throw_except=True, internal_storage=None):
+        return self.value, None
+
+
+class FakeLithopsExecutor:
+    """Runs items instantly, but only reports them as finished after their duration"""
+
+    internal_storage = None
+
+    def __init__(self, durations):
+        self.durations = durations
+        self.submitted = []
+
+    def map(self, func, iterdata, runtime_memory=None, **kwargs):
+        futures = []
+        for (i,) in iterdata:
+            futures.append(FakeFuture(func(i), self.durations[i].pop(0)))
+            self.submitted.append(i)
+        return futures
+
+    def wait(self, fs, throw_except=True, return_when=None, download_results=False):
+        if return_when != 0:
+            time.sleep(max(max(f.finish_time for f in fs) - time.monotonic(), 0))
+        for f in fs:
+            f.ready = time.monotonic() >= f.finish_time
+
+
+@patch('sm.engine.annotation_lithops.executor.SPECULATION_MIN_RUNTIME_S', 0)
+@patch('sm.engine.annotation_lithops.executor.SPECULATION_POLL_INTERVAL_S', 0.01)
+def test_run_speculatively_takes_first_copy_to_finish():
+    # Item 3's first copy is a straggler, its duplicate is as fast as the other items
+    durations = {i: [0.05] for i in range(10)}
+    durations[3] = [10, 0.05]
+    fake_executor = FakeLithopsExecutor(durations)
+
+    start = time.monotonic()
+    result = _run_speculatively(
+        fake_executor, lambda i: i * 2, [(i,) for i in range(10)], 1024, {}, speculate=True
+    )
+
+    assert time.monotonic() - start < 5
+    assert [val for val, _ in result.return_vals] == [i * 2 for i in range(10)]
+    assert fake_executor.submitted == [*range(10), 3]
+    assert result.speculation == {'duplicates': 1, 'duplicate_wins': 1}
+    assert result.errors == {}
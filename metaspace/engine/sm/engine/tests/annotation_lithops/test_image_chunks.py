@@ -0,0 +1,61 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation_lithops.image_chunks import (
+    serialize_image_chunk,
+    deserialize_image_chunk,
+    load_image_chunk_formulas,
+)
+from sm.engine.tests.annotation_lithops.utils import RangeStorageMock, CObjMock
+
+
+def make_images(rng, n_formulas, nrows, ncols):
+    images = {}
+    for formula_i in rng.choice(1000, n_formulas, replace=False).tolist():
+        f_images = []
+        for _ in range(4):
+            if rng.random() < 0.3:
+                f_images.append(None)
+            else:
+                n = rng.integers(1, 50)
+                # Duplicate pixels are possible, e.g. from multiple peaks of a spectrum
+                f_images.append(
+                    coo_matrix(
+                        (
+                            rng.random(n).astype(np.float32),
+                            (rng.integers(0, nrows, n), rng.integers(0, ncols, n)),
+                        ),
+                        shape=(nrows, ncols),
+                    )
+                )
+        images[formula_i] = f_images
+    return images
+
+
+def assert_images_equal(images, expected):
+    assert images.keys() == expected.keys()
+    for formula_i, f_images in images.items():
+        assert len(f_images) == len(expected[formula_i])
+        for img, exp_img in zip(f_images, expected[formula_i]):
+            assert (img is None) == (exp_img is None)
+            if img is not None:
+                np.testing.assert_allclose(img.toarray(), exp_img.toarray(), rtol=1e-6)
+
+
+def test_image_chunk_round_trip():
+    images = make_images(np.random.default_rng(42), 30, 20, 30)
+
+    data = serialize_image_chunk(images, 20, 30)
+
+    assert_images_equal(deserialize_image_chunk(data), images)
+
+
+def test_load_image_chunk_formulas():
+    images = make_images(np.random.default_rng(42), 30, 20, 30)
+    storage = RangeStorageMock(serialize_image_chunk(images, 20, 30))
+    formula_is = list(images.keys())[10:12]
+
+    result = load_image_chunk_formulas(storage, CObjMock(), formula_is)
+
+    assert_images_equal(result, {f_i: images[f_i] for f_i in formula_is})
+    assert sum(hi - lo for lo, hi in storage.requests) < len(storage.data)
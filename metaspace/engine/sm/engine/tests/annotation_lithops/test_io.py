@@ -0,0 +1,111 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation_lithops.io import (
+    serialize,
+    deserialize,
+    SERIALIZATION_MAGIC,
+    CObjRangeReader,
+    plan_range_requests,
+)
+from sm.engine.tests.annotation_lithops.utils import RangeStorageMock, CObjMock
+
+
+@pytest.mark.parametrize('compression', [None, 'lz4', 'zstd'])
+def test_serialize_dataframe(compression):
+    df = pd.DataFrame(
+        {
+            'mz': np.linspace(100, 200, 1000),
+            'int': np.ones(1000, dtype=np.float32),
+            'sp_i': np.arange(1000, dtype=np.uint32),
+            'formula': ['H2O'] * 1000,
+        },
+        index=pd.Index(np.arange(1000) * 2, name='formula_i'),
+    )
+
+    data = serialize(df, compression)
+
+    assert data.startswith(SERIALIZATION_MAGIC)
+    assert_frame_equal(deserialize(data), df)
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd'])
+def test_serialize_ndarray(compression):
+    arr = np.arange(24, dtype='>i4').reshape(2, 3, 4)[:, ::2]
+
+    result = deserialize(serialize(arr, compression))
+
+    assert result.dtype == arr.dtype
+    np.testing.assert_array_equal(result, arr)
+
+
+@pytest.mark.parametrize('compression', [None, 'lz4'])
+def test_serialize_other_objects(compression):
+    obj = ({1: [coo_matrix(np.eye(3)), None]}, ['a', 'b'], np.array(['x', 1], dtype=object))
+
+    img_dict, names, obj_arr = deserialize(serialize(obj, compression))
+
+    np.testing.assert_array_equal(img_dict[1][0].toarray(), np.eye(3))
+    assert img_dict[1][1] is None
+    assert names == ['a', 'b']
+    assert obj_arr.tolist() == ['x', 1]
+
+
+def test_serialize_dataframe_with_duplicate_columns():
+    df = pd.DataFrame([[1, 2.5], [3, 4.5]], columns=['a', 'a'])
+
+    assert_frame_equal(deserialize(serialize(df)), df)
+
+
+def test_deserialize_legacy_pickle():
+    df = pd.DataFrame({'a': [1, 2]})
+
+    assert_frame_equal(deserialize(pickle.dumps(df)), df)
+
+
+def test_deserialize_newer_version_fails():
+    data = bytearray(serialize([1]))
+    data[len(SERIALIZATION_MAGIC)] = 255
+
+    with pytest.raises(ValueError):
+        deserialize(bytes(data))
+
+
+def test_plan_range_requests():
+    ranges = np.array([[100, 110], [0, 10], [20, 30], [25, 28], [1000, 1010], [1010, 1500]])
+
+    request_ranges, request_idxs = plan_range_requests(ranges, max_gap=80, max_request_size=200)
+
+    np.testing.assert_array_equal(request_ranges, [[0, 110], [1000, 1500]])
+    np.testing.assert_array_equal(request_idxs, [0, 0, 0, 0, 1, 1])
+
+
+def test_plan_range_requests_splits_large_requests():
+    ranges = np.column_stack([np.arange(0, 1000, 10), np.arange(0, 1000, 10) + 10])
+
+    request_ranges, request_idxs = plan_range_requests(ranges, max_gap=50, max_request_size=100)
+
+    assert len(request_ranges) == 10
+    assert np.all(np.diff(request_ranges, axis=1) <= 100)
+    assert np.all(ranges[:, 0] >= request_ranges[request_idxs, 0])
+    assert np.all(ranges[:, 1] <= request_ranges[request_idxs, 1])
+
+
+def test_cobj_range_reader():
+    data = bytes(range(256)) * 100
+    storage = RangeStorageMock(data)
+    ranges = [(5000, 5100), (0, 10), (10, 10), (20, 30), (25000, 25600)]
+    reader = CObjRangeReader(storage, CObjMock(), max_gap=100, max_request_size=1000)
+
+    result = reader.read(ranges)
+
+    assert result == [data[lo:hi] for lo, hi in ranges]
+    assert sorted(storage.requests) == [(0, 30), (5000, 5100), (25000, 25600)]
+    assert reader.stats['requests'] == 3
+    assert reader.stats['bytes_fetched'] == 730
+    assert reader.stats['bytes_requested'] == 720
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation_lithops.build_moldb import store_formula_segments
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import load_cobjs, save_cobj
+from sm.engine.annotation_lithops.ion_metrics_cache import IonMetricsCacheEntry
+from sm.engine.annotation_lithops.load_ds import load_ds
+from sm.engine.annotation_lithops.pipeline import Pipeline
+from sm.engine.tests.annotation_lithops.utils import upload_imzml
+from tests.conftest import executor, sm_config, ds_config
+
+
+def make_formulas_df(ions):
+    return pd.DataFrame(
+        ions, columns=['ion_formula', 'target', 'targeted'], index=range(len(ions))
+    ).rename_axis(index='formula_i')
+
+
+def annotate(storage, formulas_df, metric_ion_formulas):
+    """Fakes annotation results with one image chunk per ion"""
+    df = formulas_df[formulas_df.ion_formula.isin(metric_ion_formulas)]
+    metrics_df = pd.DataFrame({'msm': [len(f) / 10 for f in df.ion_formula]}, index=df.index)
+    images_df = pd.DataFrame(
+        {'n_pixels': 1, 'cobj': [save_cobj(storage, f) for f in df.ion_formula]}, index=df.index
+    )
+    return metrics_df, images_df
+
+
+def test_ion_metrics_cache_reuses_ions_with_same_flags(executor: Executor, sm_config, ds_config):
+    storage = executor.storage
+    cache = IonMetricsCacheEntry(
+        executor, sm_config['lithops']['sm_storage'], 'ds', ds_config, use_db_mutex=False
+    )
+    formulas_df = make_formulas_df(
+        [('C1H2+H', True, False), ('C2H2+H', True, False), ('C3H2+H', False, False)]
+    )
+
+    missing_cobjs, stored_metrics_df, _ = cache.split_formulas(
+        store_formula_segments(storage, formulas_df)
+    )
+    assert stored_metrics_df.empty
+    assert pd.concat(load_cobjs(storage, missing_cobjs)).equals(formulas_df)
+    cache.save(missing_cobjs, *annotate(storage, formulas_df, ['C1H2+H', 'C2H2+H']))
+
+    # New ion C4H2+H, C2H2+H is now a decoy, C3H2+H was annotated but has no metrics
+    formulas_df = make_formulas_df(
+        [
+            ('C2H2+H', False, False),
+            ('C3H2+H', False, False),
+            ('C1H2+H', True, False),
+            ('C4H2+H', True, False),
+        ]
+    )
+    missing_cobjs, stored_metrics_df, stored_images_df = cache.split_formulas(
+        store_formula_segments(storage, formulas_df)
+    )
+
+    missing_df = pd.concat(load_cobjs(storage, missing_cobjs))
+    assert missing_df.ion_formula.tolist() == ['C2H2+H', 'C4H2+H']
+    assert stored_metrics_df.msm.to_dict() == {2: 0.6}
+    assert load_cobjs(storage, stored_images_df.cobj) == ['C1H2+H']
+    # Images are looked up in their chunk by the formula_i of the run that made the chunk
+    assert stored_images_df.chunk_formula_i.to_dict() == {2: 0}
+
+    cache.save(missing_cobjs, *annotate(storage, missing_df, ['C4H2+H']))
+    _, stored_metrics_df, stored_images_df = cache.split_formulas(
+        store_formula_segments(storage, formulas_df)
+    )
+    assert stored_metrics_df.msm.to_dict() == {2: 0.6, 3: 0.6}
+    assert sorted(load_cobjs(storage, stored_images_df.cobj)) == ['C1H2+H', 'C4H2+H']
+    # The image chunk of C2H2+H is no longer used
+    assert len(storage.list_keys(cache.bucket, cache.images_prefix)) == 2
+
+
+def test_pipeline_restores_spectra_stats_when_all_ions_are_stored(
+    executor: Executor, sm_config, ds_config
+):
+    storage = executor.storage
+    imzml_cobj, ibd_cobj = upload_imzml(storage, with_spectra_stats=False)
+    formulas_df = make_formulas_df([('C1H2+H', True, False), ('C2H2+H', True, False)])
+
+    def make_pipeline():
+        pipe = Pipeline(
+            imzml_cobj,
+            ibd_cobj,
+            [],
+            ds_config,
+            executor=executor,
+            lithops_config=sm_config['lithops'],
+            use_db_mutex=False,
+            ion_metrics_key='ds',
+        )
+        (
+            pipe.formula_cobjs,
+            pipe.stored_metrics_df,
+            pipe.stored_images_df,
+        ) = pipe.ion_metrics_cache.split_formulas(store_formula_segments(storage, formulas_df))
+        return pipe
+
+    # First run: all ions are annotated, so all spectra are read
+    pipe = make_pipeline()
+    assert pipe.formula_cobjs
+    pipe.imzml_reader, *_ = load_ds(executor, imzml_cobj, ibd_cobj, 1)
+    pipe.formula_metrics_df, pipe.images_df = annotate(storage, formulas_df, ['C1H2+H'])
+    pipe.merge_stored_ion_metrics()
+
+    # Second run: all ions have stored metrics, so no spectra are read
+    pipe2 = make_pipeline()
+    assert not pipe2.formula_cobjs
+    pipe2.load_imzml_reader()
+
+    exp_reader, reader = pipe.imzml_reader, pipe2.imzml_reader
+    assert reader.has_spectra_stats
+    np.testing.assert_array_equal(reader.tic_image(), exp_reader.tic_image())
+    assert (reader.min_mz, reader.max_mz) == (exp_reader.min_mz, exp_reader.max_mz)
+
+    # Entries stored before spectra stats were saved don't have them
+    storage.delete_cloudobject(pipe2.ion_metrics_cache.spectra_stats_cobj)
+    pipe2.load_imzml_reader()
+    assert not pipe2.imzml_reader.has_spectra_stats
@@ -0,0 +1,48 @@
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import load_cobjs
+from sm.engine.annotation_lithops.load_ds import load_ds
+from sm.engine.tests.annotation_lithops.utils import upload_imzml
+from tests.conftest import executor, sm_config
+
+
+@patch('sm.engine.annotation_lithops.load_ds.DISTRIBUTED_SAMPLE_PEAKS', 1000)
+@patch('sm.engine.annotation_lithops.load_ds.DISTRIBUTED_CHUNK_SIZE_MB', 0.02)
+def test_load_ds_distributed_matches_single_activation(executor: Executor, sm_config):
+    imzml_cobj, ibd_cobj = upload_imzml(executor.storage, with_spectra_stats=False)
+    centr_segm_bounds = np.array([[150.0, 160.0], [200.0, 300.0], [450.0, 460.0]])
+
+    exp_imzml_reader, _, exp_segms_cobjs, exp_segm_lens, _ = load_ds(
+        executor, imzml_cobj, ibd_cobj, 0.02, centr_segm_bounds, distributed=False
+    )
+    # Activations must run in separate processes, so that the reader returned by the planning
+    # activation isn't updated by the other activations reading spectra
+    process_executor = Executor(sm_config['lithops'], local_processes=2)
+    imzml_reader, segms_bounds, segms_cobjs, segm_lens, est_read_amplification = load_ds(
+        process_executor, imzml_cobj, ibd_cobj, 0.02, centr_segm_bounds, distributed=True
+    )
+
+    segms = load_cobjs(executor.storage, segms_cobjs)
+    assert len(segms) > 1
+    assert est_read_amplification is not None
+    assert segms_bounds.shape == (len(segms), 2)
+    assert list(segm_lens) == [len(segm) for segm in segms]
+    assert all(isinstance(segm.index, pd.RangeIndex) for segm in segms)
+    assert all(
+        segm.mz.min() == lo and segm.mz.max() == hi for segm, (lo, hi) in zip(segms, segms_bounds)
+    )
+    assert np.all(segm_lens * 16 <= 0.02 * 2 ** 20)
+    # Segment bounds may differ, but all peaks must be in the same order with the same index
+    assert_frame_equal(pd.concat(segms), pd.concat(load_cobjs(executor.storage, exp_segms_cobjs)))
+    assert sum(segm_lens) == sum(exp_segm_lens)
+    # The reader must have the stats of all spectra, not just the sampled ones
+    np.testing.assert_array_equal(imzml_reader.tic_image(), exp_imzml_reader.tic_image())
+    assert (imzml_reader.min_mz, imzml_reader.max_mz) == (
+        exp_imzml_reader.min_mz,
+        exp_imzml_reader.max_mz,
+    )
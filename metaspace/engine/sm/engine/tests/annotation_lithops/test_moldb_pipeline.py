@@ -2,7 +2,7 @@ from typing import List
 from unittest.mock import patch
 import pandas as pd
 
-from sm.engine.annotation_lithops.build_moldb import InputMolDb
+from sm.engine.annotation_lithops.build_moldb import InputMolDb, get_formulas_df
 from tests.conftest import executor, sm_config, ds_config
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import save_cobj, load_cobjs
@@ -53,3 +53,29 @@ def test_get_moldb_centroids(LockMock, executor: Executor, sm_config, ds_config)
     assert peaks_df.loc[
         h2so4_formula_i1
     ].targeted.any(), "H2SO4 should be targeted as it's in a targeted DB"
+
+
+def test_get_formulas_df_shares_decoys_between_dbs(executor: Executor, ds_config):
+    formulas0 = ['H2O', 'CO2', 'C6H12O6']
+    # Decoys depend on the formula's position in the DB when they aren't shared
+    formulas1 = ['C6H12O6', 'H2SO4', 'CO2']
+    moldbs: List[InputMolDb] = [
+        {'id': 0, 'targeted': False, 'cobj': save_cobj(executor.storage, formulas0)},
+        {'id': 1, 'targeted': False, 'cobj': save_cobj(executor.storage, formulas1)},
+    ]
+
+    _, formulas_df = get_formulas_df(executor.storage, ds_config, moldbs)
+    ds_config['fdr']['share_decoys'] = True
+    db_data_cobjs, shared_formulas_df = get_formulas_df(executor.storage, ds_config, moldbs)
+
+    # Both DBs get the same decoys for CO2 and C6H12O6, so fewer ions need to be annotated
+    assert shared_formulas_df.target.sum() == formulas_df.target.sum()
+    assert len(shared_formulas_df) < len(formulas_df)
+    map_df0, map_df1 = [
+        db_data['formula_map_df'].set_index(['formula', 'modifier'])
+        for db_data in load_cobjs(executor.storage, db_data_cobjs)
+    ]
+    for formula in ['CO2', 'C6H12O6']:
+        assert map_df0.loc[formula].equals(map_df1.loc[formula])
+    assert set(map_df0.index.get_level_values('formula')) == set(formulas0)
+    assert set(map_df1.index.get_level_values('formula')) == set(formulas1)
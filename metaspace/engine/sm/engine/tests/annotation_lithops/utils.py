@@ -0,0 +1,47 @@
+import re
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from pyimzml.ImzMLWriter import ImzMLWriter
+
+
+class RangeStorageMock:
+    """Storage that serves byte ranges of a single object and records the requested ranges"""
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+
+    def get_object(self, bucket, key, extra_get_args):
+        lo, hi = map(int, extra_get_args['Range'][len('bytes=') :].split('-'))
+        self.requests.append((lo, hi + 1))
+        return self.data[lo : hi + 1]
+
+
+class CObjMock:
+    bucket = 'bucket'
+    key = 'key'
+
+
+def strip_spectra_stats(imzml: bytes) -> bytes:
+    """Removes the per-spectrum TIC and mz range metadata from an .imzML file, so that readers
+    have to calculate them from the spectra"""
+    return re.sub(rb'\s*<cvParam [^>]*accession="MS:(1000285|1000527|1000528)"[^>]*/>', b'', imzml)
+
+
+def upload_imzml(storage, n_spectra=60, with_spectra_stats=True):
+    rng = np.random.default_rng(42)
+    with TemporaryDirectory() as tmpdir:
+        with ImzMLWriter(f'{tmpdir}/test.imzML', mz_dtype=np.float64) as writer:
+            for i in range(n_spectra):
+                # Rounded mzs so that many peaks share the same mz
+                mzs = np.sort(np.round(rng.uniform(100, 500, rng.integers(1, 200)), 1))
+                ints = rng.uniform(1, 100, len(mzs)).astype(np.float32)
+                writer.addSpectrum(mzs, ints, (i % 10 + 1, i // 10 + 1, 1))
+
+        imzml = open(f'{tmpdir}/test.imzML', 'rb').read()
+        if not with_spectra_stats:
+            imzml = strip_spectra_stats(imzml)
+        imzml_cobj = storage.put_cloudobject(imzml)
+        ibd_cobj = storage.put_cloudobject(open(f'{tmpdir}/test.ibd', 'rb').read())
+    return imzml_cobj, ibd_cobj
@@ -39,7 +39,35 @@ class TestMsmBasicSearch:
 
         assert len(moldb_fdr_list) == 1
         _, fdr = moldb_fdr_list[0]
-        assert not fdr.td_df.empty
+        assert fdr.td_table.dm_i.size > 0
+
+    def test_init_fdr_shares_decoys_between_dbs(self, fetch_formulas_mock):
+        # Decoys depend on the formula's position in the DB when they aren't shared
+        db_formulas = {0: ['H2O', 'CO2', 'C6H12O6'], 1: ['C6H12O6', 'H2SO4', 'CO2']}
+        fetch_formulas_mock.side_effect = lambda moldb_id: db_formulas[moldb_id]
+        ds_config = {
+            'analysis_version': 1,
+            'fdr': {'decoy_sample_size': 20},
+            'isotope_generation': BASIC_ISOTOPE_GENERATION_CONFIG,
+        }
+        moldbs = [MolecularDB(0, 'db0', 'version'), MolecularDB(1, 'db1', 'version')]
+
+        def get_td_dfs_and_ions():
+            moldb_fdr_list = init_fdr(ds_config, moldbs)
+            td_dfs = [fdr.td_table.to_df().set_index('formula') for _, fdr in moldb_fdr_list]
+            ions = {ion for _, fdr in moldb_fdr_list for ion in fdr.ion_tuples()}
+            return td_dfs, ions
+
+        (td_df0, td_df1), ions = get_td_dfs_and_ions()
+        ds_config['fdr']['share_decoys'] = True
+        (shared_td_df0, shared_td_df1), shared_ions = get_td_dfs_and_ions()
+
+        for formula in ['CO2', 'C6H12O6']:
+            assert not td_df0.loc[formula].equals(td_df1.loc[formula])
+            assert shared_td_df0.loc[formula].equals(shared_td_df1.loc[formula])
+        assert set(shared_td_df0.index) == set(db_formulas[0])
+        assert set(shared_td_df1.index) == set(db_formulas[1])
+        assert len(shared_ions) < len(ions)
 
     def test_collect_ion_formulas(self, fetch_formulas_mock, spark_context):
         ds_config = {
@@ -2,8 +2,10 @@ from pathlib import Path
 from unittest.mock import Mock, patch
 import numpy as np
 import pandas as pd
+import pytest
 from itertools import product
-from numpy.testing import assert_array_almost_equal
+from tempfile import TemporaryDirectory
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 
 from sm.engine.annotation.imzml_reader import FSImzMLReader
 from sm.engine.annotation_spark.segmenter import (
@@ -12,7 +14,16 @@ from sm.engine.annotation_spark.segmenter import (
     segment_ds,
     calculate_chunk_sp_n,
     fetch_chunk_spectra_data,
+    DSSegment,
+    ds_segment_path,
+    load_ds_segment,
+    save_ds_segment,
+    merge_ds_segment_runs,
+    segment_spectra_chunk,
+    measure_read_amplification,
 )
+from pyimzml.ImzMLWriter import ImzMLWriter
+
 from tests.conftest import make_imzml_reader_mock
 
 
@@ -61,22 +72,172 @@ def test_define_ds_segments():
     assert np.allclose(ds_segments, exp_ds_segments)
 
 
-@patch('sm.engine.annotation_spark.segmenter.pickle.dump')
-def test_segment_ds(dump_mock):
+def test_segment_ds():
+    imzml_reader = make_imzml_reader_mock(
+        list(product([0], range(10))), (np.linspace(0, 90, num=10), np.ones(10))
+    )
+    ds_segments = np.array([[0, 50], [50, 90.0]])
+
+    chunk_sp_n = 4
+    with TemporaryDirectory() as tmpdir:
+        ds_segments_path = Path(tmpdir)
+        segment_ds(imzml_reader, chunk_sp_n, ds_segments, ds_segments_path)
+
+        assert sorted(p.name for p in ds_segments_path.iterdir()) == [
+            'ds_segm_0000.bin',
+            'ds_segm_0001.bin',
+        ]
+        for segm_i, (min_mz, max_mz) in enumerate(ds_segments):
+            ds_segm = load_ds_segment(ds_segment_path(ds_segments_path, segm_i))
+
+            assert len(ds_segm.mz) == 50
+            assert ds_segm.mz.dtype == imzml_reader.mz_precision
+            assert np.all(np.diff(ds_segm.mz) >= 0)
+            assert np.all(min_mz <= ds_segm.mz)
+            assert np.all(ds_segm.mz <= max_mz)
+            assert set(ds_segm.sp_idx) == set(imzml_reader.pixel_indexes)
+
+
+def test_measure_read_amplification():
     imzml_reader = make_imzml_reader_mock(
         list(product([0], range(10))), (np.linspace(0, 90, num=10), np.ones(10))
     )
     ds_segments = np.array([[0, 50], [50, 90.0]])
+    # The first range only needs the first segment. The second one needs a single mz from
+    # the second segment, but its lower bound also requires reading the first segment.
+    centr_segm_bounds = np.array([[0, 45], [45, 55]])
+
+    with TemporaryDirectory() as tmpdir:
+        ds_segments_path = Path(tmpdir)
+        segment_ds(imzml_reader, 4, ds_segments, ds_segments_path)
+
+        read_amplification = measure_read_amplification(
+            ds_segments_path, ds_segments, centr_segm_bounds
+        )
+
+    assert read_amplification == (50 + 100) / (50 + 10)
+
+
+def test_segment_ds_parallel():
+    rng = np.random.default_rng(42)
+    coordinates = list(product(range(1, 6), range(1, 8), [1]))
+    spectra = [
+        (np.sort(rng.uniform(10, 90, n)), rng.integers(0, 3, n).astype(np.float32))
+        for n in rng.integers(0, 30, len(coordinates))
+    ]
+    ds_segments = np.array([[10, 40], [40, 60], [60, 90.0]])
+
+    with TemporaryDirectory() as tmpdir:
+        with ImzMLWriter(f'{tmpdir}/test.imzML', mz_dtype=np.float64) as writer:
+            for coords, (mzs, ints) in zip(coordinates, spectra):
+                writer.addSpectrum(mzs, ints, coords)
+
+        ds_segms = {}
+        tics = {}
+        for n_workers in [1, 3]:
+            imzml_reader = FSImzMLReader(Path(tmpdir))
+            ds_segments_path = Path(tmpdir) / f'ds_segments_{n_workers}'
+            segment_ds(imzml_reader, 4, ds_segments, ds_segments_path, n_workers=n_workers)
+
+            assert sorted(p.name for p in ds_segments_path.iterdir()) == [
+                'ds_segm_0000.bin',
+                'ds_segm_0001.bin',
+                'ds_segm_0002.bin',
+            ]
+            ds_segms[n_workers] = [
+                load_ds_segment(ds_segment_path(ds_segments_path, segm_i)) for segm_i in range(3)
+            ]
+            tics[n_workers] = imzml_reader.tic_image()
+
+    for serial_segm, parallel_segm in zip(ds_segms[1], ds_segms[3]):
+        for col in ['sp_idx', 'mz', 'int']:
+            assert_array_equal(getattr(serial_segm, col), getattr(parallel_segm, col))
+    assert_array_equal(tics[1], tics[3])
+
+
+def test_merge_ds_segment_runs():
+    rng = np.random.default_rng(42)
+    mz_segments = np.array([[0, 50], [50, 100.0]])
+    with TemporaryDirectory() as tmpdir:
+        ds_segments_path = Path(tmpdir)
+        chunk_dfs = []
+        for _ in range(7):
+            n = rng.integers(0, 100)
+            sp_chunk_df = pd.DataFrame(
+                {
+                    'sp_idx': rng.integers(0, 1000, n).astype(np.uint32),
+                    'mz': np.round(rng.uniform(0, 100, n), 1),
+                    'int': rng.random(n).astype(np.float32),
+                }
+            ).sort_values(by='mz')
+            segment_spectra_chunk(sp_chunk_df, mz_segments, ds_segments_path)
+            chunk_dfs.append(sp_chunk_df)
+
+        for segm_i, (min_mz, max_mz) in enumerate(mz_segments):
+            merge_ds_segment_runs(ds_segments_path, segm_i, np.float64, buffer_rows=16)
+            ds_segm = load_ds_segment(ds_segment_path(ds_segments_path, segm_i))
 
-    chunk_sp_n = 1000
-    segment_ds(imzml_reader, chunk_sp_n, ds_segments, Path('/tmp/abc'))
+            exp_df = pd.concat(chunk_dfs)
+            exp_df = exp_df[(exp_df.mz >= min_mz) & (exp_df.mz < max_mz)]
+            exp_df = exp_df.sort_values(by='mz', kind='mergesort')
+            assert_array_equal(ds_segm.mz, exp_df.mz.values)
+            assert_array_equal(ds_segm.sp_idx, exp_df.sp_idx.values)
+            assert_array_equal(ds_segm.int, exp_df.int.values)
+
+        assert sorted(p.name for p in ds_segments_path.iterdir()) == [
+            'ds_segm_0000.bin',
+            'ds_segm_0001.bin',
+        ]
+
+
+@pytest.mark.parametrize('buffer_rows', [1, 7, 16, 1000])
+def test_merge_ds_segment_runs_keeps_order_of_equal_mzs(buffer_rows):
+    rng = np.random.default_rng(42)
+    with TemporaryDirectory() as tmpdir:
+        runs_paths = [Path(tmpdir) / 'runs_0', Path(tmpdir) / 'runs_1']
+        chunk_dfs = []
+        for runs_path in runs_paths:
+            runs_path.mkdir()
+            for _ in range(5):
+                n = rng.integers(0, 60)
+                # Few distinct mz values, so that equal mzs span blocks and runs
+                sp_chunk_df = pd.DataFrame(
+                    {
+                        'sp_idx': np.arange(n, dtype=np.uint32) + len(chunk_dfs) * 100,
+                        'mz': np.sort(rng.integers(0, 5, n)).astype(np.float64),
+                        'int': rng.random(n).astype(np.float32),
+                    }
+                )
+                segment_spectra_chunk(sp_chunk_df, np.array([[0, 10.0]]), runs_path)
+                chunk_dfs.append(sp_chunk_df)
+
+        merge_ds_segment_runs(Path(tmpdir), 0, np.float64, runs_paths, buffer_rows=buffer_rows)
+        ds_segm = load_ds_segment(ds_segment_path(Path(tmpdir), 0))
+
+        # Same as a stable sort of all runs, in order of directory and then of writing
+        exp_df = pd.concat(chunk_dfs).sort_values(by='mz', kind='mergesort')
+        assert_array_equal(ds_segm.mz, exp_df.mz.values)
+        assert_array_equal(ds_segm.sp_idx, exp_df.sp_idx.values)
+        assert_array_equal(ds_segm.int, exp_df.int.values)
+
+
+def test_save_load_ds_segment():
+    ds_segm = DSSegment(
+        sp_idx=np.array([3, 1, 2], dtype=np.uint32),
+        mz=np.array([100.5, 200.25, 300.125], dtype=np.float64),
+        int=np.array([10, 20, 30], dtype=np.float32),
+    )
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / 'segm.bin'
+        save_ds_segment(path, ds_segm)
+        loaded = load_ds_segment(path)
 
-    for segm_i, ((sp_chunk_df, f), _) in enumerate(dump_mock.call_args_list):
-        min_mz, max_mz = ds_segments[segm_i]
+        for col in ['sp_idx', 'mz', 'int']:
+            assert getattr(loaded, col).dtype == getattr(ds_segm, col).dtype
+            assert_array_equal(getattr(loaded, col), getattr(ds_segm, col))
 
-        assert sp_chunk_df.shape == (50, 3)
-        assert np.all(min_mz <= sp_chunk_df.mz)
-        assert np.all(sp_chunk_df.mz <= max_mz)
+        save_ds_segment(path, DSSegment(*[arr[:0] for arr in ds_segm]))
+        assert load_ds_segment(path) is None
 
 
 @patch('sm.engine.annotation_spark.segmenter.pickle.dump')
@@ -1,10 +1,14 @@
+import pickle
 from itertools import product
+from pathlib import Path
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
+import pytest
 from pandas.util.testing import assert_frame_equal
 
-from sm.engine.annotation.fdr import FDR
+from sm.engine.annotation.fdr import FDR, TargetDecoyTable
 from sm.engine.formula_parser import format_modifiers
 
 FDR_CONFIG = {'decoy_sample_size': 2}
@@ -35,7 +39,7 @@ def test_fdr_decoy_adduct_selection_saves_corr():
     fdr.decoy_adducts_selection(target_formulas=['H2O'])
 
     assert_frame_equal(
-        fdr.td_df.sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
+        fdr.td_table.to_df().sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
         exp_target_decoy_df.sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
     )
 
@@ -49,9 +53,11 @@ def test_estimate_fdr_returns_correct_df():
         analysis_version=1,
     )
     fdr.fdr_levels = [0.2, 0.8]
-    fdr.td_df = pd.DataFrame(
-        [['H2O', '+H', '+Cu'], ['H2O', '+H', '+Co'], ['C2H2', '+H', '+Ag'], ['C2H2', '+H', '+Ar']],
-        columns=['formula', 'tm', 'dm'],
+    fdr.td_table = TargetDecoyTable(
+        formulas=np.array(['H2O', 'C2H2'], dtype='O'),
+        target_modifiers=np.array(['+H'], dtype='O'),
+        decoy_modifiers=np.array(['+Cu', '+Co', '+Ag', '+Ar'], dtype='O'),
+        dm_i=np.array([[[0, 1]], [[2, 3]]]),
     )
 
     msm_df = pd.DataFrame(
@@ -82,9 +88,11 @@ def test_estimate_fdr_digitize_works():
         analysis_version=1,
     )
     fdr.fdr_levels = [0.4, 0.8]
-    fdr.td_df = pd.DataFrame(
-        [['C1', '+H', '+Cu'], ['C2', '+H', '+Ag'], ['C3', '+H', '+Cl'], ['C4', '+H', '+Co']],
-        columns=['formula', 'tm', 'dm'],
+    fdr.td_table = TargetDecoyTable(
+        formulas=np.array(['C1', 'C2', 'C3', 'C4'], dtype='O'),
+        target_modifiers=np.array(['+H'], dtype='O'),
+        decoy_modifiers=np.array(['+Cu', '+Ag', '+Cl', '+Co'], dtype='O'),
+        dm_i=np.array([[[0]], [[1]], [[2]], [[3]]]),
     )
 
     msm_df = pd.DataFrame(
@@ -165,3 +173,109 @@ def test_chem_mods_and_neutral_losses():
     assert min_count < len(ions) <= max_count
     target_ions = list(product(formulas, target_modifiers))
     assert set(target_ions).issubset(set(map(tuple, ions)))
+
+
+@pytest.mark.parametrize('analysis_version', [1, 2])
+def test_estimate_fdr_matches_decoy_sample_definition(analysis_version):
+    rng = np.random.default_rng(42)
+    decoy_sample_size = 4
+    fdr = FDR(
+        fdr_config={'decoy_sample_size': decoy_sample_size},
+        chem_mods=[],
+        neutral_losses=['-H2O'],
+        target_adducts=['+H', '+Na'],
+        analysis_version=analysis_version,
+    )
+    formulas = [f'C{i}H{i}' for i in range(1, 200)]
+    fdr.decoy_adducts_selection(formulas)
+    # Rounded so that many ions share an MSM, some decoys have no MSM, and ions with zero MSM
+    # are included, like in real results
+    ions_df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    msm_df = ions_df.assign(msm=rng.random(len(ions_df)).round(2) ** 2).sample(
+        frac=0.9, random_state=1
+    )
+
+    fdr_df = fdr.estimate_fdr(msm_df)
+
+    # Expected FDRs, calculated one target at a time
+    msms = msm_df.set_index(['formula', 'modifier']).msm
+    exp_fdrs = {}
+    for tm, tm_td_df in fdr.td_table.to_df().groupby('tm'):
+        target_msms = msms[msms.index.get_level_values('modifier') == tm]
+        samples = [tm_td_df.iloc[i::decoy_sample_size] for i in range(decoy_sample_size)]
+        sample_msms = [msms.reindex(list(zip(s.formula, s.dm))).dropna() for s in samples]
+        for (formula, _), msm in target_msms.items():
+            n_targets = (target_msms >= msm).sum()
+            exp_fdrs[formula, tm] = np.median([(s >= msm).sum() / n_targets for s in sample_msms])
+    target_msm_df = msm_df[msm_df.modifier.isin(fdr.target_modifiers())]
+    exp_fdr_df = target_msm_df.assign(
+        fdr=[exp_fdrs[ion] for ion in zip(target_msm_df.formula, target_msm_df.modifier)]
+    )
+    exp_fdr_df = pd.concat(
+        [
+            fdr._digitize_fdr(exp_fdr_df[exp_fdr_df.modifier == tm]).drop('msm', axis=1)
+            for tm in fdr.target_modifiers()
+        ]
+    )
+
+    assert_frame_equal(fdr_df, exp_fdr_df)
+
+
+def test_decoy_adducts_selection_is_reproducible():
+    def select_decoys():
+        fdr = FDR(
+            fdr_config={'decoy_sample_size': 20},
+            chem_mods=['-H+C'],
+            neutral_losses=['-H2O'],
+            target_adducts=['+H', '+Na', '+K'],
+            analysis_version=1,
+        )
+        fdr.decoy_adducts_selection([f'C{i}H{i}' for i in range(1, 100)])
+        return fdr.td_table.to_df()
+
+    td_df = select_decoys()
+
+    assert_frame_equal(td_df, select_decoys())
+    assert len(td_df) == 99 * 12 * 20
+    # Decoys of a target ion are distinct, and have the target's chem mod & neutral loss
+    assert not td_df.duplicated().any()
+    assert td_df[td_df.tm == '-H+C-H2O+Na'].dm.str.startswith('-H+C-H2O+').all()
+    assert not td_df.dm.str.endswith(('+H', '+Na', '+K')).any()
+
+
+def test_fdr_pickled_with_td_df_can_estimate_fdr():
+    # Pickled before decoys were stored in a TargetDecoyTable, as FDR objects in the centroids
+    # cache were, with: FDR({'decoy_sample_size': 3}, [], ['-H2O'], ['+H', '+Na'], 1) and
+    # decoy_adducts_selection(['H2O', 'C2H2', 'CO2'])
+    with open(Path(__file__).parent / 'data' / 'fdr_with_td_df.pickle', 'rb') as f:
+        fdr = pickle.load(f)
+
+    td_df = fdr.td_table.to_df()
+    assert not hasattr(fdr, 'td_df')
+    assert td_df.shape == (36, 3)
+    assert td_df.iloc[:3].values.tolist() == [
+        ['H2O', '+H', '+Se'],
+        ['H2O', '+H', '+He'],
+        ['H2O', '+H', '+Fe'],
+    ]
+    ions_df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    assert len(ions_df) == 47
+
+    # Expected FDRs were calculated by the code that made the pickle
+    msm_df = ions_df.assign(msm=[(i * 7 % 11) / 10 for i in range(len(ions_df))])
+    fdr_df = fdr.estimate_fdr(msm_df)
+
+    assert list(zip(fdr_df.formula, fdr_df.modifier, fdr_df.fdr)) == [
+        ('C2H2', '+H', 1.0),
+        ('CO2', '+H', 1.0),
+        ('H2O', '+H', 1.0),
+        ('CO2', '+Na', 1.0),
+        ('H2O', '+Na', 1.0),
+        ('C2H2', '+Na', 1.0),
+        ('C2H2', '-H2O+H', 0.05),
+        ('CO2', '-H2O+H', 1.0),
+        ('H2O', '-H2O+H', 1.0),
+        ('H2O', '-H2O+Na', 0.05),
+        ('C2H2', '-H2O+Na', 1.0),
+        ('CO2', '-H2O+Na', 1.0),
+    ]
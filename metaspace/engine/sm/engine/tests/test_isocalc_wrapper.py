@@ -1,8 +1,13 @@
+from itertools import count
+from types import SimpleNamespace
+
 import pytest
 import numpy as np
 from numpy.testing import assert_array_almost_equal
 
 from tests.conftest import ds_config
+from sm.engine.annotation import centroids_cache
+from sm.engine.annotation.centroids_cache import CentroidsCache
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 
 
@@ -28,3 +33,123 @@ def test_centroids_h20(ds_config):
 
     assert_array_almost_equal(mzs, np.array([19.018, 20.022, 20.024, 21.022]), decimal=3)
     assert_array_almost_equal(ints, np.array([1.00e02, 3.83e-02, 3.48e-02, 2.06e-01]), decimal=2)
+
+
+def test_centroids_cache(ds_config, tmp_path):
+    cache_path = str(tmp_path / 'centroids_cache.sqlite')
+    centroids_cache.set_instance(CentroidsCache(cache_path, max_items=1))
+    try:
+        isocalc_wrapper = IsocalcWrapper(ds_config)
+        mzs, _ = isocalc_wrapper.centroids('H2O+H')
+        isocalc_wrapper.centroids('H2O+H')
+        isocalc_wrapper.centroids('C8H20NO6P+K')
+        assert centroids_cache.get_instance().stats() == {
+            'items': 1,
+            'max_items': 1,
+            'max_disk_items': centroids_cache.DEFAULT_MAX_DISK_ITEMS,
+            'hits': 1,
+            'disk_hits': 0,
+            'misses': 2,
+            'evictions': 1,
+            'disk_evictions': 0,
+            'disk_errors': 0,
+        }
+
+        # A new process should reuse the patterns stored on disk
+        centroids_cache.set_instance(CentroidsCache(cache_path, max_items=1))
+        cached_mzs, _ = isocalc_wrapper.centroids('H2O+H')
+        assert_array_almost_equal(cached_mzs, mzs)
+        assert centroids_cache.get_instance().stats()['disk_hits'] == 1
+
+        # Patterns for other instruments must not be shared
+        isocalc_wrapper.instrument = 'Orbitrap'
+        isocalc_wrapper.centroids('H2O+H')
+        assert centroids_cache.get_instance().stats()['misses'] == 1
+    finally:
+        centroids_cache.set_instance(None)
+
+
+def test_centroids_cache_evicts_least_recently_used_from_disk(tmp_path, monkeypatch):
+    clock = count()
+    monkeypatch.setattr(centroids_cache, 'time', SimpleNamespace(time=lambda: next(clock)))
+    monkeypatch.setattr(centroids_cache, 'DISK_SIZE_CHECK_INTERVAL', 1)
+    monkeypatch.setattr(centroids_cache, 'DISK_WRITE_BATCH_SIZE', 1)
+    monkeypatch.setattr(centroids_cache, 'LAST_USED_UPDATE_INTERVAL_S', 0)
+    cache = CentroidsCache(str(tmp_path / 'centroids_cache.sqlite'), max_items=1, max_disk_items=4)
+    try:
+        for i in range(4):
+            cache.put(('formula', i), i)
+        # Reading from disk marks the pattern as recently used
+        assert cache.get(('formula', 0)) == 0
+        assert cache.stats()['disk_evictions'] == 0
+
+        cache.put(('formula', 4), 4)
+
+        assert cache.stats()['disk_evictions'] == 2
+        assert [cache.get(('formula', i)) for i in range(5)] == [0, None, None, 3, 4]
+    finally:
+        cache.close()
+
+
+def test_centroids_cache_batches_disk_writes(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(centroids_cache, 'time', SimpleNamespace(time=lambda: now[0]))
+    monkeypatch.setattr(centroids_cache, 'DISK_WRITE_BATCH_SIZE', 3)
+    cache_path = str(tmp_path / 'centroids_cache.sqlite')
+    cache = CentroidsCache(cache_path, max_items=1)
+    reader = CentroidsCache(cache_path, max_items=1)
+
+    def last_used(key):
+        return (
+            reader._connection()
+            .execute('SELECT last_used FROM centroids WHERE key = ?', (repr(key),))
+            .fetchone()[0]
+        )
+
+    try:
+        cache.put(('formula', 0), 0)
+        cache.put(('formula', 1), 1)
+        # Pending writes are still readable by the same cache, but not yet by other processes
+        assert cache.get(('formula', 0)) == 0
+        assert reader.get(('formula', 0)) is None
+
+        cache.put(('formula', 2), 2)
+        assert [reader.get(('formula', i)) for i in range(3)] == [0, 1, 2]
+
+        # Disk hits only update the last used time once it's old enough
+        now[0] += centroids_cache.LAST_USED_UPDATE_INTERVAL_S / 2
+        assert cache.get(('formula', 0)) == 0
+        assert last_used(('formula', 0)) == 1000.0
+        now[0] += centroids_cache.LAST_USED_UPDATE_INTERVAL_S
+        cache.get(('formula', 1))  # Evicts ('formula', 0) from memory
+        assert cache.get(('formula', 0)) == 0
+        assert last_used(('formula', 0)) == now[0]
+
+        # Writes that have waited too long are flushed with the next one
+        cache.put(('formula', 3), 3)
+        now[0] += centroids_cache.DISK_WRITE_MAX_DELAY_S
+        cache.put(('formula', 4), 4)
+        assert reader.get(('formula', 3)) == 3
+        assert reader.get(('formula', 4)) == 4
+    finally:
+        cache.close()
+        reader.close()
+
+
+def test_centroids_cache_disabled_per_caller(ds_config):
+    cache = CentroidsCache()
+    centroids_cache.set_instance(cache)
+    try:
+        IsocalcWrapper(ds_config, use_centroids_cache=False).centroids('H2O+H')
+        assert cache.stats()['misses'] == 0
+
+        IsocalcWrapper(ds_config).centroids('H2O+H')
+        assert cache.stats()['misses'] == 1
+
+        IsocalcWrapper.set_centroids_cache_enabled(False)
+        IsocalcWrapper(ds_config).centroids('H2O+H')
+        assert centroids_cache.get_instance() is cache
+        assert cache.stats()['hits'] == 0
+    finally:
+        IsocalcWrapper.set_centroids_cache_enabled(True)
+        centroids_cache.set_instance(None)
@@ -45,7 +45,9 @@ def populate_aws_env_vars(aws_config):
 
 
 def on_startup(config_path: str) -> Dict:
-    from sm.engine import image_storage  # pylint: disable=import-outside-toplevel,cyclic-import
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from sm.engine import image_storage
+    from sm.engine.annotation import centroids_cache
 
     SMConfig.set_path(config_path)
     sm_config = SMConfig.get_conf()
@@ -55,6 +57,7 @@ def on_startup(config_path: str) -> Dict:
         populate_aws_env_vars(sm_config['aws'])
 
     image_storage.init(sm_config)
+    centroids_cache.init(sm_config)
 
     return sm_config
 
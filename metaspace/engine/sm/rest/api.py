@@ -3,6 +3,7 @@ import logging
 
 import bottle
 
+from sm.engine.annotation import centroids_cache
 from sm.engine.util import GlobalInit
 from sm.rest import isotopic_pattern, datasets, databases
 from sm.rest.utils import make_response, OK, INTERNAL_ERROR
@@ -29,6 +30,12 @@ def generate(ion, instr, res_power, at_mz, charge):
         return make_response(INTERNAL_ERROR)
 
 
+@app.get('/v1/centroids_cache/stats')
+def centroids_cache_stats():
+    cache = centroids_cache.get_instance()
+    return make_response(OK, data=cache.stats() if cache is not None else None)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='SM Engine REST API')
     parser.add_argument(
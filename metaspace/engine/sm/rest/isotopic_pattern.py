@@ -3,6 +3,8 @@ import logging
 import numpy as np
 from cpyMSpec import isotopePattern, InstrumentModel
 
+from sm.engine.annotation import centroids_cache
+
 ISOTOPIC_PEAK_N = 4
 SIGMA_TO_FWHM = 2.3548200450309493  # 2 \sqrt{2 \log 2}
 
@@ -65,9 +67,19 @@ class Centroids:
         return (not self.mzs) and (not self.ints)
 
 
-def generate(ion, instr, res_power, at_mz, charge):
+def _generate_uncached(ion, instr, res_power, at_mz, charge):
     isotopes = isotopePattern(ion)
     isotopes.addCharge(int(charge))
     instrument = InstrumentModel(instr, float(res_power), float(at_mz))
     centroids = Centroids(isotopes, instrument)
     return centroids.spectrum_chart()
+
+
+def generate(ion, instr, res_power, at_mz, charge):
+    cache = centroids_cache.get_instance()
+    if cache is not None:
+        key = ('isotopic_pattern', ion, instr, float(res_power), float(at_mz), int(charge))
+        return cache.get_or_compute(
+            key, lambda: _generate_uncached(ion, instr, res_power, at_mz, charge)
+        )
+    return _generate_uncached(ion, instr, res_power, at_mz, charge)
@@ -17,6 +17,7 @@ from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine.annotation_lithops.annotation_job import ServerAnnotationJob, LocalAnnotationJob
 from sm.engine.dataset import Dataset, DatasetStatus
 from sm.engine.db import DB
+from sm.engine.tests.annotation_lithops.utils import strip_spectra_stats
 from sm.engine.utils.perf_profile import perf_profile
 from tests.conftest import (
     global_setup,
@@ -79,11 +80,13 @@ def make_test_imzml(ds_config):
         yield f'{tmpdir}/test.imzML', f'{tmpdir}/test.ibd'
 
 
-def upload_test_imzml(storage: Storage, sm_config, ds_config):
+def upload_test_imzml(storage: Storage, sm_config, ds_config, with_spectra_stats=True):
     """Create an ImzML file, upload it into storage, and return an imzml_reader for it"""
     with make_test_imzml(ds_config) as (imzml_path, ibd_path):
         imzml_content = open(imzml_path, 'rb').read()
         ibd_content = open(ibd_path, 'rb').read()
+    if not with_spectra_stats:
+        imzml_content = strip_spectra_stats(imzml_content)
 
     bucket, prefix = sm_config['lithops']['sm_storage']['imzml']
     storage.put_cloudobject(imzml_content, bucket, f'{prefix}/test_ds/test.imzML')
@@ -219,6 +222,51 @@ def test_server_annotation_job(test_db, executor: Executor, sm_config, ds_config
     assert len(profile_entries) > 10
 
 
+@patch('sm.engine.annotation.fdr.DECOY_ADDUCTS', MOCK_DECOY_ADDUCTS)
+@patch('sm.engine.annotation_lithops.segment_centroids.MIN_CENTR_SEGMS', 2)  # Reduce log spam
+def test_server_annotation_job_with_all_ions_stored_keeps_diagnostics(
+    test_db, executor: Executor, sm_config, ds_config, metadata
+):
+    db = DB()
+    moldb_id = import_test_molecular_db()
+    ds_config['database_ids'] = [moldb_id]
+    ds_config['isotope_generation']['adducts'] = ['[M]+']
+    ds_config['fdr']['decoy_sample_size'] = len(MOCK_DECOY_ADDUCTS)
+    # Without the metadata, the TICs and mz range are only known after reading the spectra
+    input_path = upload_test_imzml(executor.storage, sm_config, ds_config, with_spectra_stats=False)
+    ds = Dataset(
+        id=datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss'),
+        name='Test Lithops Dataset',
+        input_path=input_path,
+        upload_dt=datetime.now(),
+        metadata=metadata,
+        config=ds_config,
+        is_public=True,
+        status=DatasetStatus.QUEUED,
+    )
+    ds.save(db, None, allow_insert=True)
+
+    def get_diagnostics():
+        diags = db.select_with_fields(
+            'SELECT type, data FROM dataset_diagnostic WHERE ds_id = %s', (ds.id,)
+        )
+        return {diag['type']: diag['data'] for diag in diags}
+
+    with perf_profile(db, 'test_lithops_annotate', ds.id) as perf:
+        executor._perf = perf
+        ServerAnnotationJob(executor=executor, ds=ds, perf=perf, incremental=True).run()
+        diagnostics = get_diagnostics()
+
+        # All ions have stored metrics now, so no spectra are read
+        job = ServerAnnotationJob(executor=executor, ds=ds, perf=perf, incremental=True)
+        job.run()
+
+    assert not job.pipe.formula_cobjs
+    assert diagnostics[DiagnosticType.IMZML_METADATA]['min_mz'] > 0
+    assert diagnostics[DiagnosticType.TIC]['min_tic'] > 0
+    assert get_diagnostics() == diagnostics
+
+
 @patch('sm.engine.annotation.fdr.DECOY_ADDUCTS', MOCK_DECOY_ADDUCTS)
 @patch('sm.engine.annotation_lithops.segment_centroids.MIN_CENTR_SEGMS', 2)  # Reduce log spam
 def test_local_annotation_job(executor: Executor, sm_config, ds_config):
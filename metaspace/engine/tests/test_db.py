@@ -44,3 +44,16 @@ def test_insert_nested_transaction_rollback(sm_config, empty_test_db):
         db2 = DB()
         row = db2.select_one(JOB_SEL, (job_id,))
         assert row == []
+
+
+def test_iter_select_with_fields(sm_config, empty_test_db):
+    with ConnectionPool(sm_config['db']):
+        db = DB()
+        db.alter(TABLE_CREATE)
+        db.insert_return(JOB_INS, [(i, f'ds{i}') for i in range(5)])
+
+        rows = db.iter_select_with_fields(
+            'SELECT moldb_id, ds_id FROM job WHERE moldb_id >= %s ORDER BY id', (1,), batch_size=2
+        )
+
+        assert list(rows) == [{'moldb_id': i, 'ds_id': f'ds{i}'} for i in range(1, 5)]
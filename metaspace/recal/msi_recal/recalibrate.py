@@ -32,23 +32,48 @@ TRANSFORM = {
 }
 
 
+def _read_spectra_block(p: ImzMLParser, sp_idxs: np.ndarray):
+    """Reads the given spectra into concatenated arrays via a memory map of the .ibd file,
+    instead of seeking and reading every spectrum separately with `ImzMLParser.getspectrum`.
+    Returns the spectrum index of each peak along with the mzs and intensities."""
+    mz_lengths = np.array(p.mzLengths, dtype=np.int64)[sp_idxs]
+    int_lengths = np.array(p.intensityLengths, dtype=np.int64)[sp_idxs]
+    assert np.all(mz_lengths == int_lengths), 'mz and intensity array lengths differ'
+    mz_offsets = np.array(p.mzOffsets, dtype=np.int64)[sp_idxs]
+    int_offsets = np.array(p.intensityOffsets, dtype=np.int64)[sp_idxs]
+
+    ends = np.cumsum(mz_lengths)
+    starts = ends - mz_lengths
+    mzs = np.empty(ends[-1] if len(ends) else 0, dtype=p.mzPrecision)
+    ints = np.empty(len(mzs), dtype=p.intensityPrecision)
+    if len(mzs):
+        ibd = np.memmap(p.m.name, dtype=np.uint8, mode='r')
+        for start, end, mz_offset, int_offset in zip(starts, ends, mz_offsets, int_offsets):
+            n = end - start
+            mzs[start:end] = np.frombuffer(ibd, p.mzPrecision, count=n, offset=mz_offset)
+            ints[start:end] = np.frombuffer(ibd, p.intensityPrecision, count=n, offset=int_offset)
+        del ibd
+
+    return np.repeat(sp_idxs, mz_lengths), mzs, ints
+
+
 def get_spectra_df_from_parser(p: ImzMLParser, sp_idxs: Iterable[int]):
-    peaks_dfs = []
-    spectra = []
-
-    for i in sp_idxs:
-        mzs, ints = p.getspectrum(i)
-        x, y, z = p.coordinates[i]
-        mask = ints > 0
-        mzs = mzs[mask].astype(np.float64)
-        ints = ints[mask].astype(np.float32)
-        peaks_dfs.append(pd.DataFrame({'sp': i, 'mz': mzs, 'ints': ints}))
-        spectra.append((i, x, y, z, np.min(mzs), np.max(mzs), np.sum(ints)))
-
-    peaks_df = pd.concat(peaks_dfs)
+    sp_idxs = np.asarray(sp_idxs, dtype=np.int64)
+    sps, mzs, ints = _read_spectra_block(p, sp_idxs)
+    mask = ints > 0
+    peaks_df = pd.DataFrame(
+        {'sp': sps[mask], 'mz': mzs[mask].astype(np.float64), 'ints': ints[mask].astype(np.float32)}
+    )
+
+    coords = np.array(p.coordinates)[sp_idxs]
     spectra_df = pd.DataFrame(
-        spectra, columns=['sp', 'x', 'y', 'z', 'mz_lo', 'mz_hi', 'tic']
+        {'sp': sp_idxs, 'x': coords[:, 0], 'y': coords[:, 1], 'z': coords[:, 2]}
     ).set_index('sp')
+    peak_stats = peaks_df.groupby('sp').agg(
+        mz_lo=('mz', 'min'), mz_hi=('mz', 'max'), tic=('ints', 'sum')
+    )
+    spectra_df = spectra_df.join(peak_stats)
+    spectra_df['tic'] = spectra_df.tic.fillna(0)
 
     return peaks_df, spectra_df
 
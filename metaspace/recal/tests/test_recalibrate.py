@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from numpy.random import default_rng
+from pyimzml.ImzMLParser import ImzMLParser
+from pyimzml.ImzMLWriter import ImzMLWriter
+
+from msi_recal.recalibrate import get_spectra_df_from_parser
+
+
+@pytest.mark.parametrize('mode', ['processed', 'continuous'])
+def test_get_spectra_df_from_parser_matches_getspectrum(tmp_path, mode):
+    rng = default_rng(42)
+    imzml_path = str(tmp_path / 'test.imzML')
+    base_mzs = np.sort(rng.uniform(100, 1000, 30))
+    with ImzMLWriter(imzml_path, mode=mode, intensity_dtype=np.float32) as writer:
+        for i in range(20):
+            if mode == 'continuous':
+                mzs = base_mzs
+            else:
+                mzs = np.sort(rng.uniform(100, 1000, rng.integers(1, 30)))
+            ints = rng.uniform(0, 10, len(mzs))
+            ints[rng.random(len(mzs)) < 0.3] = 0
+            ints[0] = 1
+            writer.addSpectrum(mzs, ints, (i % 5 + 1, i // 5 + 1, 1))
+
+    p = ImzMLParser(imzml_path, parse_lib='ElementTree')
+    sp_idxs = [0, 3, 4, 10, 19]
+    peaks_df, spectra_df = get_spectra_df_from_parser(p, sp_idxs)
+
+    assert spectra_df.index.tolist() == sp_idxs
+    for i in sp_idxs:
+        mzs, ints = p.getspectrum(i)
+        mask = ints > 0
+        sp_peaks = peaks_df[peaks_df.sp == i]
+        np.testing.assert_array_equal(sp_peaks.mz, mzs[mask])
+        np.testing.assert_array_equal(sp_peaks.ints, ints[mask])
+
+        spectrum = spectra_df.loc[i]
+        assert (spectrum.x, spectrum.y, spectrum.z) == p.coordinates[i]
+        assert spectrum.mz_lo == np.min(mzs[mask])
+        assert spectrum.mz_hi == np.max(mzs[mask])
+        assert spectrum.tic == pytest.approx(np.sum(ints[mask]), rel=1e-5)